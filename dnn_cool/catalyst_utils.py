@@ -5,8 +5,10 @@ from typing import Callable, Dict, Optional, Tuple, List
 import numpy as np
 from catalyst.contrib.tools.tensorboard import SummaryWriter
 from catalyst.core import Callback, CallbackOrder, State
+from catalyst.dl import CriterionCallback
 from torch.utils.data import Dataset, SequentialSampler
 
+from dnn_cool.losses import TaskFlowLoss, FlowLossResults
 from dnn_cool.task_flow import TaskFlow
 from dnn_cool.utils import any_value
 
@@ -83,13 +85,113 @@ class TensorboardConverters:
             logger.close()
 
 
+# The results of the criterion for the batch are kept in the output of the runner, which is replaced on every batch.
+LOSS_RESULTS_KEY = '_flow_loss_results'
+
+
+def get_loss_results(state: State, criterion: TaskFlowLoss,
+                     input_key: str = 'targets', output_key: str = 'logits') -> FlowLossResults:
+    """
+    :return: The results of `TaskFlowLoss.get_results` for the current batch. They are computed by the first callback
+    which needs them, so the criterion, the leaf losses and the interpretation compute the losses only once per batch.
+    The results are kept per criterion and keys, so callbacks of different criterions do not share them.
+    """
+    cache = state.output.setdefault(LOSS_RESULTS_KEY, {})
+    key = (id(criterion), input_key, output_key)
+    if key not in cache:
+        cache[key] = criterion.get_results(state.output[output_key], state.input[input_key])
+    return cache[key]
+
+
+class FlowCriterionCallback(CriterionCallback):
+    """
+    Computes the loss of the batch like `CriterionCallback` and keeps the `FlowLossResults` in the state of the runner
+    for the other callbacks (see `get_loss_results`).
+    """
+
+    def on_batch_end(self, state: State):
+        if not isinstance(self._criterion, TaskFlowLoss):
+            return super().on_batch_end(state)
+        results = get_loss_results(state, self._criterion, self.input_key, self.output_key)
+        state.batch_metrics[self.prefix] = results.loss * self.multiplier
+
+
+class LeafLossCallback(Callback):
+    """
+    Logs the loss of a leaf task, taken from the results of the criterion for the batch (see `get_loss_results`)
+    instead of computing it again.
+    """
+
+    def __init__(self, prefix: str, criterion: TaskFlowLoss, path: str,
+                 input_key: str = 'targets', output_key: str = 'logits'):
+        super().__init__(CallbackOrder.Metric)
+        self.prefix = prefix
+        self.criterion = criterion
+        self.path = path
+        self.input_key = input_key
+        self.output_key = output_key
+
+    def on_batch_end(self, state: State):
+        results = get_loss_results(state, self.criterion, self.input_key, self.output_key)
+        state.batch_metrics[self.prefix] = results.get_leaf_losses()[self.path]
+
+
+class MetricAccumulatorCallback(Callback):
+    """
+    Accumulates the metrics of a task over all batches of a loader on the device (see `TaskMetrics.update`) and logs
+    their exact values for the whole loader, once at the end of the loader. The metrics are logged as
+    `<metric name>_<task path>`.
+    """
+
+    def __init__(self, path: str, metric_decorator, input_key: str = 'targets', output_key: str = 'logits'):
+        """
+        :param path: The path of the task.
+        :param metric_decorator: `BaseMetricDecorator` of the `TaskMetrics` of the task.
+        """
+        super().__init__(CallbackOrder.Metric)
+        self.path = path
+        self.metric_decorator = metric_decorator
+        self.input_key = input_key
+        self.output_key = output_key
+
+    def on_loader_start(self, state: State):
+        self.metric_decorator.metric.reset()
+
+    def on_batch_end(self, state: State):
+        self.metric_decorator.update(state.output[self.output_key], state.input[self.input_key])
+
+    def on_loader_end(self, state: State):
+        task_metrics = self.metric_decorator.metric
+        values = task_metrics.compute()
+        task_metrics.reset()
+        for metric_name, metric in task_metrics.metrics:
+            value = values[metric_name]
+            if value is None:
+                continue
+            prefix = f'{metric_name}_{self.path}'
+            if not metric.is_multi_metric():
+                state.loader_metrics[prefix] = float(value)
+                continue
+            # The same names as catalyst `MultiMetricCallback`.
+            for arg, metric_value in zip(metric.list_args(), value):
+                key = f'{prefix}{arg:02}' if isinstance(arg, int) else f'{prefix}_{arg}'
+                state.loader_metrics[key] = float(metric_value)
+
+
 class InterpretationCallback(Callback):
-    def __init__(self, flow: TaskFlow, tensorboard_converters: Optional[TensorboardConverters] = None):
+    def __init__(self, flow: TaskFlow, tensorboard_converters: Optional[TensorboardConverters] = None,
+                 criterion: Optional[TaskFlowLoss] = None):
+        """
+        :param flow: The task flow.
+        :param tensorboard_converters: Publishes the best and the worst samples in tensorboard.
+        :param criterion: The loss of the flow. The per-sample losses are taken from the results of the batch when
+        another callback already computed them (see `get_loss_results`).
+        """
         super().__init__(CallbackOrder.Metric)
         self.flow = flow
 
-        self.overall_loss = flow.get_per_sample_loss()
-        self.leaf_losses = self.overall_loss.get_leaf_losses_per_sample()
+        self.criterion = criterion if criterion is not None else flow.get_loss()
+        self.leaf_losses = self.criterion.get_leaf_losses()
         self.interpretations = {}
         self.loader_counts = {}
 
@@ -118,8 +220,7 @@ class InterpretationCallback(Callback):
         if not isinstance(state.loaders[state.loader_name].sampler, SequentialSampler):
             return
         outputs = state.output['logits']
-        targets = state.input['targets']
-        overall_res = self.overall_loss(outputs, targets)
+        overall_res = get_loss_results(state, self.criterion).get_per_sample()
         start = self.loader_counts[state.loader_name]
         bs = len(any_value(outputs))
 
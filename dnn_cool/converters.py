@@ -2,26 +2,89 @@ from dataclasses import dataclass, field
 from typing import Tuple, Dict
 
 import numpy as np
+import torch
 
 from dnn_cool.catalyst_utils import TensorboardConverter
 
 
+def get_packing_key(value):
+    """
+    :return: The key by which 1D numeric columns are grouped into one contiguous block, or `None` if the column is not
+    packed.
+    """
+    if isinstance(value, torch.Tensor) and value.dim() == 1:
+        return 'torch', value.dtype
+    # Memory-mapped columns are not packed, since this would load them in memory.
+    if type(value) is np.ndarray and value.ndim == 1 and value.dtype != object:
+        return 'numpy', value.dtype
+    return None
+
+
+def get_nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.memmap):
+        return 0
+    return getattr(value, 'nbytes', 0)
+
+
 class Values:
+    """
+    Columnar container of the values of one or more columns. 1D numeric columns with the same type and dtype are
+    stored together in a single contiguous 2D block, so that indexing (with an int, a slice or an array of indices)
+    selects the rows of all of them at once.
+    """
 
     def __init__(self, keys, values):
         assert len(keys) == len(values)
-        self.keys = keys
-        self.values = values
+        self.keys = list(keys)
+        self.values = list(values)
+        self.blocks = []
+
+        groups = {}
+        for i, value in enumerate(self.values):
+            packing_key = get_packing_key(value)
+            if packing_key is not None:
+                groups.setdefault(packing_key, []).append(i)
+        self._unpacked = set(range(len(self.keys)))
+        for indices in groups.values():
+            if len(indices) < 2:
+                continue
+            columns = [self.values[i] for i in indices]
+            if isinstance(columns[0], torch.Tensor):
+                block = torch.stack(columns, dim=1)
+            else:
+                block = np.stack(columns, axis=1)
+            for j, i in enumerate(indices):
+                self.values[i] = block[:, j]
+            self.blocks.append((indices, block))
+            self._unpacked.difference_update(indices)
 
     def __getitem__(self, item):
-        res = {}
-        for i, key in enumerate(self.keys):
-            res[key] = self.values[i][item]
-        return res
+        if len(self.blocks) == 0:
+            return {key: self.values[i][item] for i, key in enumerate(self.keys)}
+        columns = {}
+        for indices, block in self.blocks:
+            rows = block[item]
+            for j, i in enumerate(indices):
+                columns[i] = rows[..., j]
+        for i in self._unpacked:
+            columns[i] = self.values[i][item]
+        return {key: columns[i] for i, key in enumerate(self.keys)}
 
     def __len__(self):
         return len(self.values[0])
 
+    def memory_footprint(self):
+        """
+        :return: dict from key to the number of bytes, which the column occupies in memory (memory-mapped columns
+        are not counted).
+        """
+        return {key: get_nbytes(value) for key, value in zip(self.keys, self.values)}
+
+    def nbytes(self):
+        return sum(self.memory_footprint().values())
+
 
 @dataclass()
 class TypeGuesser:
@@ -83,6 +146,14 @@ class StatefulConverter:
 @dataclass()
 class ValuesConverter(StatefulConverter):
 
+    def get_converter(self, col, guessed_type):
+        """
+        :return: The converter which is used for the column, or `None` if there is no registered converter.
+        """
+        if col in self.col_mapping:
+            return self.col_mapping[col]
+        return self.type_mapping.get(guessed_type)
+
     def to_values(self, df, col, guessed_type):
         if col in self.col_mapping:
             converter = self.col_mapping[col]
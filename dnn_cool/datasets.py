@@ -1,7 +1,22 @@
+import hashlib
+import json
+
+import numpy as np
 import torch
 
 from dataclasses import dataclass
-from torch.utils.data.dataset import Dataset
+from itertools import islice
+from pathlib import Path
+from typing import Tuple
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, SequentialSampler, get_worker_info
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.dataset import Dataset, IterableDataset
+
+from dnn_cool.modules import MaskEvaluator
+from dnn_cool.packed import PackedGt, PackedLayout, PACKED_GT_KEY, PACKED_AVAILABILITY_KEY, \
+    PACKED_GT_PRECONDITIONS_KEY
+
+SHARDS_MANIFEST_FILE = 'shards.json'
 
 
 class LeafTaskDataset(Dataset):
@@ -27,10 +42,19 @@ def discover_index_holder(*args, **kwargs):
             return arg
 
 
+def to_contiguous_tensor(labels):
+    if isinstance(labels, np.ndarray) and labels.dtype != object:
+        return torch.from_numpy(np.ascontiguousarray(labels))
+    if isinstance(labels, torch.Tensor):
+        return labels.contiguous()
+    return labels
+
+
 class FlowDatasetDecorator:
 
     def __init__(self, task, prefix, labels):
         self.task_name = task.get_name()
+        labels = to_contiguous_tensor(labels)
         self.available = task.get_available_func()(labels)
         self.prefix = prefix
         self.arr = labels
@@ -96,14 +120,56 @@ class FlowDatasetDict:
             targets = value
             y[key] = targets
         X['gt'] = self.gt
-        X['gt']['_availability'] = self.available
+        if not isinstance(self.gt, PackedGt):
+            X['gt']['_availability'] = self.available
         return X, y
 
 
+def get_tables_fingerprint(layout, preconditions, labels, available):
+    """
+    :return: Hash of everything the packed tables are computed from - the layout, the precondition expressions, the
+    gt of the tasks used in preconditions and the availability of all tasks.
+    """
+    digest = hashlib.sha256(json.dumps(layout.get_shapes(), sort_keys=True).encode())
+    for path, precondition in preconditions.items():
+        digest.update(f'{path}:{precondition.get_key()}'.encode())
+    columns = [labels[path] for path in layout.gt_index] + [available[path] for path in layout.available_index]
+    for column in columns:
+        column = column.detach().cpu().numpy() if isinstance(column, torch.Tensor) else np.asarray(column)
+        column = np.ascontiguousarray(column)
+        digest.update(f'{column.dtype.str}{column.shape}'.encode())
+        digest.update(column.view(np.uint8).reshape(-1).data)
+    return digest.hexdigest()
+
+
+def load_packed_tables(tables_path, layout, n, fingerprint):
+    if tables_path is None or not Path(tables_path).exists():
+        return None
+    saved = torch.load(tables_path)
+    # The tables are computed again if the labels (or the flow) changed since they were saved.
+    if not isinstance(saved, dict) or saved.get('fingerprint') != fingerprint:
+        return None
+    tables = saved['tables']
+    widths = {
+        PACKED_GT_KEY: layout.gt_index.width,
+        PACKED_AVAILABILITY_KEY: layout.available_index.width,
+        PACKED_GT_PRECONDITIONS_KEY: layout.precondition_index.width,
+    }
+    for key, width in widths.items():
+        if key not in tables or tables[key].shape != (n, width):
+            return None
+    return tables
+
+
 class FlowDataset(Dataset):
 
-    def __init__(self, task_flow, prefix=''):
+    def __init__(self, task_flow, prefix='', tables_path=None, inputs=None):
+        """
+        :param inputs: Optional inputs, which replace the inputs of the task flow (for example cached backbone features,
+        see `cache_features`).
+        """
         self._task_flow = task_flow
+        self._inputs = inputs
         # Save a reference to the flow function of the original class
         # We will then call it by replacing the self, this way effectively running
         # it with this class. And this class stores Pytorch modules as class attributes
@@ -120,15 +186,60 @@ class FlowDataset(Dataset):
                 setattr(self, key, instance)
         self.prefix = prefix
 
+        compiled_flow = task_flow.get_compiled_flow(prefix)
+        self._compiled_leaves = compiled_flow.resolve_leaves(self)
+        self._gt_paths = compiled_flow.get_condition_paths()
+        self._packed_layout = None
+        self._packed_tables = None
+        # Only the root dataset is indexed directly, so the nested datasets do not keep copies of the packed tables.
+        if len(prefix) == 0 and self.n is not None:
+            self.pack_tables(tables_path)
+
+    def pack_tables(self, tables_path=None):
+        """
+        Precomputes, as packed (samples x tasks) bool matrices laid out by the packed layout of the task flow: the decoded
+        gt of the tasks used in preconditions, the availability of all tasks and the precondition masks of all tasks
+        (the full negated and nested conditions, evaluated on the gt). Every item then selects one row of each matrix,
+        instead of building one small tensor per task, and the module does not evaluate the conditions when training.
+        :param tables_path: Optional file, from which the tables are loaded if it was saved from the same labels and
+        flow, or where they are saved otherwise.
+        """
+        layout = self._task_flow.get_packed_layout(self.prefix)
+        labels = {leaf.prefix + leaf.task_name: leaf.arr for leaf in self._compiled_leaves}
+        available = {leaf.prefix + leaf.task_name: leaf.available for leaf in self._compiled_leaves}
+        preconditions = self._task_flow.get_compiled_flow(self.prefix).get_preconditions()
+        fingerprint = None
+        if tables_path is not None:
+            fingerprint = get_tables_fingerprint(layout, preconditions, labels, available)
+        tables = load_packed_tables(tables_path, layout, self.n, fingerprint)
+        if tables is None:
+            tables = {
+                PACKED_GT_KEY: layout.gt_index.pack(labels, self.n),
+                PACKED_AVAILABILITY_KEY: layout.available_index.pack(available, self.n),
+            }
+            mask_evaluator = MaskEvaluator(PackedGt(tables, layout))
+            masks = {path: mask_evaluator.to_mask(precondition) for path, precondition in preconditions.items()}
+            tables[PACKED_GT_PRECONDITIONS_KEY] = layout.precondition_index.pack(masks, self.n)
+            if tables_path is not None:
+                torch.save({'fingerprint': fingerprint, 'tables': tables}, tables_path)
+        self._packed_tables = tables
+        self._packed_layout = layout
+
+    def get_inputs(self):
+        return self._inputs if self._inputs is not None else self._task_flow.get_inputs()
+
     def __getitem__(self, item):
         """
-        This method is going to execute the flow given in the constructor, passing around the index variable `item` in
-        the class `IndexHolder`
-        :param item:
+        This method is going to run the compiled plan of the flow given in the constructor, selecting the index `item`
+        from the labels of every leaf task.
+        :param item: A single index, or a sequence of indices - then the whole batch is selected with fancy indexing
+        and the result is already collated (see `batched_loader`).
         :return:
         """
-        flow_dataset_dict = self.flow(self, IndexHolder(item), FlowDatasetDict(self.prefix, {}))
-        inputs = self._task_flow.get_inputs()
+        if isinstance(item, (list, tuple)):
+            item = np.asarray(item)
+        flow_dataset_dict = self.run_compiled(item)
+        inputs = self.get_inputs()
         if inputs is None:
             raise ValueError(f'Cannot build a dataset, since the inputs are not provided. You have to provide them'
                              f' in the constructor of the TaskFlow class.')
@@ -143,6 +254,335 @@ class FlowDataset(Dataset):
     def __len__(self):
         return self.n
 
+    def run_compiled(self, item):
+        data = {}
+        available = {}
+        for leaf in self._compiled_leaves:
+            key = leaf.prefix + leaf.task_name
+            data[key] = leaf.arr[item]
+            if self._packed_layout is None:
+                available[key] = leaf.available[item]
+        flow_dataset_dict = FlowDatasetDict(self.prefix, data, available)
+        if self._packed_layout is not None:
+            packed = {key: table[item] for key, table in self._packed_tables.items()}
+            flow_dataset_dict.gt = PackedGt(packed, self._packed_layout)
+            return flow_dataset_dict
+        for path in self._gt_paths:
+            flow_dataset_dict.gt[path] = data[path].bool()
+        return flow_dataset_dict
+
     def __call__(self, *args, **kwargs):
         index_holder = discover_index_holder(*args, **kwargs)
         return self.flow(self, index_holder, FlowDatasetDict(self.prefix))
+
+
+def batched_loader(dataset, batch_size, shuffle=False, drop_last=False, **kwargs) -> DataLoader:
+    """
+    Creates a `DataLoader`, which fetches every batch with a single indexing of the dataset with an array of indices,
+    instead of fetching and collating the samples one by one. The dataset must support indexing with an array of
+    indices, as `FlowDataset` does (its inputs must support it too).
+    :param dataset: The dataset.
+    :param batch_size: The batch size.
+    :param shuffle: Whether to shuffle the samples.
+    :param drop_last: Whether to drop the last incomplete batch.
+    :param kwargs: Other arguments for the `DataLoader`, like `num_workers` or `pin_memory`.
+    :return: The `DataLoader`.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    batch_sampler = BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last)
+    # With `batch_size=None`, every list of indices from the sampler is given to the dataset as is.
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, **kwargs)
+
+
+def flatten_batch(obj, path=()):
+    """
+    :return: list of `(path, value)` pairs for all leaves of a nested structure of dicts, lists and tuples. For dicts
+    the raw entries are used, so a `PackedGt` gives its packed matrices.
+    """
+    if isinstance(obj, dict):
+        return [leaf for key, value in dict.items(obj) for leaf in flatten_batch(value, path + (key,))]
+    if isinstance(obj, (list, tuple)):
+        return [leaf for i, value in enumerate(obj) for leaf in flatten_batch(value, path + (i,))]
+    return [(path, obj)]
+
+
+def gather_leaves(samples, path, leaves):
+    """
+    Collects the values of every leaf of the nested structure of the samples, as `(path, list of values)` pairs.
+    """
+    first = samples[0]
+    if isinstance(first, dict):
+        for key in dict.keys(first):
+            gather_leaves([dict.__getitem__(sample, key) for sample in samples], path + (key,), leaves)
+    elif isinstance(first, (list, tuple)):
+        for i, values in enumerate(zip(*samples)):
+            gather_leaves(values, path + (i,), leaves)
+    else:
+        leaves.append((path, samples))
+
+
+def unflatten_batch(template, values, path=()):
+    """
+    Rebuilds the structure of `template` with the leaves taken from `values` (a dict from path to value). Tuples become
+    lists, as in `default_collate`, and a `PackedGt` keeps its layout.
+    """
+    if isinstance(template, dict):
+        res = {key: unflatten_batch(value, values, path + (key,)) for key, value in dict.items(template)}
+        return PackedGt(res, template.layout) if isinstance(template, PackedGt) else res
+    if isinstance(template, (list, tuple)):
+        return [unflatten_batch(value, values, path + (i,)) for i, value in enumerate(template)]
+    return values[path]
+
+
+@dataclass
+class BufferView:
+    offset: int
+    dtype: torch.dtype
+    shape: Tuple[int, ...]
+
+    def nbytes(self):
+        return int(np.prod(self.shape, dtype=np.int64)) * torch.empty(0, dtype=self.dtype).element_size()
+
+    def view(self, buffer):
+        return buffer[self.offset:self.offset + self.nbytes()].view(self.dtype).view(self.shape)
+
+
+class FlowBatch(list):
+    """
+    A collated `[X, y]` batch, in which all small tensors (the targets and the packed gt) are views into a single
+    contiguous byte buffer, so that they are pinned and moved to the device with a single copy (see `FlowBatch.to`).
+    """
+
+    def __init__(self, items, buffer=None, buffer_views=None):
+        super().__init__(items)
+        self.buffer = buffer
+        self.buffer_views = buffer_views if buffer_views is not None else {}
+
+    def map_tensors(self, buffer, fn):
+        """
+        :param buffer: The buffer (for example moved to the device), from which the views of the small tensors are
+        taken.
+        :param fn: The function applied to the other tensors.
+        :return: The `[X, y]` batch with the new tensors.
+        """
+        values = {}
+        for path, value in flatten_batch(self):
+            if buffer is not None and path in self.buffer_views:
+                values[path] = self.buffer_views[path].view(buffer)
+            elif isinstance(value, torch.Tensor):
+                values[path] = fn(value)
+            else:
+                values[path] = value
+        return unflatten_batch(list(self), values)
+
+    def pin_memory(self):
+        """
+        Called by the pin memory thread of a `DataLoader` with `pin_memory=True`, in the main process - the buffer is
+        pinned with a single copy.
+        """
+        buffer = self.buffer.pin_memory() if self.buffer is not None else None
+        return FlowBatch(self.map_tensors(buffer, lambda value: value.pin_memory()), buffer, self.buffer_views)
+
+    def to(self, device, non_blocking=True):
+        buffer = self.buffer.to(device, non_blocking=non_blocking) if self.buffer is not None else None
+        return self.map_tensors(buffer, lambda value: value.to(device, non_blocking=non_blocking))
+
+
+class FlowCollator:
+    """
+    Collate function for the samples of a `FlowDataset`. The output buffers are preallocated for the whole batch and
+    filled in place. All tensors with at most `small_nbytes` bytes per sample (the targets and the packed gt) are
+    packed into one contiguous byte buffer, the other tensors (the inputs) get a buffer each. The result is a
+    `FlowBatch`. The collator runs in the DataLoader workers, so it never pins memory - use `pin_memory=True` of the
+    `DataLoader`, which pins the buffer in the main process.
+    """
+
+    def __init__(self, small_nbytes=1024, alignment=8):
+        self.small_nbytes = small_nbytes
+        self.alignment = alignment
+
+    def __call__(self, batch):
+        leaves = []
+        gather_leaves(batch, (), leaves)
+
+        values = {}
+        small_samples = {}
+        buffer_views = {}
+        offset = 0
+        for path, leaf_samples in leaves:
+            first = leaf_samples[0]
+            if isinstance(first, np.ndarray):
+                leaf_samples = [torch.as_tensor(sample) for sample in leaf_samples]
+                first = leaf_samples[0]
+            if not isinstance(first, torch.Tensor):
+                values[path] = default_collate(leaf_samples)
+                continue
+            nbytes = first.numel() * first.element_size()
+            if nbytes <= self.small_nbytes:
+                buffer_views[path] = BufferView(offset, first.dtype, (len(batch), *first.shape))
+                small_samples[path] = leaf_samples
+                offset += -(-nbytes * len(batch) // self.alignment) * self.alignment
+            else:
+                out = torch.empty((len(batch), *first.shape), dtype=first.dtype)
+                values[path] = torch.stack(leaf_samples, out=out)
+
+        buffer = torch.empty(offset, dtype=torch.uint8)
+        for path, buffer_view in buffer_views.items():
+            values[path] = torch.stack(small_samples[path], out=buffer_view.view(buffer))
+        return FlowBatch(unflatten_batch(batch[0], values), buffer, buffer_views)
+
+
+def write_flow_shards(dataset, directory, shard_size=4096):
+    """
+    Exports a `FlowDataset` (or the full flow of a `Project`) to sequential `.npz` shards, which can be streamed with
+    `IterableFlowDataset`. Every shard holds a range of samples: the inputs (`X/<key>`), the packed gt, availability
+    and precondition tables (`gt/<key>`) and the labels of every task (`y/<path>`). The packed layout and the list of
+    shards are saved in a json manifest.
+    :param dataset: The root `FlowDataset` or a `Project`.
+    :param directory: Where to save the shards.
+    :param shard_size: The number of samples in a shard.
+    :return: The paths of the shards.
+    """
+    if not isinstance(dataset, FlowDataset):
+        dataset = FlowDataset(dataset.get_full_flow())
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+
+    shards = []
+    for start in range(0, len(dataset), shard_size):
+        end = min(start + shard_size, len(dataset))
+        X, y = dataset[np.arange(start, end)]
+        arrays = {}
+        for key, value in X.items():
+            if key != 'gt':
+                arrays[f'X/{key}'] = np.asarray(value)
+        for key, value in dict.items(X['gt']):
+            arrays[f'gt/{key}'] = value.numpy()
+        for key, value in y.items():
+            arrays[f'y/{key}'] = to_contiguous_tensor(value).numpy()
+        file_name = f'shard-{len(shards):06d}.npz'
+        np.savez(directory / file_name, **arrays)
+        shards.append({'file': file_name, 'n': end - start})
+
+    manifest = {'layout': dataset._packed_layout.get_shapes(), 'shards': shards}
+    with open(directory / SHARDS_MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return [directory / shard['file'] for shard in shards]
+
+
+def get_stream_split():
+    """
+    :return: `(rank, world_size, worker_id, num_workers)` - the distributed process and the DataLoader worker, which
+    consume a stream.
+    """
+    rank, world_size = 0, 1
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+    worker_info = get_worker_info()
+    worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+    return rank, world_size, worker_id, num_workers
+
+
+class IterableFlowDataset(IterableDataset):
+    """
+    Streams the samples of a flow from the shards written by `write_flow_shards`, one shard at a time, instead of
+    indexing them randomly. The shards are split across the distributed processes and then across the DataLoader
+    workers of every process. Every process gets the same number of samples (the samples beyond the smallest split are
+    dropped), so that distributed training stays in step. The samples have the same `(X, y)` structure as the samples
+    of `FlowDataset`.
+    """
+
+    def __init__(self, directory, shuffle=False, buffer_size=1024, seed=0):
+        """
+        :param directory: The directory with the shards and their manifest.
+        :param shuffle: Whether to shuffle the order of the shards and the samples within a buffer of `buffer_size`.
+        :param buffer_size: The number of samples in the shuffle buffer.
+        :param seed: The seed of the shuffling, which is combined with the epoch set through `set_epoch`.
+        """
+        self.directory = Path(directory)
+        with open(self.directory / SHARDS_MANIFEST_FILE, 'r') as f:
+            manifest = json.load(f)
+        self.layout = PackedLayout.from_shapes(manifest['layout'])
+        self.shards = manifest['shards']
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def read_shard(self, shard):
+        groups = {'X': {}, 'gt': {}, 'y': {}}
+        with np.load(self.directory / shard['file']) as arrays:
+            for key in arrays.files:
+                group, name = key.split('/', 1)
+                groups[group][name] = torch.from_numpy(arrays[key])
+        for i in range(shard['n']):
+            X = {key: value[i] for key, value in groups['X'].items()}
+            X['gt'] = PackedGt({key: value[i] for key, value in groups['gt'].items()}, self.layout)
+            y = {key: value[i] for key, value in groups['y'].items()}
+            yield X, y
+
+    def get_epoch_shards(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            np.random.default_rng((self.seed, self.epoch)).shuffle(shards)
+        return shards
+
+    def get_rank_length(self, shards, world_size):
+        """
+        :return: The number of samples of every process - the number of samples in the smallest split of the shards.
+        """
+        if len(shards) < world_size:
+            raise ValueError(f'There are {len(shards)} shards for {world_size} processes, so some processes would get '
+                             f'no samples. Write the shards with a smaller shard_size.')
+        return min(sum(shard['n'] for shard in shards[rank::world_size]) for rank in range(world_size))
+
+    def get_worker_quota(self, rank_shards, worker_id, num_workers, rank_length):
+        """
+        :return: The number of samples the worker yields, so that the workers of a process yield `rank_length` samples
+        in total. The samples beyond it are dropped from the last workers.
+        """
+        quotas = [sum(shard['n'] for shard in rank_shards[i::num_workers]) for i in range(num_workers)]
+        excess = sum(quotas) - rank_length
+        for i in reversed(range(num_workers)):
+            dropped = min(excess, quotas[i])
+            quotas[i] -= dropped
+            excess -= dropped
+        return quotas[worker_id]
+
+    def __iter__(self):
+        rank, world_size, worker_id, num_workers = get_stream_split()
+        shards = self.get_epoch_shards()
+        if len(shards) < world_size * num_workers:
+            raise ValueError(f'There are {len(shards)} shards for {world_size * num_workers} consumers (processes '
+                             f'times DataLoader workers), so some consumers would get no samples. Write the shards '
+                             f'with a smaller shard_size or use fewer workers.')
+        rank_length = self.get_rank_length(shards, world_size)
+        rank_shards = shards[rank::world_size]
+        quota = self.get_worker_quota(rank_shards, worker_id, num_workers, rank_length)
+        samples = (sample for shard in rank_shards[worker_id::num_workers] for sample in self.read_shard(shard))
+        samples = islice(samples, quota)
+        if not self.shuffle:
+            yield from samples
+            return
+
+        rng = np.random.default_rng((self.seed, self.epoch, rank, worker_id))
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.buffer_size:
+                buffer.append(sample)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __len__(self):
+        """
+        :return: The number of samples of the current process, over all its DataLoader workers.
+        """
+        rank, world_size, _, _ = get_stream_split()
+        return self.get_rank_length(self.get_epoch_shards(), world_size)
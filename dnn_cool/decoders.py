@@ -5,6 +5,7 @@ from dataclasses import dataclass, field
 from typing import Dict
 
 from sklearn.metrics import accuracy_score
+from torch import nn
 from tqdm import tqdm
 
 from dnn_cool.tuners import TunerVisitor
@@ -22,6 +23,39 @@ class Decoder:
     def load_tuned(self, params):
         raise NotImplementedError()
 
+    def to_module(self) -> nn.Module:
+        """
+        :return: An `nn.Module` with the same behaviour as the decoder (with the currently tuned params), which can be
+        traced and exported.
+        """
+        raise NotImplementedError()
+
+
+class ThresholdDecoderModule(nn.Module):
+
+    def __init__(self, threshold):
+        super().__init__()
+        self.register_buffer('threshold', torch.as_tensor(threshold, dtype=torch.float32))
+
+    def forward(self, x):
+        return x > self.threshold
+
+
+class SortDecoderModule(nn.Module):
+
+    def forward(self, x):
+        return torch.sort(x, dim=-1, descending=True)[1]
+
+
+class ScaleDecoderModule(nn.Module):
+
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+
+    def forward(self, x):
+        return x * self.scale
+
 
 class BinaryDecoder(Decoder):
 
@@ -49,6 +83,9 @@ class BinaryDecoder(Decoder):
     def load_tuned(self, params):
         self.threshold = params['threshold']
 
+    def to_module(self) -> nn.Module:
+        return ThresholdDecoderModule(self.threshold)
+
 
 class ClassificationDecoder(Decoder):
 
@@ -61,6 +98,9 @@ class ClassificationDecoder(Decoder):
     def load_tuned(self, params):
         pass
 
+    def to_module(self) -> nn.Module:
+        return SortDecoderModule()
+
 
 class DecodingVisitor(LeafVisitor):
 
@@ -125,6 +165,9 @@ class BoundedRegressionDecoder(Decoder):
     def load_tuned(self, params):
         pass
 
+    def to_module(self) -> nn.Module:
+        return ScaleDecoderModule(self.scale)
+
 
 def threshold_binary(x, threshold=0.5):
     return x > threshold
@@ -165,3 +208,8 @@ class MultilabelClassificationDecoder(Decoder):
 
     def load_tuned(self, params):
         self.thresholds = torch.tensor(params['thresholds']).unsqueeze(0)
+
+    def to_module(self) -> nn.Module:
+        # Before the first call or tuning, the number of classes is not known, and the default threshold is 0.5
+        thresholds = 0.5 if self.thresholds is None else self.thresholds
+        return ThresholdDecoderModule(thresholds)
@@ -4,6 +4,7 @@ from typing import List
 import pandas as pd
 import torch
 
+from dnn_cool.metrics import TaskMetrics
 from dnn_cool.visitors import LeafVisitor, VisitorOut, RootCompositeVisitor
 
 
@@ -12,6 +13,7 @@ class EvaluationVisitor(LeafVisitor):
     def __init__(self, task, prefix):
         super().__init__(task, prefix)
         self.metrics = task.get_metrics()
+        self.task_metrics = TaskMetrics(self.metrics)
 
     def full_result(self, preds, targets):
         return self.compute_metrics(preds, targets)
@@ -24,9 +26,11 @@ class EvaluationVisitor(LeafVisitor):
 
     def compute_metrics(self, preds, targets):
         res = []
+        # No activation, since preds is already activated. The metrics, which share a statistic (for example the
+        # confusion matrix), are derived from a single pass.
+        all_metric_res = self.task_metrics.evaluate(preds, targets, activate=False)
         for metric_name, metric in self.metrics:
-            # No activation, since preds is already activated
-            metric_res = metric(preds, targets, activate=False)
+            metric_res = all_metric_res[metric_name]
             if metric.is_multi_metric():
                 args = metric.list_args()
                 for i in range(len(metric_res)):
@@ -0,0 +1,136 @@
+from typing import Dict, Optional
+
+import torch
+from torch import nn
+
+from dnn_cool.modules import TaskFlowModule, MaskEvaluator, find_fusable_groups, fuse_linear_modules
+
+
+def to_module_key(path):
+    # nn.ModuleDict does not allow dots in the keys.
+    return path.replace('.', '__')
+
+
+class ExportedLeaf(nn.Module):
+
+    def __init__(self, module_decorator):
+        super().__init__()
+        self.module = module_decorator.module
+        activation = module_decorator.activation
+        self.activation = activation if activation is not None else nn.Identity()
+        decoder = module_decorator.decoder
+        self.decoder = decoder.to_module() if decoder is not None else nn.Identity()
+
+    def forward(self, *args, **kwargs):
+        return self.decorate_logits(self.module(*args, **kwargs))
+
+    def decorate_logits(self, logits):
+        activated = self.activation(logits)
+        decoded = self.decoder(activated)
+        return logits, activated, decoded
+
+
+class ExportedTaskFlowModule(nn.Module):
+    """
+    Plain `nn.Module` which computes the same logits, activations, decoded outputs and precondition masks as a
+    `TaskFlowModule` in inference mode, without executing the flow function. The result is a flat dict with keys
+    `logits|<path>`, `activated|<path>`, `decoded|<path>` and `precondition|<path>`. Sibling linear heads, which
+    receive the same input, are fused into a single linear layer.
+    """
+
+    def __init__(self, flow_module: TaskFlowModule, backbone: Optional[nn.Module] = None):
+        super().__init__()
+        compiled_flow = flow_module.get_compiled_flow()
+        decorators = compiled_flow.resolve_leaves(flow_module)
+        self.backbone = backbone
+        self.leaf_calls = compiled_flow.leaves
+        self.heads = nn.ModuleDict()
+        for leaf_call, decorator in zip(compiled_flow.leaves, decorators):
+            self.heads[to_module_key(leaf_call.path)] = ExportedLeaf(decorator)
+
+        self.fused_groups = find_fusable_groups(compiled_flow, decorators) if flow_module.fuse_heads else []
+        self.fused_heads = nn.ModuleList()
+        for group in self.fused_groups:
+            self.fused_heads.append(fuse_linear_modules([decorators[i].module for i in group]))
+
+    def forward(self, x: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        if self.backbone is not None:
+            x = self.backbone(x)
+        fused_logits = {}
+        for group, fused_head in zip(self.fused_groups, self.fused_heads):
+            logits = fused_head(self.leaf_calls[group[0]].args[0].resolve(x))
+            out_features = [self.heads[to_module_key(self.leaf_calls[i].path)].module.out_features for i in group]
+            fused_logits.update(zip(group, logits.split(out_features, dim=-1)))
+
+        res = {}
+        decoded = {}
+        for i, leaf_call in enumerate(self.leaf_calls):
+            head = self.heads[to_module_key(leaf_call.path)]
+            if i in fused_logits:
+                logits, activated, decoded[leaf_call.path] = head.decorate_logits(fused_logits[i])
+            else:
+                args, kwargs = leaf_call.resolve_inputs(x)
+                logits, activated, decoded[leaf_call.path] = head(*args, **kwargs)
+            res[f'logits|{leaf_call.path}'] = logits
+            res[f'activated|{leaf_call.path}'] = activated
+            res[f'decoded|{leaf_call.path}'] = decoded[leaf_call.path]
+        mask_evaluator = MaskEvaluator(decoded)
+        for leaf_call in self.leaf_calls:
+            res[f'precondition|{leaf_call.path}'] = mask_evaluator.to_mask(leaf_call.precondition)
+        return res
+
+
+def export_torchscript(flow_module: TaskFlowModule,
+                       example_inputs: Dict[str, torch.Tensor],
+                       backbone: Optional[nn.Module] = None) -> torch.jit.ScriptModule:
+    """
+    Exports a `TaskFlowModule` (optionally together with the backbone which computes its inputs) to a frozen
+    TorchScript module, optimized for inference. The exported module can be saved with `torch.jit.save` and loaded
+    without the flow function and without `dnn_cool`.
+    :param flow_module: The module to export. The decoders should already be tuned.
+    :param example_inputs: dict of tensors - example input for the backbone if given, or for the flow module otherwise.
+    :param backbone: Optional module, which receives the inputs and returns the dict of features for the flow module.
+    :return: The frozen TorchScript module.
+    """
+    exported = ExportedTaskFlowModule(flow_module, backbone)
+    was_training = flow_module.training
+    exported = exported.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(exported, (example_inputs,), strict=False)
+    exported.train(was_training)
+    frozen = torch.jit.freeze(traced)
+    return torch.jit.optimize_for_inference(frozen)
+
+
+def export_onnx(flow_module: TaskFlowModule,
+                example_inputs: Dict[str, torch.Tensor],
+                path,
+                backbone: Optional[nn.Module] = None,
+                opset_version: int = 13):
+    """
+    Exports a `TaskFlowModule` (optionally together with its backbone) to an ONNX graph. The activations, the tuned
+    decoders and the precondition masks are all part of the graph. The inputs are named by the keys of
+    `example_inputs` and the outputs are named `logits|<path>`, `activated|<path>`, `decoded|<path>` and
+    `precondition|<path>`. The first dimension of all inputs and outputs is dynamic.
+    :param flow_module: The module to export. The decoders should already be tuned.
+    :param example_inputs: dict of tensors - example input for the backbone if given, or for the flow module otherwise.
+    :param path: Where to save the ONNX file.
+    :param backbone: Optional module, which receives the inputs and returns the dict of features for the flow module.
+    :param opset_version: The ONNX opset to use.
+    :return: The names of the outputs, in the order in which they are in the graph.
+    """
+    exported = ExportedTaskFlowModule(flow_module, backbone)
+    was_training = flow_module.training
+    exported = exported.eval()
+    with torch.no_grad():
+        output_names = list(exported(example_inputs).keys())
+    input_names = list(example_inputs.keys())
+    dynamic_axes = {name: {0: 'batch'} for name in input_names + output_names}
+    # The trailing empty dict tells the exporter that the dict with inputs is not a dict of keyword arguments.
+    torch.onnx.export(exported, (example_inputs, {}), str(path),
+                      input_names=input_names,
+                      output_names=output_names,
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset_version)
+    exported.train(was_training)
+    return output_names
@@ -0,0 +1,108 @@
+import hashlib
+import pickle
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import torch
+from torch import nn
+
+from dnn_cool.converters import Values
+from dnn_cool.datasets import batched_loader
+from dnn_cool.storage import ColumnStore
+
+
+def model_hash(module: nn.Module) -> str:
+    """
+    :return: Hex digest, which identifies the architecture and the weights of the module.
+    """
+    digest = hashlib.sha256(type(module).__qualname__.encode())
+    for key, value in module.state_dict().items():
+        value = value.detach().cpu().contiguous()
+        digest.update(f'{key}:{value.dtype}:{tuple(value.shape)}'.encode())
+        digest.update(value.numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def update_column_digest(digest, column):
+    paths = getattr(column, 'paths', None)
+    if paths is not None:
+        # Lazily read columns (like `LazyImages`) are identified by their paths and their other settings.
+        digest.update(pickle.dumps((type(column).__qualname__, list(paths), getattr(column, 'size', None))))
+        return
+    column = column.detach().cpu().numpy() if isinstance(column, torch.Tensor) else np.asarray(column)
+    if column.dtype == object:
+        digest.update(pickle.dumps(column.tolist()))
+        return
+    column = np.ascontiguousarray(column)
+    digest.update(f'{column.dtype.str}{column.shape}'.encode())
+    digest.update(column.view(np.uint8).reshape(-1).data)
+
+
+def dataset_hash(dataset) -> str:
+    """
+    :return: Hex digest, which identifies the inputs of a `FlowDataset` (the contents of their columns).
+    """
+    inputs = dataset.get_inputs()
+    digest = hashlib.sha256()
+    if isinstance(inputs, Values):
+        for key, column in zip(inputs.keys, inputs.values):
+            digest.update(f'{key}:'.encode())
+            update_column_digest(digest, column)
+    else:
+        update_column_digest(digest, inputs)
+    return digest.hexdigest()[:16]
+
+
+def cache_features(backbone: nn.Module,
+                   dataset,
+                   cache_dir: Union[str, Path],
+                   batch_size: int = 256,
+                   device=None,
+                   dataset_key: str = None) -> Values:
+    """
+    Runs the frozen backbone once over all samples of the dataset and saves the features it returns as memory-mapped
+    columns in `cache_dir/<model hash>-<dataset key>`, so that the heads of the flow can be trained without recomputing
+    the backbone (see `DnnCoolSupervisedRunner.train_heads`). When the features of the same backbone weights and the
+    same dataset are already cached, they are only read.
+    :param backbone: Module, which receives the inputs of a sample and returns a dict with the features - the same keys
+    as in `FeaturesDict`, which the flow receives (for example `x.features`).
+    :param dataset: The root `FlowDataset`, indexed with arrays of indices.
+    :param cache_dir: The directory of the cache.
+    :param batch_size: The batch size for the backbone.
+    :param device: The device on which the backbone is run, by default the device of its parameters.
+    :param dataset_key: Optional key, which identifies the dataset. By default it is a hash of the inputs of the
+    dataset (see `dataset_hash`), which reads all of them.
+    :return: The cached features, which can be given as `inputs` to a `FlowDataset`.
+    """
+    dataset_key = dataset_hash(dataset) if dataset_key is None else dataset_key
+    store = ColumnStore(Path(cache_dir) / f'{model_hash(backbone)}-{dataset_key}')
+    n = len(dataset)
+    if len(store.manifest) > 0 and all(store.has_column(key, n) for key in store.manifest):
+        return store.read_values(store.manifest.keys())
+
+    if device is None:
+        device = next(backbone.parameters()).device
+    was_training = backbone.training
+    backbone.eval()
+    columns = {}
+    start = 0
+    with torch.no_grad():
+        for X, y in batched_loader(dataset, batch_size, shuffle=False):
+            X = {key: torch.as_tensor(value).to(device) for key, value in X.items() if key != 'gt'}
+            batch_len = len(next(iter(X.values())))
+            features = backbone(X)
+            features = features.data if not isinstance(features, dict) else features
+            for key, value in features.items():
+                if not isinstance(value, torch.Tensor):
+                    continue
+                value = value.detach().cpu()
+                if key not in columns:
+                    columns[key] = store.create_column(key, (n, *value.shape[1:]), value.numpy().dtype)
+                columns[key][start:start + len(value)] = value.numpy()
+            start += batch_len
+    backbone.train(was_training)
+
+    for key, column in columns.items():
+        store.commit_column(key, column)
+    return store.read_values(columns.keys())
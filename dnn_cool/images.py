@@ -0,0 +1,200 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Tuple, Union
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache of tensors, bounded by the total number of bytes of the cached tensors.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value: torch.Tensor):
+        nbytes = value.numel() * value.element_size()
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                return
+            self._items[key] = value
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.nbytes -= evicted.numel() * evicted.element_size()
+
+    def __getstate__(self):
+        # The cached tensors and the lock are not pickled - the copy starts with an empty cache.
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def __len__(self):
+        return len(self._items)
+
+
+def read_image(path, size=None):
+    """
+    :param path: The path to the image.
+    :param size: Optional `(width, height)` to which the image is resized.
+    :return: uint8 tensor with shape `(3, height, width)`, in RGB order.
+    """
+    img = cv2.imread(str(path), cv2.IMREAD_COLOR)
+    if img is None:
+        raise FileNotFoundError(f'Could not read image "{path}".')
+    if size is not None:
+        img = cv2.resize(img, tuple(size), interpolation=cv2.INTER_AREA)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return torch.from_numpy(img).permute(2, 0, 1)
+
+
+class LazyImages:
+    """
+    Column of image paths, which can be used as values of an input (see `ImageValuesConverter`). The images are decoded
+    with cv2 only when indexed - indexing with an array of indices decodes the whole batch in a thread pool (cv2
+    releases the GIL while decoding). The decoded (and resized) images are kept in a LRU cache bounded by bytes, and
+    `prefetch` starts decoding the images, which will be needed soon, in the background.
+    """
+
+    def __init__(self, paths, size: Tuple[int, int] = None, num_threads: int = 8, cache_bytes: int = 2 ** 30):
+        """
+        :param paths: The paths to the images.
+        :param size: Optional `(width, height)` to which all images are resized. It has to be given when batches are
+        fetched and the images have different sizes.
+        :param num_threads: The number of decoding threads.
+        :param cache_bytes: The maximum size of the cache of decoded images, in bytes.
+        """
+        self.paths = np.asarray([str(path) for path in paths])
+        self.size = size
+        self.num_threads = num_threads
+        self.cache = LRUCache(cache_bytes)
+        self._executor = None
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The thread pool, the pending futures and the locks cannot be pickled (for example for DataLoader workers).
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_pending'] = {}
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        return self._executor
+
+    def decode(self, index) -> torch.Tensor:
+        img = self.cache.get(index)
+        if img is None:
+            img = read_image(self.paths[index], self.size)
+            self.cache.put(index, img)
+        return img
+
+    def submit(self, index):
+        with self._lock:
+            future = self._pending.get(index)
+            if future is None:
+                future = self.get_executor().submit(self.decode, index)
+                self._pending[index] = future
+                future.add_done_callback(lambda f: self._pending.pop(index, None))
+            return future
+
+    def prefetch(self, indices):
+        """
+        Starts decoding the images at the given indices in the background, unless they are already cached.
+        """
+        for index in np.asarray(indices).reshape(-1).tolist():
+            if self.cache.get(index) is None:
+                self.submit(index)
+
+    def to_float(self, img):
+        return img.float() / 255.
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            item = np.arange(len(self))[item]
+        if isinstance(item, (list, tuple, np.ndarray, torch.Tensor)):
+            futures = [self.submit(index) for index in np.asarray(item).reshape(-1).tolist()]
+            return self.to_float(torch.stack([future.result() for future in futures]))
+        item = int(item)
+        future = self._pending.get(item)
+        return self.to_float(future.result() if future is not None else self.decode(item))
+
+    @property
+    def nbytes(self):
+        return self.paths.nbytes + self.cache.nbytes
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class ImageValuesConverter:
+    """
+    Values converter for columns with image file names, which gives `LazyImages` instead of loading all images. Can be
+    registered in `ValuesConverter.type_mapping` (for example for type `img`).
+    """
+
+    def __init__(self, images_dir: Union[str, Path] = '', size: Tuple[int, int] = None, num_threads: int = 8,
+                 cache_bytes: int = 2 ** 30):
+        self.images_dir = Path(images_dir)
+        self.size = size
+        self.num_threads = num_threads
+        self.cache_bytes = cache_bytes
+
+    def __call__(self, values):
+        paths = [self.images_dir / name for name in values]
+        return LazyImages(paths, self.size, self.num_threads, self.cache_bytes)
+
+
+class PrefetchingSampler(Sampler):
+    """
+    Wraps a sampler (or a batch sampler) and prefetches the images at the next `lookahead` indices, in the order in
+    which the sampler gives them. Prefetching is done in the process which iterates the sampler, so it helps when the
+    dataset is read in the same process (`num_workers=0`).
+    """
+
+    def __init__(self, sampler, images: LazyImages, lookahead: int = 256):
+        super().__init__()
+        self.sampler = sampler
+        self.images = images
+        self.lookahead = lookahead
+
+    def __iter__(self):
+        upcoming = []
+        n_upcoming = 0
+        for indices in self.sampler:
+            upcoming.append(indices)
+            n_upcoming += np.size(indices)
+            self.images.prefetch(indices)
+            if n_upcoming >= self.lookahead:
+                n_upcoming -= np.size(upcoming[0])
+                yield upcoming.pop(0)
+        yield from upcoming
+
+    def __len__(self):
+        return len(self.sampler)
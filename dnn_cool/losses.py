@@ -1,8 +1,12 @@
+import copy
+from dataclasses import dataclass
+from typing import Optional, List
+
 import numpy as np
 import torch
-from catalyst.core import MultiMetricCallback
 from torch import nn
 
+from dnn_cool.packed import get_nonempty_tasks, to_sample_mask, PACKED_PRECONDITIONS_KEY
 from dnn_cool.utils import any_value
 
 
@@ -77,6 +81,56 @@ def squeeze_if_needed(tensor):
     return tensor
 
 
+def get_elementwise_loss(loss):
+    """
+    :return: A tuple of a copy of the loss, which computes it for every element (`reduction='none'`), and the original
+    reduction (`'mean'` or `'sum'`). When the loss cannot be computed this way with the same result, `(None, None)`.
+    """
+    if not isinstance(loss, nn.Module):
+        return None, None
+    reductions = []
+    for module in loss.modules():
+        if isinstance(module, (nn.CrossEntropyLoss, nn.NLLLoss)) and module.weight is not None:
+            # The weighted mean is normalized by the sum of the weights, not by the number of elements.
+            return None, None
+        if isinstance(getattr(module, 'reduction', None), str):
+            reductions.append(module.reduction)
+    if len(reductions) != 1 or reductions[0] not in ('mean', 'sum'):
+        return None, None
+    elementwise_loss = copy.deepcopy(loss)
+    for module in elementwise_loss.modules():
+        if isinstance(getattr(module, 'reduction', None), str):
+            module.reduction = 'none'
+    return elementwise_loss, reductions[0]
+
+
+def get_ignore_index(loss):
+    """
+    :return: The `ignore_index` of the loss (for example of `nn.CrossEntropyLoss`), or `None` if it has none.
+    """
+    if not isinstance(loss, nn.Module):
+        return None
+    for module in loss.modules():
+        ignore_index = getattr(module, 'ignore_index', None)
+        if ignore_index is not None:
+            return ignore_index
+    return None
+
+
+def has_class_buffers(loss):
+    """
+    :return: Whether the loss has per-class buffers (`weight`, `pos_weight`), which are broadcast along the last axis
+    of the outputs.
+    """
+    if not isinstance(loss, nn.Module):
+        return False
+    return any(name.rsplit('.', 1)[-1] in ('weight', 'pos_weight') for name, _ in loss.named_buffers())
+
+
+def expand_mask(mask, tensor):
+    return mask.reshape(-1, *([1] * (len(tensor.shape) - 1)))
+
+
 class BaseMetricDecorator(nn.Module):
 
     def __init__(self, task_name, available_func, prefix, metric):
@@ -94,10 +148,21 @@ class BaseMetricDecorator(nn.Module):
         key = self.prefix + self.task_name
         outputs = loss_flow_data.outputs[key]
         precondition = loss_flow_data.outputs[f'precondition|{key}']
-        targets = loss_flow_data.targets[key]
         loss_items = torch.zeros(1, dtype=outputs.dtype, device=outputs.device)
         if precondition.sum() == 0:
             return loss_items
+        return self.compute_nonempty(loss_flow_data, metric)
+
+    def compute_nonempty(self, loss_flow_data, metric):
+        """
+        Same as `compute_with_precondition`, but without checking whether any sample satisfies the precondition, for
+        when the caller already knows it does.
+        """
+        key = self.prefix + self.task_name
+        outputs = loss_flow_data.outputs[key]
+        precondition = loss_flow_data.outputs[f'precondition|{key}']
+        targets = loss_flow_data.targets[key]
+        loss_items = torch.zeros(1, dtype=outputs.dtype, device=outputs.device)
         precondition = squeeze_if_needed(precondition)
         metric_res = metric(outputs[precondition], targets[precondition])
         return self.postprocess_results(loss_items, metric_res, precondition)
@@ -105,21 +170,291 @@ class BaseMetricDecorator(nn.Module):
     def postprocess_results(self, loss_items, metric_res, precondition):
         return metric_res
 
+    def update(self, *args, **kwargs):
+        """
+        Accumulates the metric over the samples of the batch which satisfy the precondition (see `TorchMetric.update`).
+        """
+        loss_flow_data = get_flow_data(*args, **kwargs)
+        key = self.prefix + self.task_name
+        precondition = squeeze_if_needed(loss_flow_data.outputs[f'precondition|{key}']).bool()
+        self.metric.update(loss_flow_data.outputs[key], loss_flow_data.targets[key], precondition)
+
+
+def is_same_loss(one, other):
+    """
+    :return: Whether the two losses are the same, except for their reductions.
+    """
+    if not isinstance(one, nn.Module) or not isinstance(other, nn.Module):
+        return one is other
+    modules, other_modules = list(one.modules()), list(other.modules())
+    if len(modules) != len(other_modules):
+        return False
+    for module, other_module in zip(modules, other_modules):
+        if type(module) is not type(other_module):
+            return False
+        for key, value in vars(module).items():
+            if key.startswith('_') or key == 'training' or (key == 'reduction' and isinstance(value, str)):
+                continue
+            if getattr(other_module, key, None) != value:
+                return False
+        buffers, other_buffers = dict(module.named_buffers()), dict(other_module.named_buffers())
+        if buffers.keys() != other_buffers.keys():
+            return False
+        if not all(torch.equal(buffers[key], other_buffers[key].to(buffers[key].device)) for key in buffers):
+            return False
+    return True
+
+
+def get_per_sample_reduction(loss, per_sample_loss):
+    """
+    :return: The reduction of `per_sample_loss`, when it is `ReducedPerSample` of the same loss as `loss` (with
+    reduction `'none'`), so that the per-sample losses can be computed from the elements of `loss`. Otherwise `None`.
+    """
+    if not isinstance(per_sample_loss, ReducedPerSample) or not is_same_loss(loss, per_sample_loss.loss):
+        return None
+    for module in per_sample_loss.loss.modules():
+        if isinstance(getattr(module, 'reduction', None), str) and module.reduction != 'none':
+            return None
+    return per_sample_loss.reduction
+
+
+@dataclass
+class LeafLoss:
+    """
+    The loss of a leaf task in a batch, together with what is needed to get its per-sample losses without computing
+    the loss again.
+    """
+    loss: torch.Tensor
+    precondition: torch.Tensor
+    nonempty: bool = True
+    # The loss of every element - of the samples which satisfy the precondition, unless `element_mask` is given, which
+    # selects them from the rows of `elements`.
+    elements: Optional[torch.Tensor] = None
+    element_mask: Optional[torch.Tensor] = None
+
 
 class TaskLossDecorator(BaseMetricDecorator):
 
-    def __init__(self, task_name, available_func, prefix, loss):
+    def __init__(self, task_name, available_func, prefix, loss, per_sample_loss=None):
         super().__init__(task_name, available_func, prefix, loss)
+        self.elementwise_loss, self.reduction = get_elementwise_loss(loss)
+        self.ignore_index = get_ignore_index(loss)
+        # Stacking the outputs of several leaves adds a last axis, along which per-class buffers would be broadcast,
+        # and the mean of a batch cannot leave out the ignored targets of every leaf.
+        self.batchable = self.elementwise_loss is not None and self.ignore_index is None and not has_class_buffers(loss)
+        self.per_sample_loss = per_sample_loss
+        self.per_sample_reduction = None
+        if self.elementwise_loss is not None:
+            self.per_sample_reduction = get_per_sample_reduction(loss, per_sample_loss)
+
+    def compute_masked(self, loss_flow_data):
+        """
+        Computes the loss on the whole batch and keeps only the elements of the samples which satisfy the precondition,
+        instead of selecting them first. All shapes are static and nothing is copied to the host, so the result can be
+        computed inside a captured graph or a `torch.compile`-d function. Equals `compute_with_precondition` (up to
+        floating point rounding), including the zero loss when the precondition is empty.
+        """
+        return LossItems(self.compute_leaf(loss_flow_data, masked=True).loss)
+
+    def compute_leaf(self, loss_flow_data, nonempty=None, masked=False) -> LeafLoss:
+        """
+        Computes the loss of the leaf once, keeping the loss of every element, so that the per-sample losses can be
+        taken from it (see `get_per_sample`).
+        :param loss_flow_data: The outputs and the targets.
+        :param nonempty: Whether any sample satisfies the precondition, if known.
+        :param masked: Whether to compute the loss of all samples and mask it (see `compute_masked`).
+        """
+        key = self.prefix + self.task_name
+        outputs = loss_flow_data.outputs[key]
+        targets = loss_flow_data.targets[key]
+        precondition = squeeze_if_needed(loss_flow_data.outputs[f'precondition|{key}']).bool()
+        zero = torch.zeros(1, dtype=outputs.dtype, device=outputs.device)
+        if self.elementwise_loss is None:
+            if nonempty is None:
+                res = self.compute_with_precondition(loss_flow_data, self.metric)
+            else:
+                res = self.compute_nonempty(loss_flow_data, self.metric) if nonempty else zero
+            return LeafLoss(res.loss_items if isinstance(res, LossItems) else res, precondition, nonempty is not False)
+
+        if masked:
+            # The targets of the other samples may be invalid for the loss (for example -1 class indices).
+            targets = torch.where(expand_mask(precondition, targets), targets, torch.zeros_like(targets))
+            elements = self.elementwise_loss(outputs, targets)
+            elements = torch.where(expand_mask(precondition, elements), elements, torch.zeros_like(elements))
+            loss = elements.sum()
+            if self.reduction == 'mean':
+                loss = loss / self.count_elements(elements, targets, precondition).clamp(min=1)
+            return LeafLoss(loss, precondition, nonempty is not False, elements, precondition)
+
+        if nonempty is None:
+            nonempty = bool(precondition.any())
+        if not nonempty:
+            return LeafLoss(zero, precondition, nonempty=False)
+        targets = targets[precondition]
+        elements = self.elementwise_loss(outputs[precondition], targets)
+        if self.reduction == 'sum':
+            loss = elements.sum()
+        elif self.ignore_index is None:
+            loss = elements.mean()
+        else:
+            loss = elements.sum() / self.count_elements(elements, targets)
+        return LeafLoss(loss, precondition, elements=elements)
+
+    def count_elements(self, elements, targets, mask=None):
+        """
+        :return: The number of elements, which the mean of the loss divides by: the elements of the samples in `mask`
+        (all samples if not given), except for those, whose target is `ignore_index`.
+        """
+        if self.ignore_index is None:
+            n_samples = len(elements) if mask is None else mask.sum()
+            return n_samples * int(np.prod(elements.shape[1:]))
+        valid = targets != self.ignore_index
+        if mask is not None:
+            valid = valid & expand_mask(mask, valid)
+        return valid.sum()
+
+    def get_sample_mask(self, loss_flow_data) -> torch.Tensor:
+        """
+        :return: 1D bool mask of the samples which satisfy the precondition for at least one of its values.
+        """
+        return to_sample_mask(loss_flow_data.outputs[f'precondition|{self.prefix + self.task_name}']).bool()
+
+    def get_per_sample(self, leaf_loss: LeafLoss, loss_flow_data) -> torch.Tensor:
+        """
+        :return: The per-sample losses of the samples in `get_sample_mask`, with shape `(n,)`. When the per-sample
+        loss of the task is a reduction of the elements of its loss, they are not computed again.
+        """
+        key = self.prefix + self.task_name
+        outputs = loss_flow_data.outputs[key]
+        precondition = loss_flow_data.outputs[f'precondition|{key}']
+        if len(precondition.shape) > 1 and precondition.shape[1] > 1:
+            # The leaf loss is computed on the samples of the first column only.
+            sample_mask = self.get_sample_mask(loss_flow_data)
+            res = self.per_sample_loss(outputs[sample_mask], loss_flow_data.targets[key][sample_mask])
+            return res.squeeze(dim=-1) if len(res.shape) > 1 else res
+        if not leaf_loss.nonempty:
+            return torch.zeros(0, dtype=outputs.dtype, device=outputs.device)
+        if self.per_sample_reduction is not None and leaf_loss.elements is not None:
+            elements = leaf_loss.elements
+            if leaf_loss.element_mask is not None:
+                elements = elements[leaf_loss.element_mask]
+            if len(elements.shape) > 1:
+                elements = self.per_sample_reduction(elements, dim=tuple(range(1, len(elements.shape))))
+            return elements
+        precondition = leaf_loss.precondition
+        res = self.per_sample_loss(outputs[precondition], loss_flow_data.targets[key][precondition])
+        return res.squeeze(dim=-1) if len(res.shape) > 1 else res
 
     def postprocess_results(self, loss_items, metric_res, precondition):
         return LossItems(metric_res)
 
 
+def split_into_batches(leaf_losses, loss_flow_data):
+    """
+    Splits the leaf losses into batches, which can be computed with a single call: the same loss (and reduction) on
+    outputs and targets with the same shapes and types.
+    :return: list of lists of leaf losses.
+    """
+    batches = []
+    for leaf_loss in leaf_losses:
+        key = leaf_loss.prefix + leaf_loss.task_name
+        outputs, targets = loss_flow_data.outputs[key], loss_flow_data.targets[key]
+        signature = (leaf_loss.reduction, outputs.shape[1:], outputs.dtype, targets.shape[1:], targets.dtype)
+        for batch_signature, batch in batches:
+            if batch_signature == signature and is_same_loss(batch[0].metric, leaf_loss.metric):
+                batch.append(leaf_loss)
+                break
+        else:
+            batches.append((signature, [leaf_loss]))
+    return [batch for signature, batch in batches]
+
+
+def compute_leaf_batch(leaf_losses, loss_flow_data, rows) -> List[LeafLoss]:
+    """
+    Computes the losses of leaves, which have the same loss, with a single call: the outputs and the targets of all
+    leaves are stacked and the given rows are gathered at once. Only leaves, which are `batchable`, can be computed
+    this way. Within the rows, the loss of every leaf is masked by
+    its own precondition, so the results are the same as `TaskLossDecorator.compute_leaf`.
+    :param leaf_losses: `TaskLossDecorator`s from the same batch of `split_into_batches`.
+    :param loss_flow_data: The outputs and the targets.
+    :param rows: The indices of the samples, which satisfy the precondition of at least one of the leaves.
+    :return: list of `LeafLoss`, one for every leaf.
+    """
+    keys = [leaf_loss.prefix + leaf_loss.task_name for leaf_loss in leaf_losses]
+    preconditions = [squeeze_if_needed(loss_flow_data.outputs[f'precondition|{key}']).bool() for key in keys]
+    outputs = torch.stack([loss_flow_data.outputs[key] for key in keys], dim=-1).index_select(0, rows)
+    targets = torch.stack([loss_flow_data.targets[key] for key in keys], dim=-1).index_select(0, rows)
+    masks = torch.stack(preconditions, dim=-1).index_select(0, rows)
+
+    def expand(tensor):
+        return masks.reshape(len(masks), *([1] * (len(tensor.shape) - 2)), len(keys))
+
+    # The targets of the samples, which do not satisfy the precondition, may be invalid for the loss.
+    targets = torch.where(expand(targets), targets, torch.zeros_like(targets))
+    elements = leaf_losses[0].elementwise_loss(outputs, targets)
+    sums = torch.where(expand(elements), elements, torch.zeros_like(elements)).reshape(-1, len(keys)).sum(dim=0)
+    if leaf_losses[0].reduction == 'mean':
+        n_elements = masks.sum(dim=0) * int(np.prod(elements.shape[1:-1]))
+        sums = sums / n_elements.clamp(min=1)
+    return [LeafLoss(sums[i], preconditions[i], True, elements[..., i], masks[:, i]) for i in range(len(keys))]
+
+
+class FlowLossResults:
+    """
+    The results of `TaskFlowLoss` for a batch, computed in a single pass over the leaves: the reduced loss, the scalar
+    losses of the leaves (for logging) and, on demand, the per-sample losses (for interpretation).
+    """
+
+    def __init__(self, loss_flow_data, leaf_decorators, leaf_losses, loss):
+        self.loss_flow_data = loss_flow_data
+        self.leaf_decorators = leaf_decorators
+        self.leaf_losses = leaf_losses
+        self.loss = loss
+        self._per_sample = None
+
+    def get_leaf_losses(self):
+        """
+        :return: dict from the path of every leaf to its loss.
+        """
+        return {path: leaf_loss.loss for path, leaf_loss in self.leaf_losses.items()}
+
+    def get_per_sample(self):
+        """
+        :return: dict in the format of `TaskFlowLossPerSample` - the per-sample losses of every leaf, the indices of
+        their samples in the batch (`indices|<path>`) and the overall per-sample loss.
+        """
+        if self._per_sample is not None:
+            return self._per_sample
+        res = {}
+        value = any_value(self.loss_flow_data.outputs)
+        bs = len(value)
+        overall_loss_items = torch.zeros(bs, device=value.device, dtype=value.dtype)
+        indices = torch.arange(bs, device=value.device)
+        for path, leaf_loss in self.leaf_losses.items():
+            decorator = self.leaf_decorators[path]
+            sample_mask = decorator.get_sample_mask(self.loss_flow_data)
+            res[path] = decorator.get_per_sample(leaf_loss, self.loss_flow_data)
+            res[f'indices|{path}'] = indices[sample_mask]
+            overall_loss_items[sample_mask] += res[path]
+        res['overall'] = overall_loss_items
+        res['indices|overall'] = indices
+        self._per_sample = res
+        return res
+
+
 class TaskFlowLoss(nn.Module):
 
-    def __init__(self, task_flow, prefix=''):
+    def __init__(self, task_flow, prefix='', masked=False):
+        """
+        :param task_flow: The task flow.
+        :param prefix: The prefix of the paths of the tasks in the flow.
+        :param masked: If True, every leaf loss is computed on the whole batch and masked by its precondition (see
+        `TaskLossDecorator.compute_masked`), so the loss does not synchronize with the host and can be captured or
+        compiled. Leaf losses which cannot be computed this way are computed as usual.
+        """
         super().__init__()
         self._task_flow = task_flow
+        self.masked = masked
         # Save a reference to the flow function of the original class
         # We will then call it by replacing the self, this way effectively running
         # it with this class. And this class stores Pytorch modules as class attributes
@@ -127,12 +462,17 @@ class TaskFlowLoss(nn.Module):
 
         for key, task in task_flow.tasks.items():
             if not task.has_children():
-                instance = TaskLossDecorator(task.get_name(), task.get_available_func(), prefix, task.get_loss())
+                instance = TaskLossDecorator(task.get_name(), task.get_available_func(), prefix, task.get_loss(),
+                                             task.get_per_sample_loss())
             else:
-                instance = TaskFlowLoss(task, prefix=f'{prefix}{task.get_name()}.')
+                instance = TaskFlowLoss(task, prefix=f'{prefix}{task.get_name()}.', masked=masked)
 
             setattr(self, key, instance)
 
+        self._compiled_flow = task_flow.get_compiled_flow(prefix)
+        # Leaves with the same precondition are computed together (see `compute_leaf_batch`).
+        self._precondition_groups = self._compiled_flow.get_precondition_groups()
+
     def forward(self, *args):
         """
         TaskFlowLoss can be invoked either by giving two arguments: (outputs, targets), or bby giving a single
@@ -140,22 +480,70 @@ class TaskFlowLoss(nn.Module):
         :param args:
         :return:
         """
-        is_root = len(args) == 2
-        if is_root:
+        if len(args) == 2:
             outputs, targets = args
-        else:
-            loss_flow_data = args[0]
-            outputs = loss_flow_data.outputs
-            targets = loss_flow_data.targets
+            return self.get_results(outputs, targets).loss
 
-        value = any_value(outputs)
+        loss_flow_data = args[0]
+        value = any_value(loss_flow_data.outputs)
         loss_items = torch.zeros(1, dtype=value.dtype, device=value.device)
-        flow_result = self.flow(self, LossFlowData(outputs, targets), LossItems(loss_items))
+        flow_result = self.run_compiled(LossFlowData(loss_flow_data.outputs, loss_flow_data.targets),
+                                        LossItems(loss_items))
+        return LossItems(flow_result.loss_items)
 
-        if not is_root:
-            return LossItems(flow_result.loss_items)
+    def get_results(self, outputs, targets) -> FlowLossResults:
+        """
+        Computes the loss, the losses of the leaves and the per-sample losses of a batch in a single pass. During
+        training the results are computed once per batch by `FlowCriterionCallback` and the other callbacks take them
+        from the state of the runner (see `get_loss_results`).
+        """
+        loss_flow_data = LossFlowData(outputs, targets)
+        leaf_decorators = dict(zip(self._compiled_flow.get_paths(), self._compiled_flow.resolve_leaves(self)))
+        leaf_losses = self.compute_leaves(loss_flow_data)
+        value = any_value(outputs)
+        loss = torch.zeros(1, dtype=value.dtype, device=value.device)
+        for leaf_loss in leaf_losses.values():
+            loss = loss + leaf_loss.loss
+        return FlowLossResults(loss_flow_data, leaf_decorators, leaf_losses, loss)
 
-        return flow_result.loss_items
+    def compute_leaves(self, loss_flow_data):
+        """
+        :return: dict from the path of every leaf in the compiled plan of the flow to its `LeafLoss`.
+        """
+        paths = self._compiled_flow.get_paths()
+        leaf_decorators = self._compiled_flow.resolve_leaves(self)
+        if self.masked:
+            return {path: leaf_loss.compute_leaf(loss_flow_data, masked=True)
+                    for path, leaf_loss in zip(paths, leaf_decorators)}
+        # The packed precondition matrix tells which leaves have samples with one reduction for the whole flow.
+        nonempty = get_nonempty_tasks(loss_flow_data.outputs, paths)
+        if nonempty is None:
+            return {path: leaf_loss.compute_leaf(loss_flow_data) for path, leaf_loss in zip(paths, leaf_decorators)}
+        packed = loss_flow_data.outputs[PACKED_PRECONDITIONS_KEY]
+        res = {}
+        for group in self._precondition_groups:
+            batched = [i for i in group if nonempty[i] and leaf_decorators[i].batchable]
+            for i in group:
+                if len(batched) < 2 or i not in batched:
+                    res[paths[i]] = leaf_decorators[i].compute_leaf(loss_flow_data, bool(nonempty[i]))
+            if len(batched) < 2:
+                continue
+            # The rows of the group are found once, and the outputs of all leaves are gathered together.
+            rows = torch.nonzero(packed[:, batched].any(dim=1), as_tuple=True)[0]
+            decorators = {leaf_decorators[i]: paths[i] for i in batched}
+            for batch in split_into_batches(list(decorators), loss_flow_data):
+                for leaf_decorator, leaf_loss in zip(batch, compute_leaf_batch(batch, loss_flow_data, rows)):
+                    res[decorators[leaf_decorator]] = leaf_loss
+        return {path: res[path] for path in paths}
+
+    def run_compiled(self, loss_flow_data, out):
+        """
+        Sums the losses of all leaves in the compiled plan of the flow, which gives the same result as `self.flow`.
+        """
+        loss_items = out.loss_items
+        for leaf_loss in self.compute_leaves(loss_flow_data).values():
+            loss_items = loss_items + leaf_loss.loss
+        return LossItems(loss_items)
 
     def get_leaf_losses(self):
         all_losses = {}
@@ -183,65 +571,42 @@ class TaskFlowLoss(nn.Module):
                     all_metrics.append((metric_name, metric_decorator))
         return all_metrics
 
-    def catalyst_callbacks(self):
-        from catalyst.core import MetricCallback
-        callbacks = []
-        for path, loss in self.get_leaf_losses().items():
-            metric_decorator = BaseMetricDecorator(loss.task_name,
-                                                   loss.available,
-                                                   loss.prefix,
-                                                   loss.metric)
-            callbacks.append(MetricCallback(f'loss_{path}', metric_decorator))
-        for metric_name, metric_decorator in self.get_metrics():
-            metric = metric_decorator.metric
-            full_name = f'{metric_name}_{metric_decorator.prefix}{metric_decorator.task_name}'
-            if metric.is_multi_metric():
-                callback = MultiMetricCallback(full_name, metric_decorator, metric.list_args())
+    def get_task_metrics(self):
+        """
+        :return: dict from the path of every leaf task to a metric decorator of all its metrics (`TaskMetrics`).
+        """
+        from dnn_cool.metrics import TaskMetrics
+        all_metrics = {}
+        for key, task in self._task_flow.tasks.items():
+            child_loss = getattr(self, key)
+            if task.has_children():
+                all_metrics.update(child_loss.get_task_metrics())
             else:
-                callback = MetricCallback(full_name, metric_decorator)
-            callbacks.append(callback)
+                path = child_loss.prefix + task.get_name()
+                all_metrics[path] = BaseMetricDecorator(task.get_name(),
+                                                        task.get_available_func(),
+                                                        child_loss.prefix,
+                                                        TaskMetrics(task.get_metrics()))
+        return all_metrics
+
+    def catalyst_callbacks(self):
+        from dnn_cool.catalyst_utils import FlowCriterionCallback, LeafLossCallback, MetricAccumulatorCallback
+        callbacks = [FlowCriterionCallback()]
+        for path in self.get_leaf_losses():
+            callbacks.append(LeafLossCallback(f'loss_{path}', self, path))
+        for path, metric_decorator in self.get_task_metrics().items():
+            callbacks.append(MetricAccumulatorCallback(path, metric_decorator))
         return callbacks
 
 
 class TaskFlowLossPerSample(nn.Module):
+    """
+    The per-sample losses of a task flow, as given by `FlowLossResults.get_per_sample`.
+    """
 
     def __init__(self, task_flow, prefix=''):
         super().__init__()
-
-        self._all_children = task_flow.get_all_children(prefix=prefix)
-        self._all_losses = self._collect_leaf_losses_per_sample()
+        self.flow_loss = TaskFlowLoss(task_flow, prefix=prefix)
 
     def forward(self, outputs, targets):
-        res = {}
-        value = any_value(outputs)
-        bs = len(value)
-        overall_loss_items = torch.zeros(bs, device=value.device, dtype=value.dtype)
-        for path, loss in self._all_losses.items():
-            loss_items = loss(outputs, targets).loss_items
-            res[path] = loss_items.squeeze(dim=-1)
-            indices = torch.arange(bs, device=value.device)
-            precondition = outputs[f'precondition|{path}']
-            axes = tuple(range(1, len(precondition.shape)))
-            if len(axes) > 0:
-                precondition = precondition.sum(axis=axes) > 0
-            res[f'indices|{path}'] = indices[precondition]
-            overall_loss_items[precondition] += res[path]
-        res['overall'] = overall_loss_items
-        res['indices|overall'] = torch.arange(bs, device=value.device)
-        return res
-
-    def get_leaf_losses_per_sample(self):
-        return self._all_losses
-
-    def _collect_leaf_losses_per_sample(self):
-        all_losses = {}
-        for path, task in self._all_children.items():
-            if '.' not in path:
-                prefix = ''
-            else:
-                prefix = path.rsplit('.', 1)[0] + '.'
-            all_losses[path] = TaskLossDecorator(task.get_name(),
-                                                 task.get_available_func(),
-                                                 prefix,
-                                                 task.get_per_sample_loss())
-        return all_losses
+        return self.flow_loss.get_results(outputs, targets).get_per_sample()
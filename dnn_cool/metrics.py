@@ -1,13 +1,155 @@
 from functools import partial
 
+import numpy as np
 import torch
 
-from catalyst.utils.metrics import accuracy
 from sklearn.metrics import f1_score, precision_score, recall_score
 from torch import nn
 
 
+def count_where(condition, mask=None):
+    """
+    :return: The number of true elements of `condition` in the samples selected by `mask`, as a tensor on its device.
+    """
+    if mask is not None:
+        condition = condition & mask.reshape(-1, *([1] * (len(condition.shape) - 1)))
+    return condition.sum()
+
+
+def count_elements(tensor, mask=None):
+    if mask is None:
+        return tensor.numel()
+    return mask.sum() * int(np.prod(tensor.shape[1:]))
+
+
+def accuracy(outputs, targets):
+    """
+    :return: The fraction of the elements of the decoded outputs, which are equal to the targets, as a tensor with one
+    element.
+    """
+    outputs = outputs.reshape(len(outputs), -1).long()
+    targets = targets.reshape(len(targets), -1).long()
+    return (outputs == targets).float().mean().reshape(1)
+
+
+def safe_divide(numerator, denominator):
+    """
+    :return: The ratio as a float, or `0.` if the denominator is zero (as sklearn does).
+    """
+    denominator = float(denominator)
+    return float(numerator) / denominator if denominator > 0 else 0.
+
+
+class Statistic:
+    """
+    Statistic of the (activated) outputs and the targets of a task, from which one or more metrics are derived (see
+    `TorchMetric.from_statistic`). It is accumulated over batches as tensors on the device of the outputs, so updating
+    it does not synchronize with the host.
+    """
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.reset()
+
+    def update(self, outputs, targets, mask=None):
+        """
+        :param outputs: The activated outputs.
+        :param targets: The targets.
+        :param mask: Optional 1D bool tensor, which selects the samples to use.
+        """
+        raise NotImplementedError()
+
+    def reset(self):
+        self.total = 0
+
+
+class BinaryConfusion(Statistic):
+    """
+    The confusion matrix of the decoded outputs of a binary task.
+    """
+
+    def update(self, outputs, targets, mask=None):
+        outputs = self.decoder(outputs)
+        outputs = outputs.reshape(len(outputs), -1).bool()
+        targets = targets.reshape(len(targets), -1).bool()
+        self.tp = self.tp + count_where(outputs & targets, mask)
+        self.fp = self.fp + count_where(outputs & ~targets, mask)
+        self.fn = self.fn + count_where(~outputs & targets, mask)
+        self.total = self.total + count_elements(outputs, mask)
+
+    def get_counts(self):
+        """
+        :return: The numbers of true positives, false positives, false negatives and true negatives, as floats.
+        """
+        tp, fp, fn = float(self.tp), float(self.fp), float(self.fn)
+        return tp, fp, fn, float(self.total) - tp - fp - fn
+
+    def reset(self):
+        super().reset()
+        self.tp = 0
+        self.fp = 0
+        self.fn = 0
+
+
+class TopKHits(Statistic):
+    """
+    The number of samples of a classification task, whose target is in the top 1, 3 and 5 scores.
+    """
+    topk = (1, 3, 5)
+
+    def update(self, outputs, targets, mask=None):
+        # The predictions are the indices of the top scores - with a single score, always the class 0.
+        outputs = outputs.reshape(len(outputs), -1)
+        self.n_classes = outputs.shape[1]
+        pred = outputs.topk(min(max(self.topk), self.n_classes), dim=1)[1]
+        correct = pred == targets.long().reshape(-1, 1)
+        for k in self.topk:
+            self.hits[k] = self.hits[k] + count_where(correct[:, :k].any(dim=1), mask)
+        self.total = self.total + count_elements(targets.reshape(len(targets)), mask)
+
+    def reset(self):
+        super().reset()
+        self.n_classes = None
+        self.hits = {k: 0 for k in self.topk}
+
+
+class ElementMatches(Statistic):
+    """
+    The number of elements of the decoded outputs, which are equal to the targets.
+    """
+
+    def update(self, outputs, targets, mask=None):
+        outputs = self.decoder(outputs)
+        correct = outputs.reshape(len(outputs), -1).long() == targets.reshape(len(targets), -1).long()
+        self.correct = self.correct + count_where(correct, mask)
+        self.total = self.total + count_elements(correct, mask)
+
+    def reset(self):
+        super().reset()
+        self.correct = 0
+
+
+class AbsoluteErrors(Statistic):
+    """
+    The sum of the absolute errors of the (not decoded) outputs.
+    """
+
+    def update(self, outputs, targets, mask=None):
+        errors = (outputs - targets).abs()
+        if mask is not None:
+            errors = torch.where(mask.reshape(-1, *([1] * (len(errors.shape) - 1))), errors, torch.zeros_like(errors))
+        self.error_sum = self.error_sum + errors.sum()
+        self.total = self.total + count_elements(errors, mask)
+
+    def reset(self):
+        super().reset()
+        self.error_sum = 0.
+
+
 class TorchMetric:
+    # Metrics with a statistic are derived from it with `from_statistic`, so all metrics of a task with the same
+    # statistic are computed from a single pass over the outputs (see `TaskMetrics`).
+    statistic_cls = None
 
     def __init__(self, metric_fn, decode=True, is_multimetric=False, list_args=None):
         self.activation = None
@@ -16,12 +158,13 @@ class TorchMetric:
         self._is_multimetric = is_multimetric
         self._list_args = list_args
         self._decode = decode
+        self.reset()
 
     def bind_to_task(self, task):
         self.activation = task.get_activation()
         self.decoder = task.get_decoder()
 
-    def __call__(self, outputs, targets, activate=True):
+    def prepare(self, outputs, targets, activate=True, decode=None):
         if (self.activation is None) or (self.decoder is None):
             raise ValueError(f'The metric is not binded to a task, but is already used.')
         outputs = torch.as_tensor(outputs)
@@ -29,13 +172,67 @@ class TorchMetric:
 
         if activate:
             outputs = self.activation(outputs)
-        if self._decode:
+        if self._decode if decode is None else decode:
             outputs = self.decoder(outputs)
+        return outputs, targets
+
+    def __call__(self, outputs, targets, activate=True):
+        outputs, targets = self.prepare(outputs, targets, activate)
         return self._invoke_metric(outputs, targets)
 
     def _invoke_metric(self, outputs, targets):
         return self.metric_fn(outputs, targets)
 
+    def get_statistic(self) -> Statistic:
+        return self.statistic_cls(self.decoder)
+
+    def from_statistic(self, statistic: Statistic):
+        """
+        :return: The value of the metric, derived from the statistic.
+        """
+        raise NotImplementedError()
+
+    def update(self, outputs, targets, mask=None, activate=True):
+        """
+        Accumulates the statistics of the metric over a batch. The statistics are kept on the device of the outputs,
+        so updating does not synchronize with the host.
+        :param outputs: The outputs of the task.
+        :param targets: The targets of the task.
+        :param mask: Optional 1D bool tensor, which selects the samples to use.
+        :param activate: Whether to apply the activation of the task on the outputs.
+        """
+        with torch.no_grad():
+            if self.statistic_cls is None:
+                # A general metric is computed once over all accumulated samples.
+                outputs, targets = self.prepare(outputs, targets, activate)
+                if mask is not None:
+                    outputs, targets = outputs[mask], targets[mask]
+                self._outputs.append(outputs)
+                self._targets.append(targets)
+                return
+            outputs, targets = self.prepare(outputs, targets, activate, decode=False)
+            if self._statistic is None:
+                self._statistic = self.get_statistic()
+            self._statistic.update(outputs, targets, mask)
+
+    def compute(self):
+        """
+        :return: The value of the metric over all samples given to `update` since the last `reset` (a list of values
+        for multi-metrics), or `None` if there were no samples.
+        """
+        if self.statistic_cls is not None:
+            if self._statistic is None or float(self._statistic.total) == 0:
+                return None
+            return self.from_statistic(self._statistic)
+        if sum(len(outputs) for outputs in self._outputs) == 0:
+            return None
+        return self._invoke_metric(torch.cat(self._outputs), torch.cat(self._targets))
+
+    def reset(self):
+        self._statistic = None
+        self._outputs = []
+        self._targets = []
+
     def is_multi_metric(self):
         return self._is_multimetric
 
@@ -44,29 +241,38 @@ class TorchMetric:
 
 
 class BinaryAccuracy(TorchMetric):
+    statistic_cls = BinaryConfusion
 
     def __init__(self):
         super().__init__(accuracy, decode=True, is_multimetric=False)
 
-    def _invoke_metric(self, outputs, targets):
-        if len(outputs.shape) <= 1:
-            outputs = outputs.unsqueeze(dim=-1)
-        return self.metric_fn(outputs, targets)[0]
+    def from_statistic(self, statistic):
+        tp, fp, fn, tn = statistic.get_counts()
+        return safe_divide(tp + tn, statistic.total)
 
 
 class ClassificationAccuracy(TorchMetric):
+    statistic_cls = TopKHits
 
     def __init__(self):
-        super().__init__(accuracy, decode=False, is_multimetric=True, list_args=(1, 3, 5))
+        super().__init__(None, decode=False, is_multimetric=True, list_args=(1, 3, 5))
 
-    def _invoke_metric(self, outputs, targets):
-        n_classes = outputs.shape[-1]
+    def get_topk(self, n_classes):
         topk = [1]
         if n_classes > 3:
             topk.append(3)
         if n_classes > 5:
             topk.append(5)
-        return self.metric_fn(outputs, targets, topk=topk)
+        return topk
+
+    def _invoke_metric(self, outputs, targets):
+        # The accuracy of a batch is derived from the same statistic as the accumulated metric.
+        statistic = self.get_statistic()
+        statistic.update(outputs, targets)
+        return self.from_statistic(statistic)
+
+    def from_statistic(self, statistic):
+        return [safe_divide(statistic.hits[k], statistic.total) for k in self.get_topk(statistic.n_classes)]
 
 
 class NumpyMetric(TorchMetric):
@@ -79,26 +285,42 @@ class NumpyMetric(TorchMetric):
             outputs = outputs.detach().cpu().numpy()
         if isinstance(targets, torch.Tensor):
             targets = targets.cpu().numpy()
-        return self.metric_fn(outputs, targets)
+        # sklearn metrics receive the targets first.
+        return self.metric_fn(targets, outputs)
 
 
 class BinaryF1Score(NumpyMetric):
+    statistic_cls = BinaryConfusion
 
     def __init__(self):
         super().__init__(f1_score)
 
+    def from_statistic(self, statistic):
+        tp, fp, fn, tn = statistic.get_counts()
+        return safe_divide(2 * tp, 2 * tp + fp + fn)
+
 
 class BinaryPrecision(NumpyMetric):
+    statistic_cls = BinaryConfusion
 
     def __init__(self):
         super().__init__(precision_score)
 
+    def from_statistic(self, statistic):
+        tp, fp, fn, tn = statistic.get_counts()
+        return safe_divide(tp, tp + fp)
+
 
 class BinaryRecall(NumpyMetric):
+    statistic_cls = BinaryConfusion
 
     def __init__(self):
         super().__init__(recall_score)
 
+    def from_statistic(self, statistic):
+        tp, fp, fn, tn = statistic.get_counts()
+        return safe_divide(tp, tp + fn)
+
 
 class ClassificationNumpyMetric(NumpyMetric):
 
@@ -111,40 +333,117 @@ class ClassificationNumpyMetric(NumpyMetric):
         if isinstance(targets, torch.Tensor):
             targets = targets.cpu().numpy()
         outputs = outputs[..., 0]
-        return self.metric_fn(outputs, targets)
+        return self.metric_fn(targets, outputs)
 
 
-class ClassificationF1Score(ClassificationNumpyMetric):
+class ClassificationMicroMetric(ClassificationNumpyMetric):
+    """
+    Micro-averaged metric of a (single label) classification task, which equals the fraction of samples with correct
+    top-1 predictions.
+    """
+    statistic_cls = TopKHits
+
+    def from_statistic(self, statistic):
+        return safe_divide(statistic.hits[1], statistic.total)
+
+
+class ClassificationF1Score(ClassificationMicroMetric):
 
     def __init__(self):
         super().__init__(partial(f1_score, average='micro'))
 
 
-class ClassificationPrecision(ClassificationNumpyMetric):
+class ClassificationPrecision(ClassificationMicroMetric):
 
     def __init__(self):
         super().__init__(partial(precision_score, average='micro'))
 
 
-class ClassificationRecall(ClassificationNumpyMetric):
+class ClassificationRecall(ClassificationMicroMetric):
 
     def __init__(self):
         super().__init__(partial(recall_score, average='micro'))
 
 
 class MeanAbsoluteError(TorchMetric):
+    statistic_cls = AbsoluteErrors
 
     def __init__(self, decode=False, is_multimetric=False, list_args=None):
         super().__init__(nn.L1Loss(), decode, is_multimetric, list_args)
 
+    def from_statistic(self, statistic):
+        return safe_divide(statistic.error_sum, statistic.total)
+
 
 class MultiLabelClassificationAccuracy(TorchMetric):
+    statistic_cls = ElementMatches
 
     def __init__(self):
         super().__init__(accuracy, decode=True, is_multimetric=False)
 
-    def _invoke_metric(self, outputs, targets):
-        return self.metric_fn(outputs, targets)[0]
+    def from_statistic(self, statistic):
+        return safe_divide(statistic.correct, statistic.total)
+
+
+class TaskMetrics:
+    """
+    All metrics of a task, computed in a single pass: the outputs are activated once, every distinct statistic (for
+    example the confusion matrix of a binary task) is accumulated once, and the metrics are derived from it. Metrics
+    without a statistic are accumulated as usual. Has the same `update`, `compute` and `reset` as `TorchMetric`.
+    """
+
+    def __init__(self, metrics):
+        """
+        :param metrics: The `(name, metric)` tuples of the task, bound to it (see `ITask.get_metrics`).
+        """
+        self.metrics = tuple(metrics)
+        self.reset()
+
+    def update(self, outputs, targets, mask=None, activate=True):
+        if len(self.metrics) == 0:
+            return
+        with torch.no_grad():
+            outputs = torch.as_tensor(outputs)
+            targets = torch.as_tensor(targets)
+            activation = self.metrics[0][1].activation
+            if activate and activation is not None:
+                outputs = activation(outputs)
+            for statistic in self.statistics.values():
+                statistic.update(outputs, targets, mask)
+            for metric_name, metric in self.metrics:
+                if metric.statistic_cls is None:
+                    metric.update(outputs, targets, mask, activate=False)
+
+    def compute(self):
+        """
+        :return: dict from the name of every metric to its value (see `TorchMetric.compute`).
+        """
+        res = {}
+        for metric_name, metric in self.metrics:
+            if metric.statistic_cls is None:
+                res[metric_name] = metric.compute()
+                continue
+            statistic = self.statistics[metric.statistic_cls]
+            res[metric_name] = metric.from_statistic(statistic) if float(statistic.total) > 0 else None
+        return res
+
+    def evaluate(self, outputs, targets, activate=True):
+        """
+        :return: The values of all metrics (see `compute`) for the given outputs and targets.
+        """
+        self.reset()
+        self.update(outputs, targets, activate=activate)
+        res = self.compute()
+        self.reset()
+        return res
+
+    def reset(self):
+        self.statistics = {}
+        for metric_name, metric in self.metrics:
+            if metric.statistic_cls is None:
+                metric.reset()
+            elif metric.statistic_cls not in self.statistics:
+                self.statistics[metric.statistic_cls] = metric.get_statistic()
 
 
 def get_default_binary_metrics():
@@ -5,6 +5,7 @@ from typing import Dict, Union, Optional
 from dataclasses import dataclass, field
 from torch import nn
 
+from dnn_cool.packed import PackedGt, is_packed_gt, to_sample_mask, PACKED_PRECONDITIONS_KEY
 from dnn_cool.utils import to_broadcastable_shape
 
 
@@ -76,6 +77,9 @@ class ModuleDecorator(nn.Module):
             decoded_logits = None
 
         logits = self.module(*args, **kwargs)
+        return self.decorate_logits(logits, decoded_logits)
+
+    def decorate_logits(self, logits, decoded_logits=None):
         activated_logits = self.activation(logits) if self.activation is not None else logits
 
         if decoded_logits is None:
@@ -85,14 +89,78 @@ class ModuleDecorator(nn.Module):
         return LeafModuleOutput(key, logits, activated_logits, decoded_logits, condition)
 
 
+def and_masks(mask_one, mask_two):
+    mask_one, mask_two = to_broadcastable_shape(mask_one, mask_two)
+    return mask_one & mask_two
+
+
+class MaskEvaluator:
+    """
+    Computes the masks of conditions over the given data (ground truth or decoded outputs). Every distinct condition
+    is computed only once, and cached by its expression, so conditions shared by many tasks (and the parent chains of
+    nested conditions) are not recomputed. The masks are computed out-of-place and are shared between the tasks, so
+    they must not be modified in-place.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.masks = {}
+
+    def to_mask(self, condition):
+        key = condition.get_key()
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = condition.compute_mask(self)
+            self.masks[key] = mask
+        return mask
+
+    def add_mask(self, condition, mask):
+        """
+        Registers an already computed mask of the condition (for example computed by the dataset), which is then
+        reused by all conditions with the same expression.
+        """
+        self.masks.setdefault(condition.get_key(), mask)
+
+
+def evaluate_preconditions(preconditions, data, precomputed=None):
+    """
+    Computes the masks of all preconditions with one shared `MaskEvaluator`.
+    :param preconditions: dict from path to its precondition - a `Condition`, an already computed mask or `None`.
+    :param data: The data (ground truth or decoded outputs), over which the conditions are computed.
+    :param precomputed: Optional dict from path to an already computed mask of its precondition.
+    :return: dict from path to mask, for all paths which have a precondition.
+    """
+    mask_evaluator = MaskEvaluator(data)
+    res = {}
+    for path, condition in preconditions.items():
+        if condition is None:
+            continue
+        if not isinstance(condition, Condition):
+            res[path] = condition
+            continue
+        if precomputed is not None and path in precomputed:
+            mask_evaluator.add_mask(condition, precomputed[path])
+        res[path] = mask_evaluator.to_mask(condition)
+    return res
+
+
 class Condition:
 
     def get_precondition(self, data):
         raise NotImplementedError()
 
-    def to_mask(self, data):
+    def get_key(self):
+        """
+        :return: A string expression, which uniquely identifies the mask of this condition.
+        """
+        raise NotImplementedError()
+
+    def compute_mask(self, evaluator: MaskEvaluator):
         raise NotImplementedError()
 
+    def to_mask(self, data):
+        return MaskEvaluator(data).to_mask(self)
+
     def __invert__(self):
         return NegatedCondition(self)
 
@@ -107,7 +175,11 @@ class OnesCondition(Condition):
     def get_precondition(self, data):
         return OnesCondition(self.path)
 
-    def to_mask(self, data):
+    def get_key(self):
+        return f'available({self.path})'
+
+    def compute_mask(self, evaluator):
+        data = evaluator.data
         if '_availability' in data:
             return data['_availability'][self.path]
         return torch.ones_like(data[self.path]).bool()
@@ -120,12 +192,13 @@ class NegatedCondition(Condition):
     def get_precondition(self, data):
         return self.precondition.get_precondition(data)
 
-    def to_mask(self, data):
-        mask = self.precondition.to_mask(data)
-        precondition = self.get_precondition(data).to_mask(data)
-        mask[~precondition] = False
-        mask[precondition] = ~mask[precondition]
-        return mask
+    def get_key(self):
+        return f'~{self.precondition.get_key()}'
+
+    def compute_mask(self, evaluator):
+        mask = evaluator.to_mask(self.precondition)
+        precondition = evaluator.to_mask(self.get_precondition(evaluator.data))
+        return and_masks(~mask, precondition)
 
 
 @dataclass
@@ -135,8 +208,11 @@ class LeafCondition(Condition):
     def get_precondition(self, data):
         return OnesCondition(self.path)
 
-    def to_mask(self, data):
-        return data[self.path].clone()
+    def get_key(self):
+        return self.path
+
+    def compute_mask(self, evaluator):
+        return evaluator.data[self.path]
 
 
 @dataclass()
@@ -147,11 +223,13 @@ class NestedCondition(Condition):
     def get_precondition(self, data):
         return self.parent
 
-    def to_mask(self, data):
-        mask = data[self.path].clone()
-        precondition = self.get_precondition(data).to_mask(data)
-        mask[~precondition] = False
-        return mask
+    def get_key(self):
+        return f'({self.path} | {self.parent.get_key()})'
+
+    def compute_mask(self, evaluator):
+        mask = evaluator.data[self.path]
+        precondition = evaluator.to_mask(self.get_precondition(evaluator.data))
+        return and_masks(mask, precondition)
 
 
 @dataclass()
@@ -162,11 +240,13 @@ class AndCondition(Condition):
     def get_precondition(self, data):
         return self.condition_one.get_precondition(data) & self.condition_two.get_precondition(data)
 
-    def to_mask(self, data):
-        mask_one = self.condition_one.to_mask(data)
-        mask_two = self.condition_two.to_mask(data)
-        mask_one, mask_two = to_broadcastable_shape(mask_one, mask_two)
-        return mask_one & mask_two
+    def get_key(self):
+        return f'({self.condition_one.get_key()} & {self.condition_two.get_key()})'
+
+    def compute_mask(self, evaluator):
+        mask_one = evaluator.to_mask(self.condition_one)
+        mask_two = evaluator.to_mask(self.condition_two)
+        return and_masks(mask_one, mask_two)
 
 
 @dataclass
@@ -249,13 +329,20 @@ class CompositeModuleOutput:
             res = self.decoded if inference_without_gt else self.logits
 
             if inference_without_gt and not self.training:
-                for key, value in self.preconditions.items():
-                    if value is not None:
-                        self.preconditions[key] = value.to_mask(preconditions_source)
+                self.preconditions.update(evaluate_preconditions(self.preconditions, preconditions_source))
                 return self
-            for key, value in self.preconditions.items():
-                if value is not None:
-                    res[f'precondition|{key}'] = value.to_mask(preconditions_source)
+            # The dataset may have already computed the precondition masks from the gt.
+            precomputed = None
+            if isinstance(preconditions_source, PackedGt):
+                precomputed = preconditions_source.get_preconditions()
+            masks = evaluate_preconditions(self.preconditions, preconditions_source, precomputed)
+            sample_masks = []
+            for key, mask in masks.items():
+                res[f'precondition|{key}'] = mask
+                sample_masks.append(to_sample_mask(mask))
+            # Packed (batch x tasks) matrix, which tells which samples satisfy the precondition of every task.
+            if 0 < len(sample_masks) == len(self.preconditions):
+                res[PACKED_PRECONDITIONS_KEY] = torch.stack(sample_masks, dim=1)
             return res
         return self
 
@@ -271,6 +358,124 @@ class FeaturesDict:
         return self.data[item]
 
 
+def is_fusable(leaf_call, decorator):
+    return (leaf_call.get_input_keys() is not None) and (type(decorator.module) is nn.Linear)
+
+
+def find_fusable_groups(compiled_flow, decorators):
+    """
+    Finds groups of leaves, which receive the same input and whose modules are `nn.Linear` layers with the same
+    number of input features, so that they can be computed with a single matrix multiplication.
+    :return: list of groups, every group is a list of indices of leaves in the compiled flow.
+    """
+    groups = {}
+    for i, (leaf_call, decorator) in enumerate(zip(compiled_flow.leaves, decorators)):
+        if not is_fusable(leaf_call, decorator):
+            continue
+        linear = decorator.module
+        key = (leaf_call.get_input_keys(), linear.in_features, linear.bias is not None)
+        groups.setdefault(key, []).append(i)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def concat_linear_params(linears):
+    weight = torch.cat([linear.weight for linear in linears], dim=0)
+    bias = None
+    if linears[0].bias is not None:
+        bias = torch.cat([linear.bias for linear in linears], dim=0)
+    return weight, bias
+
+
+def get_params_version(linears):
+    """
+    :return: Key, which changes whenever a parameter of the layers is replaced or modified in-place (for example by an
+    optimizer step or `load_state_dict`).
+    """
+    return tuple((param.data_ptr(), param._version) for linear in linears for param in linear.parameters())
+
+
+def fused_linear(linears, x, params=None):
+    """
+    Computes several linear layers on the same input with one matrix multiplication, by concatenating their weights.
+    :param params: Optional `(weight, bias)`, already concatenated. If not given, the weights are concatenated on this
+    call, so the gradients still flow to the original layers.
+    :return: list with the output of every layer.
+    """
+    weight, bias = concat_linear_params(linears) if params is None else params
+    res = nn.functional.linear(x, weight, bias)
+    return res.split([linear.out_features for linear in linears], dim=-1)
+
+
+def fuse_linear_modules(linears):
+    """
+    Creates a single `nn.Linear` layer with the concatenated (copied) weights of the given layers.
+    """
+    has_bias = linears[0].bias is not None
+    out_features = sum(linear.out_features for linear in linears)
+    fused = nn.Linear(linears[0].in_features, out_features, bias=has_bias)
+    with torch.no_grad():
+        fused.weight.copy_(torch.cat([linear.weight for linear in linears], dim=0))
+        if has_bias:
+            fused.bias.copy_(torch.cat([linear.bias for linear in linears], dim=0))
+    return fused.to(linears[0].weight.device)
+
+
+def find_batch_tensor(args, kwargs):
+    for arg in [*args, *kwargs.values()]:
+        if isinstance(arg, torch.Tensor):
+            return arg
+    raise ValueError(f'Sparse inference needs at least one tensor input, but got: {args}, {kwargs}')
+
+
+class PreconditionGates:
+    """
+    Finds the rows, which satisfy the preconditions of the leaves in sparse inference. The rows are computed once for
+    every group of leaves with the same precondition (see `CompiledFlow.get_precondition_groups`), and all conditions
+    are computed with one `MaskEvaluator` over the decoded outputs, so shared conditions and parent chains are computed
+    once per forward pass. All tasks referenced by a precondition are decoded before the first leaf of its group.
+    """
+
+    def __init__(self, group_preconditions, leaf_groups, decoded):
+        """
+        :param group_preconditions: The precondition of every group, without the availability of the task itself.
+        :param leaf_groups: dict from the index of every leaf to the index of its group.
+        :param decoded: The decoded outputs, which are filled in while the leaves are computed.
+        """
+        self.group_preconditions = group_preconditions
+        self.leaf_groups = leaf_groups
+        self.mask_evaluator = MaskEvaluator(decoded)
+        self.gates = {}
+
+    def get(self, i, batch_size):
+        """
+        :return: A tuple of the rows, which satisfy the precondition of the leaf (`None` if all rows do), and their
+        number.
+        """
+        group = self.leaf_groups[i]
+        if group not in self.gates:
+            condition = self.group_preconditions[group]
+            if condition is None:
+                self.gates[group] = None, batch_size
+            else:
+                rows = self.mask_evaluator.to_mask(condition).reshape(batch_size, -1).any(dim=1)
+                # The only synchronization with the host for the whole group.
+                n_rows = int(rows.sum())
+                self.gates[group] = (None if n_rows == batch_size else rows), n_rows
+        return self.gates[group]
+
+
+def gather_rows(value, rows, batch_size):
+    if isinstance(value, torch.Tensor) and len(value.shape) > 0 and len(value) == batch_size:
+        return value[rows]
+    return value
+
+
+def scatter_rows(values, rows, fill_value):
+    res = torch.full((len(rows), *values.shape[1:]), fill_value, dtype=values.dtype, device=values.device)
+    res[rows] = values
+    return res
+
+
 class TaskFlowModule(nn.Module):
 
     def __init__(self, task_flow, prefix=''):
@@ -289,14 +494,134 @@ class TaskFlowModule(nn.Module):
                 instance = TaskFlowModule(task, prefix=f'{prefix}{task.get_name()}.')
             setattr(self, key, instance)
 
+        self._compiled_flow = task_flow.get_compiled_flow(prefix)
+        self._fusable_groups = find_fusable_groups(self._compiled_flow, self._compiled_flow.resolve_leaves(self))
+        self._fused_params = {}
+        # The shapes of the outputs of the leaves, which are filled when a leaf is skipped in sparse inference.
+        self._leaf_shapes = {}
+        self._group_preconditions = self._compiled_flow.get_group_preconditions()
+        groups = self._compiled_flow.get_precondition_groups()
+        self._leaf_groups = {i: group_idx for group_idx, group in enumerate(groups) for i in group}
+        # In inference, sibling linear heads on the same input are computed with one matrix multiplication (not in
+        # sparse mode).
+        self.fuse_heads = True
+        self.sparse_inference = False
+        self.fill_value = 0
+
+    def set_sparse_inference(self, enabled=True, fill_value=0):
+        """
+        When enabled, in inference mode without ground truth, every leaf is computed only on the rows which satisfy its
+        precondition and the results are scattered back into the full batch, filling the other rows with
+        `fill_value`. A leaf is skipped entirely when no row satisfies its precondition. Since the compiled plan is
+        flat, a sub-flow is skipped leaf by leaf. The precondition masks are the same as in the dense mode, so the
+        filled values are always masked.
+        :param enabled: Whether to use sparse inference.
+        :param fill_value: The value for the rows, where the precondition is not satisfied.
+        :return: self
+        """
+        self.sparse_inference = enabled
+        self.fill_value = fill_value
+        return self
+
     def forward(self, x):
         if isinstance(x, FeaturesDict):
             x = x.data
 
-        out = CompositeModuleOutput(training=self.training, gt=x.get('gt'), prefix=self.prefix)
-        composite_module_output = self.flow(self, FeaturesDict(x), out)
+        gt = x.get('gt')
+        if is_packed_gt(gt):
+            gt = PackedGt(gt, self._task_flow.get_packed_layout(self.prefix))
+        out = CompositeModuleOutput(training=self.training, gt=gt, prefix=self.prefix)
+        composite_module_output = self.run_compiled(FeaturesDict(x), out)
         return composite_module_output.reduce()
 
+    def run_compiled(self, x, out):
+        """
+        Runs the compiled plan of the flow - it computes the same outputs and preconditions as `self.flow`, but without
+        dispatching through the proxies of the flow.
+        """
+        # The leaves are resolved on every call, so that replicas (e.g. from `nn.DataParallel`) use their own modules.
+        decorators = self._compiled_flow.resolve_leaves(self)
+        sparse = self.sparse_inference and not self.training and out.gt is None
+        fuse = self.fuse_heads and not self.training and not sparse
+        fused_logits = self._run_fused(x, decorators) if fuse else {}
+        gates = PreconditionGates(self._group_preconditions, self._leaf_groups, out.decoded) if sparse else None
+        for i, (leaf_call, decorator) in enumerate(zip(self._compiled_flow.leaves, decorators)):
+            if i in fused_logits:
+                leaf_module_output = decorator.decorate_logits(fused_logits[i])
+            elif sparse:
+                args, kwargs = leaf_call.resolve_inputs(x)
+                leaf_module_output = self._run_sparse(i, decorator, args, kwargs, gates)
+            else:
+                args, kwargs = leaf_call.resolve_inputs(x)
+                leaf_module_output = decorator(*args, **kwargs)
+            leaf_module_output.precondition = leaf_call.precondition
+            leaf_module_output.add_to_composite(out)
+        return out
+
+    def _run_fused(self, x, decorators):
+        fused_logits = {}
+        for group in self._fusable_groups:
+            inputs = self._compiled_flow.leaves[group[0]].args[0].resolve(x)
+            _, (inputs,) = find_arg_with_gt([inputs], is_kwargs=False)
+            linears = [decorators[i].module for i in group]
+            params = None if torch.is_grad_enabled() else self._get_fused_params(tuple(group), linears)
+            for i, logits in zip(group, fused_linear(linears, inputs, params)):
+                fused_logits[i] = logits
+        return fused_logits
+
+    def _get_fused_params(self, group, linears):
+        """
+        :return: The concatenated weights of the group, computed again only when the parameters of the layers change.
+        """
+        version = get_params_version(linears)
+        cached = self._fused_params.get(group)
+        if cached is None or cached[0] != version:
+            cached = (version, concat_linear_params(linears))
+            self._fused_params[group] = cached
+        return cached[1]
+
+    def _run_sparse(self, i, decorator, args, kwargs, gates):
+        batch_tensor = find_batch_tensor(args, kwargs)
+        batch_size = len(batch_tensor)
+        rows, n_rows = gates.get(i, batch_size)
+        if n_rows == 0:
+            return self._fill_leaf(i, decorator, args, kwargs, batch_tensor)
+        if rows is None:
+            return self._remember_shapes(i, decorator(*args, **kwargs))
+        args = [gather_rows(arg, rows, batch_size) for arg in args]
+        kwargs = {key: gather_rows(value, rows, batch_size) for key, value in kwargs.items()}
+        leaf_module_output = self._remember_shapes(i, decorator(*args, **kwargs))
+        leaf_module_output.logits = scatter_rows(leaf_module_output.logits, rows, self.fill_value)
+        leaf_module_output.activated = scatter_rows(leaf_module_output.activated, rows, self.fill_value)
+        leaf_module_output.decoded = scatter_rows(leaf_module_output.decoded, rows, self.fill_value)
+        return leaf_module_output
+
+    def _remember_shapes(self, i, leaf_module_output):
+        self._leaf_shapes[i] = [(value.shape[1:], value.dtype) for value in
+                                (leaf_module_output.logits, leaf_module_output.activated, leaf_module_output.decoded)]
+        return leaf_module_output
+
+    def _fill_leaf(self, i, decorator, args, kwargs, batch_tensor):
+        """
+        Skips a leaf, whose precondition is not satisfied by any row, and fills all its rows with `fill_value`. The
+        shapes of its outputs are remembered from the last time the leaf was computed - before that, it is computed once
+        on a single row.
+        """
+        batch_size = len(batch_tensor)
+        if i not in self._leaf_shapes:
+            first_row = slice(0, 1)
+            self._remember_shapes(i, decorator(*[gather_rows(arg, first_row, batch_size) for arg in args],
+                                               **{key: gather_rows(value, first_row, batch_size)
+                                                  for key, value in kwargs.items()}))
+        logits, activated, decoded = [torch.full((batch_size, *shape), self.fill_value, dtype=dtype,
+                                                 device=batch_tensor.device)
+                                      for shape, dtype in self._leaf_shapes[i]]
+        key = decorator.prefix + decorator.task_name
+        return LeafModuleOutput(key, logits, activated, decoded, OnesCondition(key))
+
+    def get_compiled_flow(self):
+        return self._compiled_flow
+
     def load_tuned(self, tuned_params):
         decoders = self._get_all_decoders()
         for key, decoder in decoders.items():
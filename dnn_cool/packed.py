@@ -0,0 +1,207 @@
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import Dict, Tuple, Optional
+
+import numpy as np
+import torch
+
+PACKED_GT_KEY = '_packed_gt'
+PACKED_AVAILABILITY_KEY = '_packed_availability'
+PACKED_GT_PRECONDITIONS_KEY = '_packed_preconditions'
+# Key of the packed (batch x tasks) precondition matrix in the outputs of a `TaskFlowModule`. It starts with an
+# underscore, so that it does not collide with the name of a task.
+PACKED_PRECONDITIONS_KEY = '_packed_precondition_masks'
+
+
+@dataclass
+class TaskIndex:
+    """
+    Static map from task paths to the columns of a packed matrix, where every task occupies a contiguous range of
+    columns (the flattened per-sample shape of its values).
+    """
+    slices: Dict[str, Tuple[int, int]] = field(default_factory=lambda: {})
+    shapes: Dict[str, Tuple[int, ...]] = field(default_factory=lambda: {})
+    width: int = 0
+
+    @classmethod
+    def from_shapes(cls, shapes: Dict[str, Tuple[int, ...]]):
+        slices = {}
+        start = 0
+        for path, shape in shapes.items():
+            end = start + int(np.prod(shape, dtype=np.int64))
+            slices[path] = (start, end)
+            start = end
+        return cls(slices, dict(shapes), start)
+
+    def __contains__(self, path):
+        return path in self.slices
+
+    def __iter__(self):
+        return iter(self.slices)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def pack(self, values, n) -> torch.Tensor:
+        """
+        Packs the given values into a single bool matrix.
+        :param values: dict from path to the values of a task, with the leading dimension of size `n`.
+        :param n: The number of rows.
+        :return: bool tensor with shape `(n, width)`.
+        """
+        if len(self) == 0:
+            return torch.zeros(n, 0, dtype=torch.bool)
+        columns = [torch.as_tensor(values[path]).reshape(n, -1).bool() for path in self]
+        return torch.cat(columns, dim=1)
+
+    def unpack(self, packed, path):
+        """
+        :return: A view into `packed` (which may have any number of leading dimensions) with the values of the task.
+        """
+        start, end = self.slices[path]
+        return packed[..., start:end].reshape(*packed.shape[:-1], *self.shapes[path])
+
+
+@dataclass
+class PackedLayout:
+    """
+    The layout of the packed ground truth of a flow: the decoded gt of the tasks used in preconditions, the
+    availability of all tasks and the precondition masks of all tasks, computed from the gt.
+    """
+    gt_index: TaskIndex
+    available_index: TaskIndex
+    precondition_index: TaskIndex
+
+    def get_shapes(self):
+        """
+        :return: The per-sample shapes of the tasks in the three indices (json serializable), from which the layout can
+        be restored with `PackedLayout.from_shapes`.
+        """
+        return {
+            'gt': {path: list(shape) for path, shape in self.gt_index.shapes.items()},
+            'available': {path: list(shape) for path, shape in self.available_index.shapes.items()},
+            'precondition': {path: list(shape) for path, shape in self.precondition_index.shapes.items()},
+        }
+
+    @classmethod
+    def from_shapes(cls, shapes):
+        indices = [{path: tuple(shape) for path, shape in shapes[key].items()}
+                   for key in ('gt', 'available', 'precondition')]
+        return cls(*[TaskIndex.from_shapes(index) for index in indices])
+
+
+def build_packed_layout(compiled_flow, tasks) -> PackedLayout:
+    """
+    :param compiled_flow: The compiled flow.
+    :param tasks: dict from full path to the leaf task, as returned by `TaskFlow.get_all_children`.
+    :return: The packed layout, with the per-sample shapes taken from the first sample of the labels of the tasks.
+    """
+    from dnn_cool.modules import MaskEvaluator
+
+    first_sample = {'_availability': {}}
+    for path in compiled_flow.get_condition_paths():
+        first_sample[path] = torch.as_tensor(tasks[path].get_labels()[:1]).bool()
+    for path in compiled_flow.get_paths():
+        task = tasks[path]
+        available = task.get_available_func()(task.get_labels()[:1])
+        first_sample['_availability'][path] = torch.as_tensor(available)
+
+    mask_evaluator = MaskEvaluator(first_sample)
+    precondition_shapes = {}
+    for leaf in compiled_flow.leaves:
+        precondition_shapes[leaf.path] = tuple(mask_evaluator.to_mask(leaf.precondition).shape[1:])
+    gt_shapes = {path: tuple(first_sample[path].shape[1:]) for path in compiled_flow.get_condition_paths()}
+    available_shapes = {path: tuple(value.shape[1:]) for path, value in first_sample['_availability'].items()}
+    return PackedLayout(TaskIndex.from_shapes(gt_shapes),
+                        TaskIndex.from_shapes(available_shapes),
+                        TaskIndex.from_shapes(precondition_shapes))
+
+
+class PackedMasks(Mapping):
+    """
+    Read-only dict view over a packed bool matrix.
+    """
+
+    def __init__(self, packed, task_index: TaskIndex):
+        self.packed = packed
+        self.task_index = task_index
+
+    def __getitem__(self, path):
+        if path not in self.task_index:
+            raise KeyError(path)
+        return self.task_index.unpack(self.packed, path)
+
+    def __iter__(self):
+        return iter(self.task_index)
+
+    def __len__(self):
+        return len(self.task_index)
+
+
+class PackedGt(dict):
+    """
+    The ground truth given to a `TaskFlowModule`, packed into three bool matrices. The dict itself holds only the
+    packed matrices (under `_packed_gt`, `_packed_availability` and `_packed_preconditions`), so collation, device
+    transfer and scattering move three tensors, regardless of the number of tasks. When a layout is attached, the gt of a task can be read by its path and
+    the availability through `gt['_availability'][path]`, as views into the packed matrices.
+    """
+
+    def __init__(self, packed=(), layout: PackedLayout = None):
+        super().__init__(packed)
+        self.layout = layout
+
+    def __getitem__(self, key):
+        if dict.__contains__(self, key) or self.layout is None:
+            return super().__getitem__(key)
+        if key == '_availability':
+            return PackedMasks(super().__getitem__(PACKED_AVAILABILITY_KEY), self.layout.available_index)
+        if key not in self.layout.gt_index:
+            raise KeyError(key)
+        return self.layout.gt_index.unpack(super().__getitem__(PACKED_GT_KEY), key)
+
+    def __contains__(self, key):
+        if dict.__contains__(self, key):
+            return True
+        if self.layout is None:
+            return False
+        return key == '_availability' or key in self.layout.gt_index
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def get_preconditions(self) -> Optional[PackedMasks]:
+        """
+        :return: The precomputed precondition masks of all tasks, if they are packed in this gt, otherwise `None`.
+        """
+        if self.layout is None or not dict.__contains__(self, PACKED_GT_PRECONDITIONS_KEY):
+            return None
+        return PackedMasks(super().__getitem__(PACKED_GT_PRECONDITIONS_KEY), self.layout.precondition_index)
+
+
+def is_packed_gt(gt):
+    return isinstance(gt, dict) and dict.__contains__(gt, PACKED_GT_KEY)
+
+
+def to_sample_mask(precondition):
+    """
+    :return: 1D bool mask, which tells whether a sample satisfies the precondition for at least one of its values.
+    """
+    axes = tuple(range(1, len(precondition.shape)))
+    if len(axes) > 0:
+        return precondition.sum(axis=axes) > 0
+    return precondition
+
+
+def get_nonempty_tasks(outputs, paths):
+    """
+    Finds which tasks have at least one sample satisfying their precondition, from the packed (batch x tasks)
+    precondition matrix in the outputs, with a single reduction (and device synchronization) for all tasks.
+    :param outputs: The outputs of a `TaskFlowModule` (tensors or numpy arrays).
+    :param paths: The paths of the tasks, in the order of the columns of the packed matrix.
+    :return: list of bools, one for every path, or `None` if the outputs have no packed preconditions.
+    """
+    preconditions = outputs.get(PACKED_PRECONDITIONS_KEY)
+    if preconditions is None or preconditions.shape[-1] != len(paths):
+        return None
+    nonempty = preconditions.any(0)
+    return nonempty.tolist()
@@ -1,8 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from time import time
 from typing import Union, Iterable
 
+import pandas as pd
+from tqdm import tqdm
+
 from dnn_cool.converters import Values, Converters
 from dnn_cool.runner import DnnCoolSupervisedRunner
+from dnn_cool.storage import ColumnStore, ColumnCache, to_numpy, get_column_fingerprint, get_files_fingerprint
 from dnn_cool.task_flow import TaskFlow
 
 
@@ -18,43 +24,168 @@ def assert_col_in_df(col, df):
             assert col_s in df, not_found_error_message(col_s, df)
 
 
-def create_values(df, output_col, converters):
+def create_values(df, output_col, converters, store=None):
+    """
+    :param store: Optional `ColumnStore` or `ColumnCache`, from which the converted values are read if they are saved
+    there, or where they are saved after the conversion otherwise.
+    """
     values_type = converters.type.guess(df, output_col)
-    values = converters.values.to_values(df, output_col, values_type)
+    if store is None:
+        return converters.values.to_values(df, output_col, values_type), values_type
+    converter = converters.values.get_converter(output_col, values_type)
+    # The fingerprint is computed before the conversion, with the state of the converter before it.
+    fingerprint = get_column_fingerprint(df, output_col, values_type, converter)
+    key = store.get_key(df, output_col, values_type, converter, fingerprint)
+    values = store.get(key, output_col, len(df), converter, fingerprint)
+    if values is None:
+        values = store.put(key, converter, converters.values.to_values(df, output_col, values_type), fingerprint)
     return values, values_type
 
 
-def create_leaf_task(df, col, converters):
-    values, values_type = create_values(df, col, converters)
+def convert_columns(df, cols, converters, store=None, num_workers=0, timings=None, verbose=False):
+    """
+    Converts the columns of the dataframe to values. With `num_workers > 0`, the columns are converted concurrently in
+    a thread pool (the converters work on whole numpy arrays, which release the GIL). Columns with a stateful converter
+    (one with a `state_dict`) are converted in the main thread in the order of `cols`, because the converter of a type
+    is shared by all its columns and the column which fits it first must not depend on the scheduling of the threads.
+    :param timings: Optional dict, in which the conversion time (in seconds) of every column is saved.
+    :param verbose: Whether to show the progress and the conversion time of every column.
+    :return: list of `(values, values_type)` pairs, in the order of `cols`.
+    """
+    def convert(col):
+        start = time()
+        res = create_values(df, col, converters, store)
+        return res, time() - start
+
+    def is_stateful(col):
+        converter = converters.values.get_converter(col, converters.type.guess(df, col))
+        return hasattr(converter, 'state_dict')
+
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        futures = {}
+        if num_workers > 0:
+            futures = {col: executor.submit(convert, col) for col in cols if not is_stateful(col)}
+
+        res = []
+        for col in tqdm(cols, desc='Converting columns', disable=not verbose):
+            converted, seconds = futures[col].result() if col in futures else convert(col)
+            res.append(converted)
+            if timings is not None:
+                timings[col] = seconds
+            if verbose:
+                tqdm.write(f'Converted column "{col}" in {seconds:.3f}s.')
+    return res
+
+
+def create_leaf_task(df, col, converters, store=None):
+    values, values_type = create_values(df, col, converters, store)
     task = converters.task.to_task(col, values_type, values.values[0])
     return task
 
 
-def create_leaf_tasks(df, col, converters):
-    if isinstance(col, str):
-        return [create_leaf_task(df, col, converters)]
-
+def create_leaf_tasks(df, col, converters, store=None, num_workers=0, timings=None, verbose=False):
+    cols = [col] if isinstance(col, str) else list(col)
+    converted = convert_columns(df, cols, converters, store, num_workers, timings, verbose)
+    # The tasks are created in the order of the columns, so that the initialization of their modules is reproducible.
     res = []
-    for col_s in col:
-        res.append(create_leaf_task(df, col_s, converters))
+    for col_s, (values, values_type) in zip(cols, converted):
+        res.append(converters.task.to_task(col_s, values_type, values.values[0]))
     return res
 
 
-def read_inputs(df, input_col, converters):
+def read_inputs(df, input_col, converters, store=None, num_workers=0, timings=None, verbose=False):
     if isinstance(input_col, str):
-        values, values_type = create_values(df, input_col, converters)
+        values, values_type = convert_columns(df, [input_col], converters, store, num_workers, timings, verbose)[0]
         return values
 
     keys = []
     values = []
-    for col_s in input_col:
-        vals, _ = create_values(df, col_s, converters)
-        keys.extend(keys)
-        values.extend(values)
+    for vals, _ in convert_columns(df, list(input_col), converters, store, num_workers, timings, verbose):
+        keys.extend(vals.keys)
+        values.extend(vals.values)
 
     return Values(keys=keys, values=values)
 
 
+def read_chunks(paths, cols, chunksize):
+    for path in paths:
+        path = Path(path)
+        if path.suffix == '.parquet':
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=cols):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, usecols=cols, chunksize=chunksize)
+
+
+def fit_converters_on_chunks(paths, cols, converters, chunksize):
+    """
+    :return: The guessed types of the columns (from the first chunk) and the total number of rows.
+    """
+    types = {}
+    n = 0
+    for chunk in read_chunks(paths, cols, chunksize):
+        if n == 0:
+            types = {col: converters.type.guess(chunk, col) for col in cols}
+        n += len(chunk)
+        for col in cols:
+            converter = converters.values.get_converter(col, types[col])
+            if hasattr(converter, 'partial_fit'):
+                converter.partial_fit(chunk[col])
+    return types, n
+
+
+def convert_chunks(paths, cols, converters, store, types, n, chunksize, timings=None, verbose=False):
+    """
+    Converts the columns chunk by chunk into the store.
+    :return: dict from column to its converted `Values`.
+    """
+    columns = {}
+    raw_chunks = {}
+    fingerprints = {col: get_files_fingerprint(paths, col, types[col], converters.values.get_converter(col, types[col]))
+                    for col in cols}
+    pending = [col for col in cols if not store.has_column(col, n, fingerprints[col])]
+    times = {col: 0. for col in pending}
+    start = 0
+    chunks = read_chunks(paths, pending, chunksize) if len(pending) > 0 else []
+    for chunk in tqdm(chunks, total=-(-n // chunksize), desc='Converting chunks', disable=not verbose):
+        for col in pending:
+            if col in raw_chunks:
+                raw_chunks[col].append(chunk[col])
+                continue
+            chunk_start = time()
+            values = converters.values.to_values(chunk, col, types[col]).values[0]
+            if col not in columns and not store.can_store(values):
+                raw_chunks[col] = [chunk[col]]
+                continue
+            values = to_numpy(values)
+            if col not in columns:
+                columns[col] = store.create_column(col, (n, *values.shape[1:]), values.dtype)
+            columns[col][start:start + len(chunk)] = values
+            times[col] += time() - chunk_start
+        start += len(chunk)
+
+    res = {}
+    for col, column in columns.items():
+        store.commit_column(col, column, fingerprints[col])
+        store.save_state(col, converters.values.get_converter(col, types[col]))
+    for col in cols:
+        if col in raw_chunks:
+            convert_start = time()
+            res[col] = converters.values.to_values(pd.concat(raw_chunks.pop(col)).to_frame(), col, types[col])
+            times[col] += time() - convert_start
+        else:
+            if col not in columns:
+                store.load_state(col, converters.values.get_converter(col, types[col]))
+            res[col] = store.read_values([col])
+    if timings is not None:
+        timings.update(times)
+    if verbose:
+        for col, seconds in times.items():
+            tqdm.write(f'Converted column "{col}" in {seconds:.3f}s.')
+    return res
+
+
 class UsedTasksTracer:
 
     def __init__(self):
@@ -83,15 +214,93 @@ class Project:
                  input_col: Union[str, Iterable[str]],
                  output_col: Union[str, Iterable[str]],
                  project_dir: Union[str, Path],
-                 converters: Converters = None):
-        self.df = df
+                 converters: Converters = None,
+                 storage_dir: Union[str, Path] = None,
+                 num_workers: int = 0,
+                 verbose: bool = False,
+                 cache_columns: bool = False,
+                 lazy: bool = False):
+        """
+        :param storage_dir: Optional directory of a `ColumnStore`. If given, the converted inputs and labels are saved
+        there as memory-mapped columns and the columns which are already saved (with the same values and converters)
+        are read from it instead of being converted again.
+        :param cache_columns: When `True`, the converted columns are kept in a `ColumnCache` (in `storage_dir`, or in
+        `project_dir/column_cache` by default) under a hash of their contents and converters, so only the columns which
+        changed are converted again.
+        :param num_workers: The number of threads, in which the columns are converted. When 0, the columns are
+        converted one by one.
+        :param verbose: Whether to report the progress and the conversion time of every column. The times are
+        available in `conversion_times` either way.
+        :param lazy: When `True`, the columns are not converted in the constructor - the inputs and the output columns
+        which a flow uses are converted when the flow is added, and the other output columns are never converted.
+        Once all flows are added, the dataframe can be released with `release_df`.
+        """
         assert_col_in_df(input_col, df)
         assert_col_in_df(output_col, df)
 
+        store = ColumnStore(storage_dir) if storage_dir is not None else None
+        if cache_columns:
+            store = ColumnCache(Path(project_dir) / 'column_cache' if storage_dir is None else storage_dir)
+        conversion_times = {}
+        if lazy:
+            self._init_tasks(df, project_dir, converters, None, [], store, conversion_times)
+        else:
+            inputs = read_inputs(df, input_col, converters, store, num_workers, conversion_times, verbose)
+            leaf_tasks = create_leaf_tasks(df, output_col, converters, store, num_workers, conversion_times, verbose)
+            self._init_tasks(df, project_dir, converters, inputs, leaf_tasks, store, conversion_times)
+        self._input_col = input_col
+        self._pending_cols = [] if not lazy else ([output_col] if isinstance(output_col, str) else list(output_col))
+        self._num_workers = num_workers
+        self._verbose = verbose
+
+    @classmethod
+    def from_files(cls, paths,
+                   input_col: Union[str, Iterable[str]],
+                   output_col: Union[str, Iterable[str]],
+                   project_dir: Union[str, Path],
+                   converters: Converters = None,
+                   storage_dir: Union[str, Path] = None,
+                   chunksize: int = 100000,
+                   verbose: bool = False):
+        """
+        Creates a project from CSV or Parquet files, which may not fit in memory. The files are read in chunks of
+        `chunksize` rows: a first pass guesses the types of the columns (from the first chunk) and fits the stateful
+        converters, which have a `partial_fit` method (like `MultiLabelValuesConverter`), and a second pass converts
+        the chunks into the memory-mapped columns of a `ColumnStore`. Columns which cannot be memory-mapped (for example
+        image paths converted to `LazyImages`) are converted at once, after the chunks are read.
+        :param paths: A path, or a list of paths, to `.csv` or `.parquet` files with the same columns.
+        :param storage_dir: The directory of the `ColumnStore`, by default `project_dir/columns`. Columns which are
+        already saved there are not converted again.
+        :param chunksize: The number of rows in a chunk.
+        """
+        paths = [paths] if isinstance(paths, (str, Path)) else list(paths)
+        input_cols = [input_col] if isinstance(input_col, str) else list(input_col)
+        output_cols = [output_col] if isinstance(output_col, str) else list(output_col)
+        cols = input_cols + output_cols
+        store = ColumnStore(Path(project_dir) / 'columns' if storage_dir is None else storage_dir)
+
+        types, n = fit_converters_on_chunks(paths, cols, converters, chunksize)
+        conversion_times = {}
+        values = convert_chunks(paths, cols, converters, store, types, n, chunksize, conversion_times, verbose)
+
+        inputs = values[input_cols[0]]
+        if not isinstance(input_col, str):
+            inputs = Values(input_cols, [values[col].values[0] for col in input_cols])
+        leaf_tasks = [converters.task.to_task(col, types[col], values[col].values[0]) for col in output_cols]
+        # The runner only needs the number of rows of the dataframe, which the empty frame has without any memory.
+        df = pd.DataFrame(index=pd.RangeIndex(n))
+        project = cls.__new__(cls)
+        project._init_tasks(df, project_dir, converters, inputs, leaf_tasks, store, conversion_times)
+        return project
+
+    def _init_tasks(self, df, project_dir, converters, inputs, leaf_tasks, store, conversion_times):
+        self.df = df
         self.project_dir = Path(project_dir)
         self.project_dir.mkdir(exist_ok=True)
-        self.inputs = read_inputs(df, input_col, converters)
-        self.leaf_tasks = create_leaf_tasks(df, output_col, converters)
+        self.store = store
+        self.conversion_times = conversion_times
+        self.inputs = inputs
+        self.leaf_tasks = leaf_tasks
         self.flow_tasks = []
 
         self._name_to_task = {}
@@ -101,6 +310,35 @@ class Project:
         if converters is None:
             converters = Converters()
         self.converters = converters
+        self._pending_cols = []
+
+    def convert_pending(self, task_names):
+        """
+        Converts the inputs (if they are not converted yet) and the output columns with the given names, which are not
+        converted yet, and creates their leaf tasks. Used by lazy projects.
+        """
+        cols = [col for col in self._pending_cols if col in task_names]
+        if self.inputs is None:
+            self.inputs = read_inputs(self.df, self._input_col, self.converters, self.store, self._num_workers,
+                                      self.conversion_times, self._verbose)
+        if len(cols) == 0:
+            return
+        leaf_tasks = create_leaf_tasks(self.df, cols, self.converters, self.store, self._num_workers,
+                                       self.conversion_times, self._verbose)
+        for leaf_task in leaf_tasks:
+            self.leaf_tasks.append(leaf_task)
+            self._name_to_task[leaf_task.get_name()] = leaf_task
+        self._pending_cols = [col for col in self._pending_cols if col not in cols]
+
+    def release_df(self):
+        """
+        Releases the raw dataframe, keeping only its number of rows, which is all the runner needs. The output columns,
+        which are not converted yet, cannot be used in flows afterwards.
+        """
+        if self.inputs is None:
+            self.convert_pending([])
+        self.df = pd.DataFrame(index=pd.RangeIndex(len(self.df)))
+        self._pending_cols = []
 
     def add_task_flow(self, task_flow: TaskFlow):
         self.flow_tasks.append(task_flow)
@@ -116,6 +354,7 @@ class Project:
         flow_name = flow_func.__name__ if flow_name is None else flow_name
         used_tasks_tracer = UsedTasksTracer()
         flow_func(used_tasks_tracer, UsedTasksTracer(), UsedTasksTracer())
+        self.convert_pending(used_tasks_tracer.used_tasks)
         used_tasks = []
         for used_task_name in used_tasks_tracer.used_tasks:
             task = self._name_to_task.get(used_task_name, None)
@@ -132,5 +371,5 @@ class Project:
     def get_task(self, task_name):
         return self._name_to_task[task_name]
 
-    def runner(self, model, early_stop=True, runner_name=None, train_test_val_indices=None):
-        return DnnCoolSupervisedRunner(self, model, early_stop, runner_name, train_test_val_indices)
+    def runner(self, model, early_stop=True, runner_name=None, train_test_val_indices=None, persist_tables=False):
+        return DnnCoolSupervisedRunner(self, model, early_stop, runner_name, train_test_val_indices, persist_tables)
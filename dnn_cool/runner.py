@@ -14,6 +14,8 @@ from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch.utils.data import DataLoader, Dataset
 
 from dnn_cool.catalyst_utils import InterpretationCallback, TensorboardConverters
+from dnn_cool.datasets import batched_loader, FlowCollator, FlowBatch
+from dnn_cool.feature_cache import cache_features
 from dnn_cool.utils import TransformedSubset, train_test_val_split
 
 
@@ -57,8 +59,11 @@ class InferDictCallback(InferCallback):
 
 class DnnCoolSupervisedRunner(SupervisedRunner):
 
-    def __init__(self, project, model, early_stop: bool = True, runner_name=None, train_test_val_indices=None):
+    def __init__(self, project, model, early_stop: bool = True, runner_name=None, train_test_val_indices=None,
+                 persist_tables: bool = False):
         self.task_flow = project.get_full_flow()
+        # When set, the precomputed gt tables of the dataset are saved next to the split files and reused.
+        self.persist_tables = persist_tables
 
         self.default_criterion = self.task_flow.get_loss()
         self.default_callbacks = self.default_criterion.catalyst_callbacks()
@@ -110,6 +115,26 @@ class DnnCoolSupervisedRunner(SupervisedRunner):
         kwargs['callbacks'] = kwargs.get('callbacks', default_callbacks)
         super().train(*args, **kwargs)
 
+    def train_heads(self, backbone: nn.Module, flow_module: nn.Module, *args, **kwargs):
+        """
+        Trains only the heads of the flow, from the features of the frozen backbone, which are computed once and cached
+        under `project_dir/feature_cache` (see `cache_features`). The heads are trained in place, so a model which
+        contains `flow_module` gets the trained heads. The checkpoints are saved in the logdir with suffix `_heads`.
+        :param backbone: The frozen backbone, which returns the dict of features, given to the flow module.
+        :param flow_module: The `TaskFlowModule` of the full flow.
+        :param args: Other arguments for `train`.
+        :param kwargs: Other keyword arguments for `train`. `features_batch_size` and `features_dataset_key` are given
+        to `cache_features`.
+        """
+        features = cache_features(backbone, self.task_flow.get_dataset(), self.project_dir / 'feature_cache',
+                                  batch_size=kwargs.pop('features_batch_size', 256),
+                                  dataset_key=kwargs.pop('features_dataset_key', None))
+        kwargs['model'] = flow_module
+        kwargs['logdir'] = kwargs.get('logdir', f'{self.default_logdir}_heads')
+        if 'loaders' not in kwargs:
+            datasets, kwargs['loaders'] = self.get_default_loaders(inputs=features)
+        self.train(*args, **kwargs)
+
     def infer(self, *args, **kwargs):
         default_datasets, default_loaders = self.get_default_loaders(shuffle_train=False)
         kwargs['loaders'] = kwargs.get('loaders', default_loaders)
@@ -142,20 +167,40 @@ class DnnCoolSupervisedRunner(SupervisedRunner):
             tensorboard_loggers=self.tensor_loggers,
             datasets=kwargs.get('datasets', self.get_default_datasets(**kwargs))
         )
-        interpretation_callback = InterpretationCallback(self.task_flow, tensorboard_converters)
+        interpretation_callback = InterpretationCallback(self.task_flow, tensorboard_converters, self.default_criterion)
         return interpretation_callback
 
-    def get_default_loaders(self, shuffle_train=True, collator=None) -> Tuple[Dict[str, Dataset], Dict[str, DataLoader]]:
-        datasets = self.get_default_datasets()
+    def get_default_loaders(self, shuffle_train=True, collator=None, batched=False,
+                            inputs=None) -> Tuple[Dict[str, Dataset], Dict[str, DataLoader]]:
+        """
+        :param shuffle_train: Whether to shuffle the train loader. When `False`, the loaders are prepared for inference.
+        :param collator: Optional `collate_fn` for the loaders, by default `FlowCollator`.
+        :param batched: When `True`, every batch is fetched with a single indexing of the dataset with the array of its
+        indices (see `batched_loader`), instead of fetching and collating the samples one by one. Then `collator` is not
+        used.
+        :param inputs: Optional inputs of the datasets, which replace the inputs of the project (for example cached
+        features).
+        """
+        datasets = self.get_default_datasets(inputs=inputs)
         train_dataset = datasets['train']
         val_dataset = datasets['valid']
         test_dataset = datasets['test']
-        train_loader = DataLoader(train_dataset, batch_size=32 * torch.cuda.device_count(), shuffle=shuffle_train,
-                                  collate_fn=collator)
-        val_loader = DataLoader(val_dataset, batch_size=32 * torch.cuda.device_count(), shuffle=False,
-                                collate_fn=collator)
-        test_loader = DataLoader(test_dataset, batch_size=32 * torch.cuda.device_count(), shuffle=False,
-                                 collate_fn=collator)
+        batch_size = 32 * torch.cuda.device_count()
+        # The batches are pinned by the DataLoader, in the main process.
+        pin_memory = torch.cuda.is_available()
+        if collator is None:
+            collator = FlowCollator()
+        if batched:
+            train_loader = batched_loader(train_dataset, batch_size, shuffle=shuffle_train, pin_memory=pin_memory)
+            val_loader = batched_loader(val_dataset, batch_size, shuffle=False, pin_memory=pin_memory)
+            test_loader = batched_loader(test_dataset, batch_size, shuffle=False, pin_memory=pin_memory)
+        else:
+            train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle_train, collate_fn=collator,
+                                      pin_memory=pin_memory)
+            val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, collate_fn=collator,
+                                    pin_memory=pin_memory)
+            test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=False, collate_fn=collator,
+                                     pin_memory=pin_memory)
         loaders = OrderedDict({
             'train': train_loader,
             'valid': val_loader,
@@ -170,8 +215,12 @@ class DnnCoolSupervisedRunner(SupervisedRunner):
             loaders['test'] = test_loader
         return datasets, loaders
 
-    def get_default_datasets(self, **kwargs) -> Dict[str, Dataset]:
-        dataset = self.task_flow.get_dataset()
+    def get_default_datasets(self, inputs=None, **kwargs) -> Dict[str, Dataset]:
+        tables_path = None
+        if self.persist_tables:
+            (self.project_dir / self.default_logdir).mkdir(parents=True, exist_ok=True)
+            tables_path = self.project_dir / self.default_logdir / 'flow_tables.pt'
+        dataset = self.task_flow.get_dataset(tables_path=tables_path, inputs=inputs)
         if self.train_test_val_indices is None:
             raise ValueError(f'You must supply either a `loaders` parameter, or give `train_test_val_indices` via'
                              f'constructor.')
@@ -189,11 +238,17 @@ class DnnCoolSupervisedRunner(SupervisedRunner):
         datasets['infer'] = datasets[kwargs.get('target_loader', 'valid')]
         return datasets
 
-    def batch_to_device(self, batch, device) -> Dict[str, torch.Tensor]:
+    def _batch2device(self, batch, device):
+        # The small tensors of a collated flow batch are moved with a single copy.
+        if isinstance(batch, FlowBatch):
+            batch = batch.to(device)
         return super()._batch2device(batch, device)
 
+    def batch_to_device(self, batch, device) -> Dict[str, torch.Tensor]:
+        return self._batch2device(batch, device)
+
     def batch_to_model_device(self, batch) -> Dict[str, torch.Tensor]:
-        return super()._batch2device(batch, next(self.model.parameters()).device)
+        return self._batch2device(batch, next(self.model.parameters()).device)
 
     def best(self) -> nn.Module:
         model = self.model
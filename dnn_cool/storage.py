@@ -0,0 +1,279 @@
+import functools
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+from pathlib import Path
+from typing import Union, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+import torch
+
+from dnn_cool.converters import Values
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def to_numpy(values):
+    if isinstance(values, torch.Tensor):
+        return values.detach().cpu().numpy()
+    return np.asarray(values)
+
+
+def to_file_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name) + '.npy'
+
+
+class ColumnStore:
+    """
+    Directory of converted columns (inputs and labels), every column saved as a separate `.npy` file which is read as a
+    memory-mapped array, together with a small json manifest with the file, dtype, shape and fingerprint of every
+    column. Reading a column does not load it in memory - only the rows which are indexed are read from disk, so
+    datasets larger than the RAM can be used and the columns are converted only once. A saved column is reused only if
+    its fingerprint (of the raw values and the converter, see `get_column_fingerprint`) did not change.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.manifest = self.read_manifest()
+        self._lock = threading.Lock()
+
+    def read_manifest(self):
+        manifest_path = self.directory / MANIFEST_FILE
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+
+    def write_manifest(self):
+        tmp_path = self.directory / f'{MANIFEST_FILE}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp_path, self.directory / MANIFEST_FILE)
+
+    def has_column(self, name, n_rows=None, fingerprint=None):
+        """
+        :param name: The name of the column.
+        :param n_rows: If given, the column is considered present only if it has exactly this number of rows.
+        :param fingerprint: If given, the column is considered present only if it was saved with this fingerprint.
+        """
+        if name not in self.manifest or not (self.directory / self.manifest[name]['file']).exists():
+            return False
+        if fingerprint is not None and self.manifest[name].get('fingerprint') != fingerprint:
+            return False
+        return n_rows is None or self.manifest[name]['shape'][0] == n_rows
+
+    def can_store(self, values):
+        return isinstance(values, (torch.Tensor, np.ndarray)) and to_numpy(values).dtype != object
+
+    def create_column(self, name, shape, dtype) -> np.memmap:
+        """
+        Creates an empty column, which can be filled in chunks, without having all of it in memory. The column is
+        added to the manifest when `commit_column` is called.
+        :return: Writable memory-mapped array.
+        """
+        tmp_path = self.directory / f'{to_file_name(name)}.tmp'
+        return np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.dtype(dtype), shape=tuple(shape))
+
+    def commit_column(self, name, column: np.memmap, fingerprint=None):
+        """
+        :param fingerprint: The fingerprint of the raw values and the converter of the column, saved in the manifest.
+        """
+        column.flush()
+        file_name = to_file_name(name)
+        os.replace(self.directory / f'{file_name}.tmp', self.directory / file_name)
+        # Columns may be committed from several threads (see `Project`).
+        with self._lock:
+            self.manifest[name] = {
+                'file': file_name,
+                'dtype': column.dtype.str,
+                'shape': list(column.shape),
+                'fingerprint': fingerprint,
+            }
+            self.write_manifest()
+
+    def write_column(self, name, values, fingerprint=None):
+        """
+        Saves the converted values of a column.
+        :param name: The name of the column.
+        :param values: torch tensor or numpy array.
+        :param fingerprint: The fingerprint of the raw values and the converter of the column.
+        :return: The saved column, memory-mapped.
+        """
+        values = to_numpy(values)
+        column = self.create_column(name, values.shape, values.dtype)
+        column[...] = values
+        self.commit_column(name, column, fingerprint)
+        return self.read_column(name)
+
+    def read_column(self, name) -> np.ndarray:
+        """
+        :return: The column as a copy-on-write memory-mapped array - torch tensors created from it with
+        `torch.from_numpy` share its memory and modifying them never changes the file.
+        """
+        entry = self.manifest[name]
+        column = np.load(self.directory / entry['file'], mmap_mode='c')
+        assert list(column.shape) == entry['shape'] and column.dtype.str == entry['dtype'], \
+            f'The file of column "{name}" does not match the manifest in {self.directory}.'
+        return column
+
+    def get_state_path(self, name):
+        return self.directory / f'{to_file_name(name)}.state.pkl'
+
+    def save_state(self, name, converter):
+        """
+        Saves the state of a stateful converter (for example the fit binarizer of `MultiLabelValuesConverter`) together
+        with the column, so that it is restored when the column is read again.
+        """
+        if hasattr(converter, 'state_dict') and hasattr(converter, 'load_state_dict'):
+            with open(self.get_state_path(name), 'wb') as f:
+                pickle.dump(converter.state_dict(), f)
+
+    def load_state(self, name, converter):
+        state_path = self.get_state_path(name)
+        if converter is not None and state_path.exists():
+            with open(state_path, 'rb') as f:
+                converter.load_state_dict(pickle.load(f))
+
+    def read_values(self, keys: Iterable[str]) -> Values:
+        keys = list(keys)
+        return Values(keys, [self.read_column(key) for key in keys])
+
+    def store_values(self, values: Values, fingerprint=None) -> Values:
+        """
+        Saves all columns of the given values, which can be memory-mapped.
+        :return: The values, with the saved columns replaced by their memory-mapped versions.
+        """
+        res = []
+        for key, value in zip(values.keys, values.values):
+            res.append(self.write_column(key, value, fingerprint) if self.can_store(value) else value)
+        return Values(values.keys, res)
+
+    def get_key(self, df, col, values_type, converter, fingerprint=None):
+        return col
+
+    def get(self, key, col, n_rows, converter, fingerprint=None) -> Optional[Values]:
+        """
+        :return: The saved values of the column, if it is saved with `n_rows` rows and the given fingerprint, otherwise
+        `None`. The saved state of the converter is restored.
+        """
+        if not self.has_column(key, n_rows, fingerprint):
+            return None
+        self.load_state(key, converter)
+        return Values([col], [self.read_column(key)])
+
+    def put(self, key, converter, values: Values, fingerprint=None) -> Values:
+        values = self.store_values(values, fingerprint)
+        if self.has_column(key):
+            self.save_state(key, converter)
+        return values
+
+    def __contains__(self, name):
+        return self.has_column(name)
+
+    def __repr__(self):
+        return f'ColumnStore({str(self.directory)!r}, columns={list(self.manifest)})'
+
+
+def get_value_fingerprint(value, seen) -> bytes:
+    try:
+        return pickle.dumps(value)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        pass
+    # Values which cannot be pickled (for example local functions) are fingerprinted piece by piece.
+    if isinstance(value, dict):
+        return b''.join(repr(key).encode() + get_value_fingerprint(item, seen) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return b''.join(get_value_fingerprint(item, seen) for item in value)
+    if callable(value):
+        return get_converter_fingerprint(value, seen)
+    return repr(value).encode()
+
+
+def get_converter_fingerprint(converter, seen=None) -> bytes:
+    """
+    :return: Bytes which identify the converter - its function (including its code and closure) or class, and its full
+    configuration: the attributes of the object (including its state), or the arguments of a `functools.partial`.
+    """
+    if converter is None:
+        return b''
+    # Recursive functions and objects, which reference themselves, are fingerprinted only once.
+    seen = set() if seen is None else seen
+    if id(converter) in seen:
+        return b'<recursion>'
+    seen.add(id(converter))
+    if isinstance(converter, functools.partial):
+        return b'partial:' + get_converter_fingerprint(converter.func, seen) + \
+               get_value_fingerprint((converter.args, converter.keywords), seen)
+    code = getattr(converter, '__code__', None)
+    if code is not None:
+        fingerprint = f'{converter.__module__}.{converter.__qualname__}'.encode()
+        fingerprint += code.co_code + repr(code.co_consts).encode()
+        # Values captured by the closure are a part of the configuration, except mutable containers (like counters or
+        # caches), which change between calls.
+        closure = [cell.cell_contents for cell in converter.__closure__ or ()]
+        closure = [value for value in closure if not isinstance(value, (list, dict, set))]
+        fingerprint += get_value_fingerprint(closure, seen)
+        return fingerprint + get_value_fingerprint(getattr(converter, '__self__', None), seen)
+    fingerprint = f'{type(converter).__module__}.{type(converter).__qualname__}'.encode()
+    return fingerprint + get_value_fingerprint(getattr(converter, '__dict__', None), seen)
+
+
+def get_column_fingerprint(df, col, values_type, converter) -> str:
+    """
+    :return: A hash of the raw values of the column, its type and the converter (with its state).
+    """
+    digest = hashlib.sha256(f'{col}:{values_type}:{df[col].dtype}'.encode())
+    digest.update(pd.util.hash_pandas_object(df[col], index=False).values.tobytes())
+    digest.update(get_converter_fingerprint(converter))
+    return digest.hexdigest()
+
+
+def get_files_fingerprint(paths, col, values_type, converter) -> str:
+    """
+    :return: A hash of the files (their paths, sizes and modification times), from which the column is read in chunks,
+    its type and the converter (with its state, after it is fit on the chunks).
+    """
+    digest = hashlib.sha256(f'{col}:{values_type}'.encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f'{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    digest.update(get_converter_fingerprint(converter))
+    return digest.hexdigest()
+
+
+class ColumnCache:
+    """
+    Content-addressed cache of converted columns: every column is saved in a `ColumnStore` under a key, which is a hash
+    of the contents of the column, its type and the converter (with its state). A column is converted again only when
+    one of them changes. The state of a stateful converter after the conversion (for example the fit binarizer of
+    `MultiLabelValuesConverter`) is saved together with the column and restored when the column is read from the cache.
+    Columns which cannot be memory-mapped are always converted.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.store = ColumnStore(directory)
+
+    def get_key(self, df, col, values_type, converter, fingerprint=None) -> str:
+        if fingerprint is None:
+            fingerprint = get_column_fingerprint(df, col, values_type, converter)
+        return f'{col}-{fingerprint[:16]}'
+
+    def get(self, key, col, n_rows, converter, fingerprint=None) -> Optional[Values]:
+        if not self.store.has_column(key, n_rows, fingerprint):
+            return None
+        self.store.load_state(key, converter)
+        return Values([col], [self.store.read_column(key)])
+
+    def put(self, key, converter, values: Values, fingerprint=None) -> Values:
+        """
+        :param key: The key of the column, computed before the conversion (with the state of the converter before it).
+        """
+        if not self.store.can_store(values.values[0]):
+            return values
+        self.store.save_state(key, converter)
+        return Values(values.keys, [self.store.write_column(key, values.values[0], fingerprint)])
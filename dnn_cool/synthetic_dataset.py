@@ -1,4 +1,7 @@
+import json
+import os
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from functools import partial
 from pathlib import Path
 
@@ -159,6 +162,15 @@ def generate_sample():
     return generators[choice]()
 
 
+def add_missing_values(df):
+    """
+    Marks the first samples as missing in the `camera_blocked` column. The bool column is converted to an object
+    column first, since a bool column cannot hold NaN.
+    """
+    df['camera_blocked'] = df['camera_blocked'].astype(object)
+    df.loc[:5, 'camera_blocked'] = np.nan
+
+
 def create_df_and_images_tensor(n=int(1e4), cache_file=Path('dnn_cool_synthetic_dataset.pkl')):
     if cache_file.exists():
         return torch.load(cache_file)
@@ -173,12 +185,84 @@ def create_df_and_images_tensor(n=int(1e4), cache_file=Path('dnn_cool_synthetic_
 
     df = pd.DataFrame(rows)
     df['img'] = names
-    df.loc[:5, 'camera_blocked'] = np.nan
+    add_missing_values(df)
     res = torch.stack(imgs, dim=0).float() / 255., df
     torch.save(res, cache_file)
     return res
 
 
+SYNTHETIC_MANIFEST_FILE = 'manifest.json'
+
+
+def generate_shard(images_path, shard, start, end, seed):
+    """
+    Draws the samples `start:end` into the memory-mapped images. The random state depends only on the seed and the
+    shard, so the result does not depend on the worker which draws the shard.
+    :return: The dataframe with the labels of the samples.
+    """
+    np.random.seed([seed, shard])
+    images = np.load(images_path, mmap_mode='r+')
+    rows = []
+    for i in range(start, end):
+        img, row = generate_sample()
+        images[i] = img.transpose(2, 0, 1)
+        rows.append(row)
+    images.flush()
+    df = pd.DataFrame(rows, index=pd.RangeIndex(start, end))
+    df['img'] = [f'{i}.jpg' for i in range(start, end)]
+    return df
+
+
+def create_synthetic_dataset(n, directory, shard_size=10000, num_workers=None, seed=0):
+    """
+    Generates the synthetic dataset in parallel worker processes, drawing the uint8 images directly into a
+    memory-mapped array (`images.npy`, with shape `(n, 3, 64, 64)`), so that datasets with millions of samples can be
+    generated. Every shard of `shard_size` samples is seeded with `(seed, shard)` and its labels are saved when it is
+    complete, so an interrupted generation is resumed from the incomplete shards and gives the same dataset. The
+    parameters of the generation are saved in a manifest and a directory generated with other parameters is not
+    resumed.
+    :param n: The number of samples.
+    :param directory: Where the images and the labels are saved.
+    :param shard_size: The number of samples drawn by a worker at once.
+    :param num_workers: The number of worker processes, by default the number of CPUs.
+    :param seed: The seed of the dataset.
+    :return: The memory-mapped uint8 images and the dataframe with the labels.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    images_path = directory / 'images.npy'
+    manifest_path = directory / SYNTHETIC_MANIFEST_FILE
+    manifest = {'n': n, 'shard_size': shard_size, 'seed': seed}
+    if images_path.exists():
+        # The shards of the labels are reused only if they cover the same samples, drawn with the same seed.
+        saved_manifest = None
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                saved_manifest = json.load(f)
+        if saved_manifest != manifest:
+            raise ValueError(f'{directory} was generated with {saved_manifest}, but {manifest} is requested.')
+    else:
+        np.lib.format.open_memmap(images_path, mode='w+', dtype=np.uint8, shape=(n, 3, 64, 64)).flush()
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+    shards = [(shard, start, min(start + shard_size, n)) for shard, start in enumerate(range(0, n, shard_size))]
+    labels_paths = [directory / f'labels-{shard:06d}.pkl' for shard, _, _ in shards]
+    pending = [shard for shard in shards if not labels_paths[shard[0]].exists()]
+    if len(pending) > 0:
+        with ProcessPoolExecutor(max_workers=num_workers or os.cpu_count()) as executor:
+            futures = {executor.submit(generate_shard, images_path, *shard, seed): shard for shard in pending}
+            for future in as_completed(futures):
+                labels_path = labels_paths[futures[future][0]]
+                # The labels are the marker of a complete shard, so they are written atomically.
+                future.result().to_pickle(f'{labels_path}.tmp')
+                os.replace(f'{labels_path}.tmp', labels_path)
+
+    df = pd.concat([pd.read_pickle(labels_path) for labels_path in labels_paths], sort=False)
+    add_missing_values(df)
+    return np.load(images_path, mmap_mode='r'), df
+
+
 def synthenic_dataset_preparation(n=int(1e4)):
     imgs, df = create_df_and_images_tensor(n)
     output_col = ['camera_blocked', 'door_open', 'person_present', 'door_locked',
@@ -18,6 +18,8 @@ from dnn_cool.metrics import TorchMetric, get_default_binary_metrics, \
     get_default_multilabel_classification_metrics
 from dnn_cool.missing_values import positive_values
 from dnn_cool.modules import SigmoidAndMSELoss, Identity, TaskFlowModule
+from dnn_cool.packed import build_packed_layout, PackedLayout
+from dnn_cool.tracing import trace_flow, CompiledFlow
 from dnn_cool.treelib import TreeExplainer
 
 
@@ -228,9 +230,11 @@ class TaskFlow(ITask):
             self.tasks[task.get_name()] = task
         if flow_func is not None:
             self._flow_func = flow_func
+        self._compiled_flows = {}
+        self._packed_layouts = {}
 
-    def get_loss(self):
-        return TaskFlowLoss(self)
+    def get_loss(self, masked=False):
+        return TaskFlowLoss(self, masked=masked)
 
     def get_per_sample_loss(self):
         return TaskFlowLossPerSample(self)
@@ -252,6 +256,25 @@ class TaskFlow(ITask):
             return self._flow_func
         return self.__class__.flow
 
+    def get_compiled_flow(self, prefix='') -> CompiledFlow:
+        """
+        Traces the flow function once (per prefix) and returns the static execution plan, which is shared by the
+        module, the loss, the dataset and the visitors of this flow.
+        """
+        if prefix not in self._compiled_flows:
+            self._compiled_flows[prefix] = trace_flow(self, prefix=prefix)
+        return self._compiled_flows[prefix]
+
+    def get_packed_layout(self, prefix='') -> PackedLayout:
+        """
+        Returns the layout of the packed ground truth (gt and availability matrices), which is shared by the dataset
+        and the module of this flow. The layout is built from the labels of the tasks.
+        """
+        if prefix not in self._packed_layouts:
+            compiled_flow = self.get_compiled_flow(prefix)
+            self._packed_layouts[prefix] = build_packed_layout(compiled_flow, self.get_all_children(prefix=prefix))
+        return self._packed_layouts[prefix]
+
     def get_metrics(self):
         all_metrics = []
         for task in self.tasks.values():
@@ -0,0 +1,208 @@
+from dataclasses import dataclass, field
+from typing import Tuple, Dict, Any, List
+
+from dnn_cool.modules import CompositeModuleOutput, LeafModuleOutput, OnesCondition, LeafCondition, \
+    NestedCondition, NegatedCondition, AndCondition, Condition
+
+
+@dataclass
+class InputRef:
+    """
+    A reference to a value inside the input of a flow, recorded as the chain of attribute accesses done on `x`
+    (for example `x.features` is recorded as `('features',)`).
+    """
+    keys: Tuple[str, ...] = ()
+
+    def resolve(self, x):
+        for key in self.keys:
+            x = x[key] if isinstance(x, dict) else getattr(x, key)
+        return x
+
+
+def resolve_arg(arg, x):
+    if isinstance(arg, InputRef):
+        return arg.resolve(x)
+    return arg
+
+
+@dataclass
+class LeafCall:
+    path: str
+    args: Tuple[Any, ...]
+    kwargs: Dict[str, Any]
+    precondition: Condition = None
+
+    def resolve_inputs(self, x):
+        args = [resolve_arg(arg, x) for arg in self.args]
+        kwargs = {key: resolve_arg(value, x) for key, value in self.kwargs.items()}
+        return args, kwargs
+
+    def get_input_keys(self):
+        """
+        :return: The keys of the input, if the leaf receives exactly one input from `x`, otherwise `None`.
+        """
+        if len(self.args) != 1 or len(self.kwargs) > 0 or not isinstance(self.args[0], InputRef):
+            return None
+        return self.args[0].keys
+
+
+def collect_condition_paths(condition, paths):
+    if isinstance(condition, (LeafCondition, NestedCondition)):
+        if condition.path not in paths:
+            paths.append(condition.path)
+    if isinstance(condition, NestedCondition):
+        collect_condition_paths(condition.parent, paths)
+    if isinstance(condition, NegatedCondition):
+        collect_condition_paths(condition.precondition, paths)
+    if isinstance(condition, AndCondition):
+        collect_condition_paths(condition.condition_one, paths)
+        collect_condition_paths(condition.condition_two, paths)
+    return paths
+
+
+def remove_own_availability(condition, path):
+    """
+    :return: The condition without the availability of the task itself (which is part of the precondition of every
+    leaf), or `None` if nothing else remains.
+    """
+    if isinstance(condition, OnesCondition) and condition.path == path:
+        return None
+    if isinstance(condition, AndCondition):
+        condition_one = remove_own_availability(condition.condition_one, path)
+        condition_two = remove_own_availability(condition.condition_two, path)
+        if condition_one is None or condition_two is None:
+            return condition_two if condition_one is None else condition_one
+        return AndCondition(condition_one, condition_two)
+    return condition
+
+
+@dataclass
+class CompiledFlow:
+    """
+    Static execution plan of a flow: the leaf calls in the order in which the flow makes them, the input each of them
+    receives and the final precondition of every leaf. Components run the plan directly instead of executing the flow
+    function with their operator-overloaded proxies.
+    """
+    prefix: str
+    leaves: List[LeafCall] = field(default_factory=lambda: [])
+
+    def get_paths(self):
+        return [leaf.path for leaf in self.leaves]
+
+    def get_preconditions(self):
+        return {leaf.path: leaf.precondition for leaf in self.leaves}
+
+    def get_condition_paths(self):
+        """
+        :return: The paths of all tasks which are used as a precondition somewhere in the flow.
+        """
+        paths = []
+        for leaf in self.leaves:
+            collect_condition_paths(leaf.precondition, paths)
+        return paths
+
+    def get_precondition_groups(self):
+        """
+        Groups the leaves by their precondition as written in the flow (for example all leaves called with
+        `| out.obj_exists`), ignoring the availability of the task itself.
+        :return: list of groups, every group a list of indices into `leaves`, in the order of the plan.
+        """
+        groups = {}
+        for i, leaf in enumerate(self.leaves):
+            condition = remove_own_availability(leaf.precondition, leaf.path)
+            key = condition.get_key() if condition is not None else ''
+            groups.setdefault(key, []).append(i)
+        return list(groups.values())
+
+    def get_group_preconditions(self):
+        """
+        :return: The precondition of every group of `get_precondition_groups`, without the availability of the task
+        itself (`None` if nothing else remains).
+        """
+        return [remove_own_availability(self.leaves[group[0]].precondition, self.leaves[group[0]].path)
+                for group in self.get_precondition_groups()]
+
+    def resolve_leaves(self, component):
+        """
+        Finds the leaf objects of the component (for example the `ModuleDecorator`s of a `TaskFlowModule`), in the
+        order of the plan.
+        :param component: A composite component, which has its children set as attributes, named after the tasks.
+        :return: list of leaf objects, one for every leaf call.
+        """
+        res = []
+        for leaf in self.leaves:
+            relative_path = leaf.path[len(self.prefix):]
+            obj = component
+            for task_name in relative_path.split('.'):
+                obj = getattr(obj, task_name)
+            res.append(obj)
+        return res
+
+
+class InputTracer:
+
+    def __init__(self, keys=()):
+        self._keys = keys
+
+    def __getattr__(self, item):
+        if item.startswith('__'):
+            raise AttributeError(item)
+        return InputTracer(self._keys + (item,))
+
+    def to_ref(self):
+        return InputRef(self._keys)
+
+
+def to_traced_arg(arg):
+    if isinstance(arg, InputTracer):
+        return arg.to_ref()
+    return arg
+
+
+class LeafTracer:
+
+    def __init__(self, task, prefix, calls):
+        self.path = prefix + task.get_name()
+        self.calls = calls
+
+    def __call__(self, *args, **kwargs):
+        args = tuple(to_traced_arg(arg) for arg in args)
+        kwargs = {key: to_traced_arg(value) for key, value in kwargs.items()}
+        self.calls.append(LeafCall(self.path, args, kwargs))
+        return LeafModuleOutput(self.path, None, None, None, OnesCondition(self.path))
+
+
+class FlowTracer:
+
+    def __init__(self, task_flow, prefix='', calls=None):
+        self.flow = task_flow.get_flow_func()
+        self.prefix = prefix
+        self.calls = [] if calls is None else calls
+
+        for key, task in task_flow.tasks.items():
+            if not task.has_children():
+                instance = LeafTracer(task, prefix, self.calls)
+            else:
+                instance = FlowTracer(task, prefix=f'{prefix}{task.get_name()}.', calls=self.calls)
+            setattr(self, key, instance)
+
+    def __call__(self, x):
+        out = CompositeModuleOutput(training=False, gt=None, prefix=self.prefix)
+        return self.flow(self, x, out)
+
+
+def trace_flow(task_flow, prefix='') -> CompiledFlow:
+    """
+    Executes the flow function of the task flow once with tracing proxies and records it as a `CompiledFlow`.
+    The preconditions are built in exactly the same way as in `TaskFlowModule`, so the plan has the same semantics.
+    :param task_flow: The task flow to trace
+    :param prefix: The prefix of the task flow, if it is nested.
+    :return: The compiled flow.
+    """
+    tracer = FlowTracer(task_flow, prefix=prefix)
+    out = tracer(InputTracer())
+    # Leaves which are called, but never added to the output do not contribute to the result.
+    leaves = [leaf for leaf in tracer.calls if leaf.path in out.preconditions]
+    for leaf in leaves:
+        leaf.precondition = out.preconditions[leaf.path]
+    return CompiledFlow(prefix, leaves)
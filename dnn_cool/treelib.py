@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from treelib import Tree
 
+from dnn_cool.modules import evaluate_preconditions
 from dnn_cool.utils import any_value
 
 
@@ -60,7 +61,7 @@ class LeafExplainer:
         decoded = results.module_output.decoded[path][results.idx].detach().cpu().numpy()
         activated = results.module_output.activated[path][results.idx].detach().cpu().numpy()
         logits = results.module_output.logits[path][results.idx].detach().cpu().numpy()
-        precondition = results.module_output.preconditions.get(path)
+        precondition = results.masks.get(path)
         if precondition is not None:
             precondition = precondition[results.idx][0].item()
 
@@ -76,9 +77,10 @@ class LeafExplainer:
 
 class Results:
 
-    def __init__(self, module_output, idx=None):
+    def __init__(self, module_output, idx=None, masks=None):
         self.module_output = module_output
         self.idx = idx
+        self.masks = masks
 
     # Pipeline compatibility
     def __getattr__(self, item):
@@ -104,6 +106,10 @@ class TreeExplainer:
     def __call__(self, x):
         if not isinstance(x, Results):
             x = Results(x)
+        if x.masks is None:
+            # The masks of all preconditions are computed once for the whole batch.
+            module_output = x.module_output
+            x.masks = evaluate_preconditions(module_output.preconditions, module_output.decoded)
 
         if x.idx is None:
             n = len(any_value(x.module_output.logits))
@@ -112,7 +118,7 @@ class TreeExplainer:
             for i in range(n):
                 inp_tree = Tree()
                 inp_node = inp_tree.create_node(tag=f'inp {i}', identifier=f'inp_{i}.{self.prefix}')
-                x_for_id = Results(x.module_output, i)
+                x_for_id = Results(x.module_output, i, x.masks)
                 out = TreeExplanation(inp_tree, inp_node, x_for_id, f'inp_{i}.')
                 out = self.flow(self, x_for_id, out)
                 tree.paste(batch_node.identifier, out.tree)
@@ -42,7 +42,12 @@ class TransformedSubset(Dataset):
         self.transforms = transforms
 
     def __getitem__(self, idx):
-        r = self.dataset[self.indices[idx]]
+        if isinstance(idx, (list, tuple)):
+            idx = np.asarray(idx)
+        if isinstance(idx, np.ndarray):
+            r = self.dataset[np.asarray(self.indices)[idx]]
+        else:
+            r = self.dataset[self.indices[idx]]
         if self.transforms is None:
             return r
         return self.transforms(r)
@@ -7,14 +7,24 @@ import torch
 from sklearn.preprocessing import MultiLabelBinarizer
 
 
+def to_float_array(values):
+    """
+    :return: A new float64 array with the values, where the missing values are replaced with -1 (in place).
+    """
+    arr = np.array(values, dtype=np.float64)
+    arr[np.isnan(arr)] = -1
+    return arr
+
+
 def binary_value_converter(values):
-    values[np.isnan(values.astype(float))] = -1
-    return torch.tensor(values.astype(float)).float().unsqueeze(dim=-1)
+    return torch.from_numpy(to_float_array(values)).float().unsqueeze(dim=-1)
 
 
 def classification_converter(values):
-    values[np.isnan(values)] = -1
-    return torch.tensor(values).long()
+    arr = np.asarray(values)
+    if np.issubdtype(arr.dtype, np.integer):
+        return torch.from_numpy(arr.astype(np.int64))
+    return torch.from_numpy(to_float_array(arr)).long()
 
 
 class MultiLabelValuesConverter:
@@ -23,19 +33,35 @@ class MultiLabelValuesConverter:
         self.binarizer = MultiLabelBinarizer()
         self.is_fit = False
 
+    def split_labels(self, values):
+        """
+        :return: The available values (indexed by their position) and a series with one row for every label of every
+        available value, indexed by the position of the value.
+        """
+        available_labels = pd.Series(values[~pd.isna(values)]).reset_index(drop=True)
+        labels = available_labels.str.split(',').explode()
+        return available_labels, labels[labels.str.len() > 0]
+
+    def partial_fit(self, values):
+        """
+        Adds the labels of the given values to the known labels, so that the converter can be fit chunk by chunk.
+        """
+        _, labels = self.split_labels(values)
+        known = self.binarizer.classes_ if self.is_fit else []
+        self.binarizer.fit([np.union1d(known, labels.unique())])
+        self.is_fit = True
+
     def __call__(self, values):
-        available_labels = values[~pd.isna(values)]
-        labels = []
-        for i in range(len(available_labels)):
-            split = available_labels.iloc[i].split(',')
-            labels.append(list(filter(lambda x: len(x) > 0, split)))
+        available_labels, labels = self.split_labels(values)
         if not self.is_fit:
-            one_hot_labels = self.binarizer.fit_transform(labels)
+            self.binarizer.fit([labels.unique()])
             self.is_fit = True
-        else:
-            one_hot_labels = self.binarizer.transform(labels)
-        res = np.ones((len(values), one_hot_labels.shape[1]), dtype=np.float32) * -1.
-        res[~pd.isna(values)] = one_hot_labels
+        codes = pd.Categorical(labels, categories=self.binarizer.classes_).codes
+        known = codes >= 0
+        res = np.full((len(values), len(self.binarizer.classes_)), -1., dtype=np.float32)
+        one_hot_labels = np.zeros((len(available_labels), len(self.binarizer.classes_)), dtype=np.float32)
+        one_hot_labels[labels.index.values[known], codes[known]] = 1.
+        res[np.asarray(~pd.isna(values))] = one_hot_labels
         return res
 
     def state_dict(self):
@@ -55,6 +81,6 @@ class ImageCoordinatesValuesConverter:
         self.dim = dim
 
     def __call__(self, values):
-        values = values.astype(float) / self.dim
+        values = np.array(values, dtype=np.float64) / self.dim
         values[np.isnan(values)] = -1
-        return torch.tensor(values).float().unsqueeze(dim=-1)
+        return torch.from_numpy(values).float().unsqueeze(dim=-1)
@@ -4,12 +4,15 @@ from dataclasses import dataclass
 from typing import Dict
 
 from dnn_cool.losses import squeeze_if_needed
+from dnn_cool.modules import evaluate_preconditions
+from dnn_cool.packed import get_nonempty_tasks
 
 
 @dataclass
 class VisitorData:
     predictions: Dict
     targets: Dict
+    masks: Dict
 
     def __getattr__(self, item):
         return self
@@ -59,7 +62,7 @@ class LeafVisitor:
             preds = self.activation(torch.tensor(preds).float()).detach().cpu().numpy()
         targets = visitor_data.targets[self.path]
 
-        precondition = visitor_data.predictions[f'precondition|{self.path}']
+        precondition = visitor_data.masks[self.path]
         if precondition.sum() == 0:
             return self.empty_result()
         precondition = squeeze_if_needed(precondition)
@@ -88,8 +91,18 @@ class CompositeVisitor:
                 instance = CompositeVisitor(task, leaf_visitor_cls, visitor_out_cls, prefix=f'{prefix}{task.get_name()}.')
             setattr(self, key, instance)
 
+        compiled_flow = task_flow.get_compiled_flow(prefix)
+        self._compiled_leaves = compiled_flow.resolve_leaves(self)
+        self._paths = compiled_flow.get_paths()
+
     def __call__(self, data):
-        flow_result = self.flow(self, data, self.visitor_out_cls())
+        flow_result = self.visitor_out_cls()
+        nonempty = get_nonempty_tasks(data.predictions, self._paths)
+        for i, leaf_visitor in enumerate(self._compiled_leaves):
+            if nonempty is not None and not nonempty[i]:
+                flow_result += leaf_visitor.empty_result()
+            else:
+                flow_result += leaf_visitor(data)
         return flow_result
 
 
@@ -99,7 +112,21 @@ class RootCompositeVisitor:
         self.prefix = prefix
         self.task_flow = task_flow
         self.composite_visitor = CompositeVisitor(task_flow, leaf_visitor_cls, visitor_out_cls, prefix)
+        self.preconditions = task_flow.get_compiled_flow(prefix).get_preconditions()
+
+    def get_masks(self, predictions, targets):
+        """
+        :return: dict from path to the mask of its precondition. The masks saved in the predictions are reused, the
+        others are computed over the targets, with one shared `MaskEvaluator`.
+        """
+        precomputed = {}
+        for path in self.preconditions:
+            mask = predictions.get(f'precondition|{path}')
+            if mask is not None:
+                precomputed[path] = mask
+        return evaluate_preconditions(self.preconditions, targets, precomputed)
 
     def __call__(self, predictions, targets):
-        flow_result = self.composite_visitor(VisitorData(predictions, targets))
+        masks = self.get_masks(predictions, targets)
+        flow_result = self.composite_visitor(VisitorData(predictions, targets, masks))
         return flow_result.reduce()
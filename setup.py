@@ -34,4 +34,9 @@ setup(
                       "tqdm",
                       "scikit_learn",
                       "treelib"],
+    extras_require={
+        "test": ["pytest",
+                 "onnx",
+                 "onnxruntime"],
+    },
 )
\ No newline at end of file
@@ -1,10 +1,24 @@
+from functools import partial
+import time
+
+import numpy as np
+import pandas as pd
 import torch
 import pytest
+from torch.utils.data import DataLoader
 
-from dnn_cool.datasets import FlowDataset
-from dnn_cool.converters import Values
-from dnn_cool.synthetic_dataset import synthenic_dataset_preparation
-from dnn_cool.task_flow import TaskFlow, BinaryHardcodedTask
+from dnn_cool.datasets import FlowDataset, batched_loader, FlowCollator, FlowBatch, IterableFlowDataset, \
+    write_flow_shards
+from dnn_cool.converters import Values, Converters
+from dnn_cool.feature_cache import cache_features
+from dnn_cool.project import Project
+from dnn_cool.storage import ColumnStore, ColumnCache
+from dnn_cool.task_converters import To
+from dnn_cool.value_converters import binary_value_converter, MultiLabelValuesConverter, classification_converter, \
+    ImageCoordinatesValuesConverter
+from dnn_cool.packed import PackedGt, PACKED_GT_KEY, PACKED_AVAILABILITY_KEY, PACKED_GT_PRECONDITIONS_KEY
+from dnn_cool.synthetic_dataset import synthenic_dataset_preparation, create_synthetic_dataset
+from dnn_cool.task_flow import TaskFlow, BinaryHardcodedTask, BinaryClassificationTask, MultilabelClassificationTask
 
 
 @pytest.fixture()
@@ -58,3 +72,459 @@ def test_synthetic_dataset_missing_values():
 
         if y['camera_blocked'].item() < 0:
             assert not X['gt']['_availability']['camera_blocked'].item()
+
+
+def test_packed_gt_survives_collation(example_numerical_flow):
+    dataset = FlowDataset(example_numerical_flow)
+    X, y = next(iter(DataLoader(dataset, batch_size=8, shuffle=False)))
+
+    gt = X['gt']
+    assert set(gt.keys()) == {PACKED_GT_KEY, PACKED_AVAILABILITY_KEY, PACKED_GT_PRECONDITIONS_KEY}
+    gt = PackedGt(gt, example_numerical_flow.get_packed_layout())
+    assert torch.equal(gt['is_interesting'], y['is_interesting'].bool())
+    assert torch.equal(gt['numerical_flow.is_even'], y['numerical_flow.is_even'].bool())
+    assert 'numerical_flow.multiple_three' not in gt
+    assert torch.equal(gt['_availability']['numerical_flow.multiple_three'],
+                       y['numerical_flow.multiple_three'] >= 0.)
+
+
+def test_batched_indexing_matches_collated_samples(example_numerical_flow):
+    dataset = FlowDataset(example_numerical_flow)
+    expected_X, expected_y = next(iter(DataLoader(dataset, batch_size=5, shuffle=False)))
+
+    X, y = next(iter(batched_loader(dataset, batch_size=5)))
+
+    assert torch.equal(X['inp'], expected_X['inp'])
+    assert y.keys() == expected_y.keys()
+    for key, value in expected_y.items():
+        assert torch.equal(y[key], value)
+    for key, value in expected_X['gt'].items():
+        assert torch.equal(X['gt'][key], value)
+
+
+def test_precomputed_preconditions_are_persisted(example_numerical_flow, tmp_path):
+    tables_path = tmp_path / 'tables.pt'
+    dataset = FlowDataset(example_numerical_flow, tables_path=tables_path)
+    X, y = dataset[np.arange(8)]
+
+    preconditions = X['gt'].get_preconditions()
+    is_interesting = y['is_interesting'].bool()
+    expected = is_interesting.unsqueeze(dim=-1) & y['numerical_flow.is_even'].bool()
+    assert torch.equal(preconditions['numerical_flow.predict_positive'], expected)
+    assert tables_path.exists()
+
+    loaded = FlowDataset(example_numerical_flow, tables_path=tables_path)
+    for key, table in dataset._packed_tables.items():
+        assert torch.equal(loaded._packed_tables[key], table)
+
+    # Editing the labels (with the same number of rows) invalidates the saved tables.
+    labels = example_numerical_flow.get_all_children()['is_interesting'].get_labels()
+    labels[2] = True
+    edited = FlowDataset(example_numerical_flow, tables_path=tables_path)
+    labels[2] = False
+    edited_preconditions = edited[np.arange(8)][0]['gt'].get_preconditions()
+    assert edited_preconditions['numerical_flow.predict_positive'][2].all()
+    assert not preconditions['numerical_flow.predict_positive'][2].any()
+
+
+def test_flow_collator_packs_small_tensors_in_one_buffer(example_numerical_flow):
+    dataset = FlowDataset(example_numerical_flow)
+    expected_X, expected_y = next(iter(DataLoader(dataset, batch_size=8, shuffle=False)))
+
+    batch = next(iter(DataLoader(dataset, batch_size=8, shuffle=False, collate_fn=FlowCollator(), num_workers=2)))
+
+    assert isinstance(batch, FlowBatch)
+    assert len(batch.buffer_views) == len(expected_y) + len(expected_X['gt']) + 1
+    # Without the buffer (as rebuilt by older pin memory threads), every tensor is moved separately.
+    for X, y in [batch, batch.to('cpu'), FlowBatch(list(batch)).to('cpu')]:
+        assert isinstance(X['gt'], PackedGt)
+        assert torch.equal(X['inp'], expected_X['inp'])
+        for key, value in expected_y.items():
+            assert torch.equal(y[key], value)
+        for key, value in expected_X['gt'].items():
+            assert torch.equal(X['gt'][key], value)
+
+
+def test_project_reads_converted_columns_from_store(tmp_path):
+    df = pd.DataFrame({'features': np.arange(16), 'is_big': np.arange(16) > 7})
+    calls = []
+
+    def features_converter(values):
+        calls.append(values.name)
+        return [torch.tensor(values.values).float().unsqueeze(dim=-1)]
+
+    def create_project():
+        converters = Converters()
+        converters.values.col_mapping['features'] = features_converter
+        converters.values.type_mapping['binary'] = binary_value_converter
+        converters.task.type_mapping['binary'] = To(BinaryClassificationTask,
+                                                    module_supplier=lambda: torch.nn.Linear(1, 1))
+        return Project(df, input_col='features', output_col=['is_big'], converters=converters,
+                       project_dir=tmp_path / 'project', storage_dir=tmp_path / 'columns')
+
+    create_project()
+    assert calls == ['features']
+    assert set(ColumnStore(tmp_path / 'columns').manifest) == {'features', 'is_big'}
+
+    project = create_project()
+    assert calls == ['features']
+    assert isinstance(project.inputs.values[0], np.memmap)
+    labels = project.get_task('is_big').get_labels()
+    assert isinstance(labels, np.memmap)
+    assert np.array_equal(labels, (np.arange(16) > 7).astype(np.float32)[:, None])
+
+    @project.add_flow
+    def is_big_flow(flow, x, out):
+        out += flow.is_big(x.features)
+        return out
+
+    dataset = FlowDataset(project.get_full_flow())
+    assert np.shares_memory(dataset.is_big.arr.numpy(), labels)
+    X, y = dataset[np.arange(4, 12)]
+    assert np.array_equal(X['features'], np.arange(4, 12, dtype=np.float32)[:, None])
+    assert torch.equal(y['is_big'], torch.from_numpy(labels[4:12].copy()))
+
+    # The saved columns are not reused when the dataframe changes, even if it keeps its length.
+    df['features'] = np.arange(16, 32)
+    df['is_big'] = np.arange(16) > 3
+    project = create_project()
+    assert calls == ['features', 'features']
+    assert np.array_equal(project.inputs.values[0], np.arange(16, 32, dtype=np.float32)[:, None])
+    assert np.array_equal(project.get_task('is_big').get_labels(), (np.arange(16) > 3).astype(np.float32)[:, None])
+
+
+def test_iterable_dataset_streams_shards(example_numerical_flow, tmp_path):
+    dataset = FlowDataset(example_numerical_flow)
+    shard_paths = write_flow_shards(dataset, tmp_path, shard_size=3)
+    assert len(shard_paths) == 3
+
+    stream = IterableFlowDataset(tmp_path)
+    assert len(stream) == len(dataset)
+    for i, (X, y) in enumerate(stream):
+        expected_X, expected_y = dataset[i]
+        assert torch.equal(X['inp'], expected_X['inp'])
+        for key, value in expected_y.items():
+            assert torch.equal(y[key], value)
+        for key, value in expected_X['gt'].items():
+            assert torch.equal(X['gt'][key], value)
+        assert torch.equal(X['gt']['_availability']['numerical_flow.is_even'],
+                           expected_X['gt']['_availability']['numerical_flow.is_even'])
+
+    shuffled = IterableFlowDataset(tmp_path, shuffle=True, buffer_size=4)
+    inputs = [X['inp'].item() for X, y in shuffled]
+    assert sorted(inputs) == list(range(8))
+
+    loader = DataLoader(IterableFlowDataset(tmp_path), batch_size=8, num_workers=2)
+    inputs = torch.cat([X['inp'] for X, y in loader])
+    assert sorted(inputs.flatten().tolist()) == list(range(8))
+
+
+def test_iterable_dataset_balances_processes(example_numerical_flow, tmp_path, monkeypatch):
+    write_flow_shards(FlowDataset(example_numerical_flow), tmp_path, shard_size=3)
+    stream = IterableFlowDataset(tmp_path)
+
+    # The shards have 3, 3 and 2 samples, so the first process gets 5 samples and the second one 3.
+    inputs = []
+    for rank in range(2):
+        monkeypatch.setattr('dnn_cool.datasets.get_stream_split', lambda: (rank, 2, 0, 1))
+        assert len(stream) == 3
+        inputs.append([X['inp'].item() for X, y in stream])
+    assert inputs == [[0, 1, 2], [3, 4, 5]]
+
+    # Within a process, the shards are split across the DataLoader workers.
+    monkeypatch.setattr('dnn_cool.datasets.get_stream_split', lambda: (0, 1, 1, 2))
+    assert [X['inp'].item() for X, y in stream] == [3, 4, 5]
+    # The samples beyond the length of the process are dropped from the last workers.
+    shards = [{'n': 3}, {'n': 3}, {'n': 2}]
+    assert [stream.get_worker_quota(shards, worker_id, 2, 6) for worker_id in range(2)] == [5, 1]
+    # Some of the 4 consumers would get no shard.
+    monkeypatch.setattr('dnn_cool.datasets.get_stream_split', lambda: (0, 2, 0, 2))
+    with pytest.raises(ValueError):
+        list(stream)
+    monkeypatch.setattr('dnn_cool.datasets.get_stream_split', lambda: (0, 4, 0, 1))
+    with pytest.raises(ValueError):
+        len(stream)
+
+
+def test_backbone_features_are_cached(example_numerical_flow, tmp_path):
+    calls = []
+
+    class Backbone(torch.nn.Module):
+
+        def __init__(self):
+            super().__init__()
+            self.linear = torch.nn.Linear(1, 4)
+
+        def forward(self, x):
+            calls.append(len(x['inp']))
+            return {'features': self.linear(x['inp'].float())}
+
+    torch.manual_seed(0)
+    backbone = Backbone()
+    dataset = FlowDataset(example_numerical_flow)
+    features = cache_features(backbone, dataset, tmp_path, batch_size=3)
+    assert calls == [3, 3, 2]
+    assert cache_features(backbone, dataset, tmp_path).keys == ['features']
+    assert len(calls) == 3
+
+    # A different dataset of the same length does not get the cached features.
+    other_dataset = FlowDataset(example_numerical_flow, inputs=Values(['inp'], [torch.arange(8, 16).unsqueeze(-1)]))
+    other_features = cache_features(backbone, other_dataset, tmp_path)
+    assert len(calls) == 4
+    assert not np.allclose(other_features.values[0], features.values[0])
+    cache_features(backbone, other_dataset, tmp_path, dataset_key='other')
+    cache_features(backbone, other_dataset, tmp_path, dataset_key='other')
+    assert len(calls) == 5
+
+    cached_dataset = FlowDataset(example_numerical_flow, inputs=features)
+    X, y = cached_dataset[5]
+    with torch.no_grad():
+        expected = backbone.linear(torch.tensor([5.]))
+    assert torch.allclose(torch.as_tensor(X['features']), expected)
+    assert torch.equal(y['is_interesting'], dataset[5][1]['is_interesting'])
+
+
+def test_values_pack_numeric_columns():
+    a, b = torch.arange(6).float(), torch.arange(6, 12).float()
+    images = torch.zeros(6, 3, 2, 2)
+    values = Values(['a', 'b', 'img'], [a, b, images])
+
+    assert len(values.blocks) == 1
+    indices, block = values.blocks[0]
+    assert indices == [0, 1] and block.shape == (6, 2) and block.is_contiguous()
+
+    batch = values[np.array([4, 1])]
+    assert list(batch.keys()) == ['a', 'b', 'img']
+    assert torch.equal(batch['a'], torch.tensor([4., 1.]))
+    assert torch.equal(batch['b'], torch.tensor([10., 7.]))
+    assert batch['img'].shape == (2, 3, 2, 2)
+    assert torch.equal(values[2:4]['b'], b[2:4])
+    assert values[3]['a'].item() == 3.
+
+    assert values.memory_footprint() == {'a': 24, 'b': 24, 'img': 6 * 12 * 4}
+    assert values.nbytes() == block.numel() * 4 + images.numel() * 4
+
+
+def test_project_converts_columns_in_threads(tmp_path):
+    df = pd.DataFrame({'features': np.arange(6),
+                       'is_big': [True, False, np.nan, True, False, True],
+                       'category': [0., 2., np.nan, 1., 1., 0.],
+                       'tags': ['a,b', '', np.nan, 'b', 'c,a,', 'c']})
+
+    def create_converters():
+        converters = Converters()
+        converters.type.type_mapping['is_big'] = 'binary'
+        converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+        converters.values.type_mapping['binary'] = binary_value_converter
+        converters.values.col_mapping['category'] = lambda values: [classification_converter(values)]
+        converters.values.col_mapping['tags'] = lambda values: [MultiLabelValuesConverter()(values)]
+        converters.task.type_mapping['binary'] = To(BinaryClassificationTask)
+        converters.task.col_mapping['category'] = To(BinaryClassificationTask)
+        converters.task.col_mapping['tags'] = To(BinaryClassificationTask)
+        return converters
+
+    output_col = ['is_big', 'category', 'tags']
+    serial = Project(df, 'features', output_col, tmp_path, create_converters())
+    threaded = Project(df, 'features', output_col, tmp_path, create_converters(), num_workers=3)
+
+    assert set(threaded.conversion_times) == {'features', 'is_big', 'category', 'tags'}
+    for col in output_col:
+        assert torch.equal(torch.as_tensor(threaded.get_task(col).get_labels()),
+                           torch.as_tensor(serial.get_task(col).get_labels()))
+    assert torch.equal(threaded.get_task('is_big').get_labels().squeeze(), torch.tensor([1., 0., -1., 1., 0., 1.]))
+    assert torch.equal(threaded.get_task('category').get_labels(), torch.tensor([0, 2, -1, 1, 1, 0]))
+    expected_tags = np.array([[1, 1, 0], [0, 0, 0], [-1, -1, -1], [0, 1, 0], [1, 0, 1], [0, 0, 1]], dtype=np.float32)
+    assert np.array_equal(threaded.get_task('tags').get_labels(), expected_tags)
+    assert df['is_big'].isna().sum() == 1
+
+
+def test_project_fits_shared_converters_in_column_order(tmp_path):
+    df = pd.DataFrame({'features': np.arange(4),
+                       'tags': ['a,b', 'b', np.nan, 'c'],
+                       'other_tags': ['x', 'a,x', 'y', np.nan]})
+
+    class SlowMultiLabelValuesConverter(MultiLabelValuesConverter):
+        def split_labels(self, values):
+            # Without ordering, the second column would fit the shared converter first.
+            if values.name == 'tags':
+                time.sleep(0.2)
+            return super().split_labels(values)
+
+    def create_converters():
+        converters = Converters()
+        converters.type.type_mapping['tags'] = 'multilabel'
+        converters.type.type_mapping['other_tags'] = 'multilabel'
+        converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+        converters.values.type_mapping['multilabel'] = SlowMultiLabelValuesConverter()
+        converters.task.type_mapping['multilabel'] = To(MultilabelClassificationTask)
+        return converters
+
+    output_col = ['tags', 'other_tags']
+    serial = Project(df, 'features', output_col, tmp_path / 'serial', create_converters())
+    threaded = Project(df, 'features', output_col, tmp_path / 'threaded', create_converters(), num_workers=2)
+    for col in output_col:
+        assert np.array_equal(threaded.get_task(col).get_labels(), serial.get_task(col).get_labels())
+    # The classes are defined by the first column.
+    assert np.array_equal(threaded.get_task('other_tags').get_labels(),
+                          np.array([[0, 0, 0], [1, 0, 0], [0, 0, 0], [-1, -1, -1]], dtype=np.float32))
+
+
+def test_project_from_csv_chunks(tmp_path):
+    df = pd.DataFrame({'features': np.arange(7),
+                       'is_big': [True, False, np.nan, True, False, True, True],
+                       'tags': ['a,b', ',', np.nan, 'b', 'c,a,', 'c', 'd']})
+    df.to_csv(tmp_path / 'data.csv', index=False)
+
+    def create_converters():
+        converters = Converters()
+        converters.type.type_mapping['is_big'] = 'binary'
+        converters.type.type_mapping['tags'] = 'multilabel'
+        converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+        converters.values.type_mapping['binary'] = binary_value_converter
+        converters.values.type_mapping['multilabel'] = MultiLabelValuesConverter()
+        converters.task.type_mapping['binary'] = To(BinaryClassificationTask)
+        converters.task.type_mapping['multilabel'] = To(BinaryClassificationTask)
+        return converters
+
+    expected = Project(df, 'features', ['is_big', 'tags'], tmp_path / 'expected', create_converters())
+    project = Project.from_files(tmp_path / 'data.csv', 'features', ['is_big', 'tags'], tmp_path / 'project',
+                                 create_converters(), chunksize=2)
+
+    assert len(project.df) == 7
+    assert isinstance(project.inputs.values[0], np.memmap)
+    assert np.array_equal(project.inputs[np.arange(7)]['features'], np.arange(7, dtype=np.float32))
+    for col in ['is_big', 'tags']:
+        labels = project.get_task(col).get_labels()
+        assert isinstance(labels, np.memmap)
+        # The label "d" is only in the last chunk.
+        assert np.array_equal(labels, np.asarray(expected.get_task(col).get_labels()))
+    assert set(project.conversion_times) == {'features', 'is_big', 'tags'}
+
+
+def test_project_caches_columns_by_content(tmp_path):
+    df = pd.DataFrame({'features': np.arange(6), 'is_big': np.arange(6) > 2, 'tags': ['a', 'b', 'a,b', 'c', 'a', 'b']})
+    calls = []
+
+    def counting(converter):
+        def convert(values):
+            calls.append(values.name)
+            return converter(values)
+        return convert
+
+    def create_project(df):
+        converters = Converters()
+        converters.type.type_mapping['tags'] = 'multilabel'
+        converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+        converters.values.type_mapping['binary'] = counting(binary_value_converter)
+        converters.values.type_mapping['multilabel'] = MultiLabelValuesConverter()
+        converters.task.type_mapping['binary'] = To(BinaryClassificationTask)
+        converters.task.type_mapping['multilabel'] = To(BinaryClassificationTask)
+        project = Project(df, 'features', ['is_big', 'tags'], tmp_path, converters, cache_columns=True)
+        return project, converters
+
+    create_project(df)
+    assert calls == ['is_big']
+    project, converters = create_project(df)
+    assert calls == ['is_big']
+    assert isinstance(project.get_task('is_big').get_labels(), np.memmap)
+    # The state of the fit converter is restored with the cached column.
+    assert list(converters.values.type_mapping['multilabel'].binarizer.classes_) == ['a', 'b', 'c']
+
+    changed = df.copy()
+    changed.loc[0, 'is_big'] = True
+    project, _ = create_project(changed)
+    assert calls == ['is_big', 'is_big']
+    assert project.get_task('is_big').get_labels()[0, 0] == 1.
+
+
+def test_column_store_restores_converter_state(tmp_path):
+    df = pd.DataFrame({'features': np.arange(4), 'tags': ['a', 'b', 'a,b', 'c']})
+
+    def create_project():
+        converters = Converters()
+        converters.type.type_mapping['tags'] = 'multilabel'
+        converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+        converters.values.type_mapping['multilabel'] = MultiLabelValuesConverter()
+        converters.task.type_mapping['multilabel'] = To(BinaryClassificationTask)
+        Project(df, 'features', ['tags'], tmp_path / 'project', converters, storage_dir=tmp_path / 'columns')
+        return converters.values.type_mapping['multilabel']
+
+    create_project()
+    # The column is read from the store, and the converter gets the state it had when the column was converted.
+    converter = create_project()
+    assert list(converter.binarizer.classes_) == ['a', 'b', 'c']
+
+
+def test_column_cache_keys_depend_on_converter_config(tmp_path):
+    df = pd.DataFrame({'x': [1., 2., np.nan]})
+    cache = ColumnCache(tmp_path)
+
+    def scale(values, factor):
+        return torch.tensor(values.values * factor)
+
+    small, large = ImageCoordinatesValuesConverter(64), ImageCoordinatesValuesConverter(128)
+    key = cache.get_key(df, 'x', 'coords', small)
+    assert key == cache.get_key(df, 'x', 'coords', ImageCoordinatesValuesConverter(64))
+    assert key != cache.get_key(df, 'x', 'coords', large)
+    assert cache.get_key(df, 'x', 'num', partial(scale, factor=2)) != \
+           cache.get_key(df, 'x', 'num', partial(scale, factor=3))
+
+    cache.put(key, small, Values(['x'], [small(df['x'])]))
+    assert cache.get(key, 'x', len(df), small) is not None
+    assert cache.get(cache.get_key(df, 'x', 'coords', large), 'x', len(df), large) is None
+
+
+def test_lazy_project_converts_only_used_columns(tmp_path):
+    df = pd.DataFrame({'features': np.arange(6), 'a': np.arange(6) > 2, 'b': np.arange(6) > 3, 'c': np.arange(6) > 4})
+    calls = []
+
+    def binary_converter(values):
+        calls.append(values.name)
+        return binary_value_converter(values)
+
+    converters = Converters()
+    converters.values.col_mapping['features'] = lambda values: [torch.tensor(values.values).float()]
+    converters.values.type_mapping['binary'] = binary_converter
+    converters.task.type_mapping['binary'] = To(BinaryClassificationTask)
+    project = Project(df, 'features', ['a', 'b', 'c'], tmp_path, converters, lazy=True)
+    assert calls == [] and project.inputs is None
+
+    @project.add_flow
+    def a_and_b(flow, x, out):
+        out += flow.a(x.features)
+        out += flow.b(x.features) | out.a
+        return out
+
+    assert calls == ['a', 'b']
+    assert [task.get_name() for task in project.get_full_flow().tasks.values()] == ['a', 'b']
+    project.release_df()
+    assert len(project.df) == 6 and len(project.df.columns) == 0
+
+    X, y = FlowDataset(project.get_full_flow())[np.arange(6)]
+    assert torch.equal(y['b'].squeeze(), torch.tensor([0., 0., 0., 0., 1., 1.]))
+    assert calls == ['a', 'b']
+
+
+def test_synthetic_dataset_shards_are_deterministic_and_resumable(tmp_path):
+    images, df = create_synthetic_dataset(20, tmp_path / 'first', shard_size=8, num_workers=2, seed=3)
+    assert images.dtype == np.uint8 and images.shape == (20, 3, 64, 64)
+    assert len(df) == 20 and df['img'].tolist() == [f'{i}.jpg' for i in range(20)]
+    assert df['camera_blocked'][:6].isna().all()
+
+    other_images, other_df = create_synthetic_dataset(20, tmp_path / 'second', shard_size=8, num_workers=1, seed=3)
+    assert np.array_equal(images, other_images)
+    pd.testing.assert_frame_equal(df, other_df)
+
+    # Simulate an interrupted generation of the second shard.
+    (tmp_path / 'second' / 'labels-000001.pkl').unlink()
+    writable = np.load(tmp_path / 'second' / 'images.npy', mmap_mode='r+')
+    writable[8:16] = 0
+    writable.flush()
+    resumed_images, resumed_df = create_synthetic_dataset(20, tmp_path / 'second', shard_size=8, num_workers=1, seed=3)
+    assert np.array_equal(images, resumed_images)
+    pd.testing.assert_frame_equal(df, resumed_df)
+
+    # The shards of another generation cover other samples, so they are not resumed.
+    for kwargs in [dict(shard_size=4, seed=3), dict(shard_size=8, seed=4)]:
+        with pytest.raises(ValueError):
+            create_synthetic_dataset(20, tmp_path / 'second', num_workers=1, **kwargs)
@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+
+from dnn_cool.export import export_torchscript, export_onnx
+
+
+def test_torchscript_export_matches_module(interior_car_task):
+    model, task_flow = interior_car_task
+    model = model.eval()
+    flow_module = model.flow_module
+    inputs = {
+        'driver_features': torch.randn(16, 128),
+        'passenger_features': torch.randn(16, 128),
+        'features': torch.randn(16, 128),
+    }
+
+    exported = export_torchscript(flow_module, inputs)
+    buffer = io.BytesIO()
+    torch.jit.save(exported, buffer)
+    buffer.seek(0)
+    loaded = torch.jit.load(buffer)
+
+    inputs = {key: torch.randn(32, 128) for key in inputs}
+    with torch.no_grad():
+        expected = flow_module({**inputs, 'gt': None})
+        actual = loaded(inputs)
+
+    for path in task_flow.get_all_children():
+        assert torch.allclose(actual[f'logits|{path}'], expected.logits[path], atol=1e-5)
+        assert torch.allclose(actual[f'activated|{path}'], expected.activated[path], atol=1e-5)
+        assert torch.equal(actual[f'decoded|{path}'], expected.decoded[path])
+        assert torch.equal(actual[f'precondition|{path}'], expected.preconditions[path])
+
+
+def test_onnx_export_matches_module(interior_car_task, tmp_path):
+    ort = pytest.importorskip('onnxruntime')
+    model, task_flow = interior_car_task
+    model = model.eval()
+    flow_module = model.flow_module
+    inputs = {
+        'driver_features': torch.randn(4, 128),
+        'passenger_features': torch.randn(4, 128),
+        'features': torch.randn(4, 128),
+    }
+
+    onnx_path = tmp_path / 'flow.onnx'
+    output_names = export_onnx(flow_module, inputs, onnx_path)
+    session = ort.InferenceSession(str(onnx_path))
+    # The batch dimension is dynamic.
+    inputs = {key: torch.randn(32, 128) for key in inputs}
+    outputs = session.run(output_names, {key: value.numpy() for key, value in inputs.items()})
+    actual = dict(zip(output_names, outputs))
+    with torch.no_grad():
+        expected = flow_module({**inputs, 'gt': None})
+
+    for path in task_flow.get_all_children():
+        assert np.allclose(actual[f'logits|{path}'], expected.logits[path].numpy(), atol=1e-5)
+        assert np.allclose(actual[f'activated|{path}'], expected.activated[path].numpy(), atol=1e-5)
+        assert np.allclose(actual[f'decoded|{path}'], expected.decoded[path].numpy(), atol=1e-4)
+        assert np.array_equal(actual[f'precondition|{path}'], expected.preconditions[path].numpy())
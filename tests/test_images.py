@@ -0,0 +1,50 @@
+import pickle
+
+import cv2
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import SequentialSampler, BatchSampler
+
+from dnn_cool.converters import Values
+from dnn_cool.images import ImageValuesConverter, PrefetchingSampler
+
+
+def write_images(directory, n):
+    names = []
+    for i in range(n):
+        img = np.full((8, 6, 3), i, dtype=np.uint8)
+        img[..., 0] = 255 - i
+        names.append(f'{i}.png')
+        cv2.imwrite(str(directory / names[-1]), img)
+    return pd.Series(names)
+
+
+def test_lazy_images_decode_and_cache(tmp_path):
+    names = write_images(tmp_path, 10)
+    images = ImageValuesConverter(tmp_path, num_threads=2, cache_bytes=4 * 8 * 6 * 3)(names)
+    inputs = Values(['img'], [images])
+
+    img = inputs[3]['img']
+    assert img.shape == (3, 8, 6)
+    # cv2 reads BGR, the images are returned in RGB order.
+    assert torch.allclose(img[2], torch.full((8, 6), (255 - 3) / 255.))
+    assert torch.allclose(img[0], torch.full((8, 6), 3 / 255.))
+
+    batch = inputs[np.array([1, 5, 7])]['img']
+    assert batch.shape == (3, 3, 8, 6)
+    assert torch.equal(batch[1], inputs[5]['img'])
+    assert len(images.cache) == 4
+    assert images.cache.nbytes <= images.cache.max_bytes
+
+    restored = pickle.loads(pickle.dumps(images))
+    assert torch.equal(restored[np.arange(2, 4)], images[2:4])
+
+
+def test_prefetching_sampler_keeps_order(tmp_path):
+    images = ImageValuesConverter(tmp_path)(write_images(tmp_path, 10))
+    batch_sampler = BatchSampler(SequentialSampler(range(10)), batch_size=3, drop_last=False)
+    sampler = PrefetchingSampler(batch_sampler, images, lookahead=4)
+    assert list(sampler) == list(batch_sampler)
+    images.get_executor().shutdown(wait=True)
+    assert len(images.cache) == 10
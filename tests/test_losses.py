@@ -3,8 +3,12 @@ from functools import partial
 import torch
 
 from torch import nn
+from torch.utils.data import DataLoader, Subset
 
-from dnn_cool.losses import ReducedPerSample
+from dnn_cool.converters import Values
+from dnn_cool.losses import ReducedPerSample, BaseMetricDecorator, TaskLossDecorator, LossFlowData
+from dnn_cool.packed import PACKED_PRECONDITIONS_KEY
+from dnn_cool.task_flow import TaskFlow, MultilabelClassificationTask
 
 
 def test_reduced_per_sample_utility(simple_binary_data):
@@ -20,3 +24,156 @@ def test_reduced_per_sample_utility(simple_binary_data):
     actual = criterion(x, y)
 
     assert torch.allclose(expected, actual)
+
+
+def compute_losses(model, task_flow, indices):
+    loader = DataLoader(Subset(task_flow.get_dataset(), indices), batch_size=len(indices), shuffle=False)
+    X, y = next(iter(loader))
+    outputs = model(X)
+    return task_flow.get_loss()(outputs, y), task_flow.get_loss(masked=True)(outputs, y)
+
+
+def test_masked_loss_matches_loss(interior_car_task):
+    model, task_flow = interior_car_task
+    expected, actual = compute_losses(model, task_flow, list(range(32)))
+    assert torch.allclose(expected, actual)
+
+    expected_grads = torch.autograd.grad(expected.sum(), list(model.parameters()), retain_graph=True)
+    actual_grads = torch.autograd.grad(actual.sum(), list(model.parameters()))
+    for expected_grad, actual_grad in zip(expected_grads, actual_grads):
+        assert torch.allclose(expected_grad, actual_grad, atol=1e-6)
+
+    # When the camera is blocked, the preconditions of all other tasks are empty.
+    camera_blocked = task_flow.tasks['camera_blocked'].labels[:, 0] > 0.5
+    indices = torch.nonzero(camera_blocked)[:8, 0].tolist()
+    expected, actual = compute_losses(model, task_flow, indices)
+    assert torch.allclose(expected, actual)
+
+
+def test_loss_results_match_leaf_and_per_sample_losses(interior_car_task):
+    model, task_flow = interior_car_task
+    loader = DataLoader(task_flow.get_dataset(), batch_size=32, shuffle=False)
+    X, y = next(iter(loader))
+    outputs = model(X)
+    criterion = task_flow.get_loss()
+
+    loss = criterion(outputs, y)
+    results = criterion.get_results(outputs, y)
+    assert torch.equal(loss, results.loss)
+
+    leaf_losses = results.get_leaf_losses()
+    for path, leaf_loss in criterion.get_leaf_losses().items():
+        expected = BaseMetricDecorator(leaf_loss.task_name, leaf_loss.available, leaf_loss.prefix, leaf_loss.metric)
+        assert torch.allclose(expected(outputs, y), leaf_losses[path])
+
+    # The per-sample losses must match the per-sample losses of the tasks, computed directly.
+    actual = results.get_per_sample()
+    bs = len(y['camera_blocked'])
+    overall = torch.zeros(bs, dtype=outputs['camera_blocked'].dtype)
+    for path, task in task_flow.get_all_children().items():
+        precondition = outputs[f'precondition|{path}']
+        precondition = (precondition.sum(dim=tuple(range(1, precondition.dim()))) > 0) if precondition.dim() > 1 \
+            else precondition.bool()
+        expected = task.get_per_sample_loss()(outputs[path][precondition], y[path][precondition])
+        expected = expected.squeeze(dim=-1) if expected.dim() > 1 else expected
+        assert torch.allclose(actual[path], expected, atol=1e-6)
+        assert torch.equal(actual[f'indices|{path}'], torch.arange(bs)[precondition])
+        overall[precondition] += expected
+    assert torch.allclose(actual['overall'], overall, atol=1e-6)
+    assert torch.equal(actual['indices|overall'], torch.arange(bs))
+
+    per_sample = task_flow.get_per_sample_loss()(outputs, y)
+    assert per_sample.keys() == actual.keys()
+    for key, value in actual.items():
+        assert torch.allclose(per_sample[key], value)
+
+    # A sample satisfies a precondition with several columns when any of them is set.
+    path = 'driver_flow.driver_has_seatbelt'
+    precondition = outputs[f'precondition|{path}'].reshape(bs).bool()
+    first_column = precondition & (torch.arange(bs) % 2 == 0)
+    outputs[f'precondition|{path}'] = torch.stack([first_column, precondition], dim=1)
+    multi_column = criterion.get_results(outputs, y).get_per_sample()
+    assert torch.allclose(multi_column[path], actual[path], atol=1e-6)
+    assert torch.equal(multi_column[f'indices|{path}'], actual[f'indices|{path}'])
+    assert torch.allclose(multi_column['overall'], actual['overall'], atol=1e-6)
+
+
+def test_loss_results_are_shared_by_callbacks_through_the_state(interior_car_task):
+    from types import SimpleNamespace
+    from dnn_cool.catalyst_utils import FlowCriterionCallback, LeafLossCallback, LOSS_RESULTS_KEY, get_loss_results
+
+    model, task_flow = interior_car_task
+    loader = DataLoader(task_flow.get_dataset(), batch_size=32, shuffle=False)
+    X, y = next(iter(loader))
+    criterion = task_flow.get_loss()
+    get_results = criterion.get_results
+    calls = []
+
+    def counting_get_results(outputs, targets):
+        calls.append(1)
+        return get_results(outputs, targets)
+
+    criterion.get_results = counting_get_results
+    leaf_callbacks = [callback for callback in criterion.catalyst_callbacks() if isinstance(callback, LeafLossCallback)]
+    criterion_callback = FlowCriterionCallback()
+    criterion_callback._criterion = criterion
+
+    for _ in range(2):
+        state = SimpleNamespace(output={'logits': model(X)}, input={'targets': y}, batch_metrics={})
+        for callback in leaf_callbacks + [criterion_callback]:
+            callback.on_batch_end(state)
+        assert len(state.output[LOSS_RESULTS_KEY]) == 1
+        results = get_loss_results(state, criterion)
+        assert torch.equal(state.batch_metrics['loss'], results.loss)
+        for callback in leaf_callbacks:
+            assert torch.equal(state.batch_metrics[callback.prefix], results.get_leaf_losses()[callback.path])
+    # The losses are computed once per batch.
+    assert len(calls) == 2
+    # Another criterion does not reuse the results of the first one.
+    other_results = get_loss_results(state, task_flow.get_loss())
+    assert other_results is not results
+    assert len(state.output[LOSS_RESULTS_KEY]) == 2
+
+
+def test_batched_loss_matches_loss_with_class_buffers():
+    def flow_func(flow, x, out):
+        out += flow.first(x.features)
+        out += flow.second(x.features)
+        return out
+
+    torch.manual_seed(0)
+    inputs = Values(keys=['inp'], values=[torch.randn(8, 3)])
+    pos_weight = torch.tensor([1., 2., 3.])
+    tasks = [MultilabelClassificationTask(name=name, labels=(torch.rand(8, 3) > 0.5).float(),
+                                          loss=nn.BCEWithLogitsLoss(pos_weight=pos_weight))
+             for name in ('first', 'second')]
+    task_flow = TaskFlow(name='flow', tasks=tasks, inputs=inputs, flow_func=flow_func)
+    preconditions = torch.tensor([[True, True], [True, False], [False, True], [True, True],
+                                  [False, False], [True, True], [True, False], [False, True]])
+    outputs = {PACKED_PRECONDITIONS_KEY: preconditions}
+    targets = {}
+    for i, task in enumerate(tasks):
+        outputs[task.name] = torch.randn(8, 3)
+        outputs[f'precondition|{task.name}'] = preconditions[:, i]
+        targets[task.name] = task.labels
+
+    actual = task_flow.get_loss()(outputs, targets)
+    expected = torch.zeros(1)
+    for i, task in enumerate(tasks):
+        mask = preconditions[:, i]
+        expected += nn.BCEWithLogitsLoss(pos_weight=pos_weight)(outputs[task.name][mask], targets[task.name][mask])
+    assert torch.allclose(actual, expected)
+
+
+def test_mean_loss_leaves_out_ignored_targets():
+    criterion = nn.CrossEntropyLoss()
+    loss = TaskLossDecorator('task', None, '', criterion)
+    outputs = torch.randn(6, 4)
+    targets = torch.tensor([0, -100, 2, 3, -100, 1])
+    precondition = torch.tensor([True, True, True, False, True, True])
+    loss_flow_data = LossFlowData({'task': outputs, 'precondition|task': precondition}, {'task': targets})
+
+    assert not loss.batchable
+    expected = criterion(outputs[precondition], targets[precondition])
+    assert torch.allclose(loss.compute_leaf(loss_flow_data).loss, expected)
+    assert torch.allclose(loss.compute_leaf(loss_flow_data, masked=True).loss, expected)
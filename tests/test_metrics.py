@@ -1,6 +1,9 @@
-from sklearn.metrics import accuracy_score
+import numpy as np
+import torch
+from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
 
-from dnn_cool.metrics import BinaryAccuracy, NumpyMetric
+from dnn_cool.metrics import BinaryAccuracy, NumpyMetric, TaskMetrics
+from dnn_cool.task_flow import BinaryClassificationTask, ClassificationTask
 
 
 def test_binary_accuracy(simple_binary_data):
@@ -20,3 +23,91 @@ def test_scikit_accuracy(simple_binary_data):
     res = metric(x, y, activate=True).item()
     assert res >= 0.70
 
+
+def test_accumulated_metrics_match_whole_epoch():
+    torch.manual_seed(0)
+    outputs = torch.randn(100, 1)
+    targets = (torch.randn(100, 1) > 0.).float()
+    mask = torch.randn(100) > -0.5
+    expected_preds = (torch.sigmoid(outputs[mask]) > 0.5).numpy()[:, 0]
+    expected_targets = targets[mask].numpy()[:, 0]
+
+    task = BinaryClassificationTask('binary', module=None, labels=targets)
+    for metric_name, metric in task.get_metrics():
+        for start in range(0, 100, 32):
+            metric.update(outputs[start:start + 32], targets[start:start + 32], mask[start:start + 32])
+        expected = {
+            'accuracy': accuracy_score,
+            'f1_score': f1_score,
+            'precision': precision_score,
+            'recall': recall_score
+        }[metric_name](expected_targets, expected_preds)
+        assert np.isclose(metric.compute(), expected)
+        metric.reset()
+        assert metric.compute() is None
+
+    outputs = torch.randn(100, 7)
+    targets = torch.randint(0, 7, size=(100,))
+    task = ClassificationTask('classification', module=None, labels=targets)
+    metrics = dict(task.get_metrics())
+    for metric in metrics.values():
+        for start in range(0, 100, 32):
+            metric.update(outputs[start:start + 32], targets[start:start + 32], mask[start:start + 32])
+    top1, top3, top5 = metrics['accuracy'].compute()
+    ranks = (outputs[mask].argsort(dim=1, descending=True) == targets[mask].unsqueeze(dim=1)).float().argmax(dim=1)
+    assert np.isclose(top1, (ranks < 1).float().mean().item())
+    assert np.isclose(top3, (ranks < 3).float().mean().item())
+    assert np.isclose(top5, (ranks < 5).float().mean().item())
+    assert np.isclose(metrics['f1_score'].compute(), top1)
+
+
+def test_task_metrics_are_derived_from_one_statistic():
+    torch.manual_seed(0)
+    outputs = torch.randn(64, 1)
+    targets = (torch.randn(64, 1) > 0.).float()
+    task = BinaryClassificationTask('binary', module=None, labels=targets)
+    metrics = task.get_metrics()
+
+    decoder = task.get_decoder()
+    calls = []
+    task.decoder = lambda x: calls.append(x) or decoder(x)
+    task_metrics = TaskMetrics(task.get_metrics())
+    assert len(task_metrics.statistics) == 1
+    actual = task_metrics.evaluate(outputs, targets)
+    assert len(calls) == 1
+    task.decoder = decoder
+
+    for metric_name, metric in metrics:
+        assert np.isclose(actual[metric_name], float(metric(outputs, targets)))
+
+    outputs = torch.randn(64, 4)
+    targets = torch.randint(0, 4, size=(64,))
+    task = ClassificationTask('classification', module=None, labels=targets)
+    actual = TaskMetrics(task.get_metrics()).evaluate(outputs, targets)
+    for metric_name, metric in task.get_metrics():
+        expected = metric(outputs, targets)
+        if metric.is_multi_metric():
+            assert np.allclose(actual[metric_name], [float(value) for value in expected])
+        else:
+            assert np.isclose(actual[metric_name], float(expected))
+
+
+def test_top_k_hits_with_one_score_predict_the_first_class():
+    task = ClassificationTask('classification', module=None, labels=torch.zeros(4))
+    metric = dict(task.get_metrics())['accuracy']
+    metric.bind_to_task(task)
+    # The scores are not class indices: with a single score, the prediction is always the class 0.
+    outputs = torch.tensor([[5.], [1.], [0.], [0.]])
+    targets = torch.tensor([0, 0, 0, 1])
+    assert metric(outputs, targets, activate=False) == [0.75]
+
+
+def test_scikit_metrics_receive_the_targets_first(simple_binary_data):
+    x, y, task_mock = simple_binary_data
+    preds = (torch.sigmoid(x) > 0.5).numpy()
+    for metric_fn in (precision_score, recall_score):
+        metric = NumpyMetric(metric_fn)
+        metric.bind_to_task(task_mock)
+        # The precision and the recall differ on this data, so swapped arguments would swap them too.
+        assert np.isclose(metric(x, y, activate=True), metric_fn(y.numpy(), preds))
+    assert not np.isclose(precision_score(y.numpy(), preds), recall_score(y.numpy(), preds))
@@ -0,0 +1,209 @@
+import torch
+from torch.utils.data import DataLoader
+
+from dnn_cool.modules import CompositeModuleOutput, FeaturesDict, MaskEvaluator, evaluate_preconditions
+from dnn_cool.packed import PACKED_PRECONDITIONS_KEY
+
+
+def create_features(n):
+    return {
+        'driver_features': torch.randn(n, 128),
+        'passenger_features': torch.randn(n, 128),
+        'features': torch.randn(n, 128),
+        'gt': None
+    }
+
+
+def test_sparse_inference_matches_dense(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval()
+    features = create_features(64)
+
+    with torch.no_grad():
+        expected = flow_module(features)
+        actual = flow_module.set_sparse_inference(fill_value=0)(features)
+    flow_module.set_sparse_inference(False)
+
+    for path in task_flow.get_all_children():
+        precondition = expected.preconditions[path]
+        assert torch.equal(actual.preconditions[path], precondition)
+        rows = precondition.reshape(len(precondition), -1).any(dim=1)
+        assert torch.allclose(actual.logits[path][rows], expected.logits[path][rows], atol=1e-6)
+        assert torch.equal(actual.decoded[path][rows], expected.decoded[path][rows])
+        assert (actual.logits[path][~rows] == 0).all()
+
+
+def test_sparse_inference_runs_heads_only_on_selected_rows(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval().set_sparse_inference()
+    seen_rows = []
+    handle = flow_module.driver_flow.driver_has_seatbelt.module.register_forward_hook(
+        lambda module, inputs, outputs: seen_rows.append(len(inputs[0])))
+
+    with torch.no_grad():
+        res = flow_module(create_features(64))
+    handle.remove()
+    flow_module.set_sparse_inference(False)
+
+    expected_rows = res.preconditions['driver_flow.driver_has_seatbelt'].sum().item()
+    assert seen_rows == [expected_rows]
+
+
+def test_sparse_inference_gates_rows_once_per_forward(interior_car_task, monkeypatch):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval().set_sparse_inference()
+    evaluators = []
+    init = MaskEvaluator.__init__
+
+    def record_init(self, data):
+        evaluators.append(self)
+        init(self, data)
+
+    monkeypatch.setattr(MaskEvaluator, '__init__', record_init)
+    with torch.no_grad():
+        flow_module(create_features(64))
+    flow_module.set_sparse_inference(False)
+
+    # One evaluator gates the rows of all leaves and one computes the returned preconditions.
+    assert len(evaluators) == 2
+
+
+def test_sparse_inference_skips_leaves_without_rows(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval().set_sparse_inference(fill_value=-1)
+    features = create_features(16)
+    seen_rows = []
+    handle = flow_module.driver_flow.driver_has_seatbelt.module.register_forward_hook(
+        lambda module, inputs, outputs: seen_rows.append(len(inputs[0])))
+    camera_blocked = flow_module.camera_blocked.module
+
+    with torch.no_grad():
+        expected = flow_module.set_sparse_inference(False)(features)
+        flow_module._leaf_shapes.clear()
+        flow_module.set_sparse_inference(fill_value=-1)
+        # When the camera is blocked, no other task has rows.
+        camera_blocked.bias.add_(100.)
+        actual = flow_module(features)
+        # The shapes are known now, so the leaf is not computed at all.
+        flow_module(features)
+        camera_blocked.bias.sub_(100.)
+    handle.remove()
+    flow_module.set_sparse_inference(False)
+
+    # The dense pass runs the fused heads, so the head is only computed once on a single row, to find its shapes.
+    assert seen_rows == [1]
+    for path in task_flow.get_all_children():
+        if path == 'camera_blocked':
+            continue
+        assert not actual.preconditions[path].any()
+        assert actual.logits[path].shape == expected.logits[path].shape
+        assert actual.logits[path].dtype == expected.logits[path].dtype
+        assert (actual.logits[path] == -1).all()
+
+
+def test_fused_heads_match_unfused(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval()
+    features = create_features(32)
+    assert len(flow_module._fusable_groups) > 0
+
+    with torch.no_grad():
+        fused = flow_module(features)
+        flow_module.fuse_heads = False
+        unfused = flow_module(features)
+    flow_module.fuse_heads = True
+
+    for path in task_flow.get_all_children():
+        assert torch.allclose(fused.logits[path], unfused.logits[path], atol=1e-6)
+        assert torch.equal(fused.preconditions[path], unfused.preconditions[path])
+
+
+def test_fused_heads_train_original_parameters(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.train()
+    state_dict_keys = set(flow_module.state_dict().keys())
+    flow_module.zero_grad()
+
+    out = CompositeModuleOutput(training=True, gt=None, prefix='')
+    res = flow_module.run_compiled(FeaturesDict(create_features(32)), out)
+    sum(value.sum() for value in res.logits.values()).backward()
+
+    assert set(flow_module.state_dict().keys()) == state_dict_keys
+    for group in flow_module._fusable_groups:
+        for i in group:
+            path = flow_module.get_compiled_flow().leaves[i].path
+            linear = flow_module.get_compiled_flow().resolve_leaves(flow_module)[i].module
+            assert linear.weight.grad is not None, path
+
+
+def test_fused_heads_are_cached_until_parameters_change(interior_car_task):
+    model, task_flow = interior_car_task
+    flow_module = model.flow_module.eval()
+    features = create_features(32)
+    group = flow_module._fusable_groups[0]
+    linear = flow_module.get_compiled_flow().resolve_leaves(flow_module)[group[0]].module
+    path = flow_module.get_compiled_flow().leaves[group[0]].path
+
+    with torch.no_grad():
+        flow_module(features)
+        weight = flow_module._fused_params[tuple(group)][1][0]
+        flow_module(features)
+        assert flow_module._fused_params[tuple(group)][1][0] is weight
+
+        linear.weight.add_(1.)
+        fused = flow_module(features)
+        flow_module.fuse_heads = False
+        unfused = flow_module(features)
+        linear.weight.sub_(1.)
+    flow_module.fuse_heads = True
+
+    assert flow_module._fused_params[tuple(group)][1][0] is not weight
+    assert torch.allclose(fused.logits[path], unfused.logits[path], atol=1e-5)
+
+
+def test_mask_evaluator_computes_shared_conditions_once(interior_car_task):
+    model, task_flow = interior_car_task
+    compiled_flow = task_flow.get_compiled_flow()
+    data = {path: torch.randn(16, 1) > 0. for path in compiled_flow.get_paths()}
+    preconditions = compiled_flow.get_preconditions()
+
+    mask_evaluator = MaskEvaluator(data)
+    seatbelt = mask_evaluator.to_mask(preconditions['driver_flow.driver_has_seatbelt'])
+    uniform = mask_evaluator.to_mask(preconditions['driver_flow.driver_uniform_type'])
+
+    assert seatbelt is uniform
+    assert torch.equal(seatbelt, preconditions['driver_flow.driver_has_seatbelt'].to_mask(data))
+    expected = ~data['driver_flow.driver_seat_empty'] & ~data['camera_blocked']
+    assert torch.equal(seatbelt, expected)
+
+
+def test_packed_preconditions_match_masks(interior_car_task):
+    model, task_flow = interior_car_task
+    X, y = next(iter(DataLoader(task_flow.get_dataset(), batch_size=16, shuffle=False)))
+
+    res = model(X)
+
+    paths = task_flow.get_compiled_flow().get_paths()
+    assert res[PACKED_PRECONDITIONS_KEY].shape == (16, len(paths))
+    for i, path in enumerate(paths):
+        expected = res[f'precondition|{path}'].reshape(16, -1).any(dim=1)
+        assert torch.equal(res[PACKED_PRECONDITIONS_KEY][:, i], expected)
+
+
+def test_preconditions_are_evaluated_with_shared_masks(interior_car_task):
+    model, task_flow = interior_car_task
+    preconditions = task_flow.get_compiled_flow().get_preconditions()
+    data = {path: torch.randn(16, 1) > 0. for path in preconditions}
+    seatbelt = preconditions['driver_flow.driver_has_seatbelt']
+    precomputed = {'driver_flow.driver_has_seatbelt': seatbelt.to_mask(data).clone()}
+
+    masks = evaluate_preconditions(preconditions, data, precomputed)
+    assert masks['driver_flow.driver_has_seatbelt'] is precomputed['driver_flow.driver_has_seatbelt']
+    assert masks['driver_flow.driver_uniform_type'] is precomputed['driver_flow.driver_has_seatbelt']
+    for path, precondition in preconditions.items():
+        assert torch.equal(masks[path], precondition.to_mask(data))
+
+    with torch.no_grad():
+        out = model.flow_module.eval()(create_features(4))
+    tree = task_flow.get_treelib_explainer()(out)
+    assert len(tree.nodes) > 1
@@ -0,0 +1,111 @@
+import torch
+from torch.utils.data import DataLoader
+
+from dnn_cool.converters import Values
+from dnn_cool.datasets import IndexHolder, FlowDatasetDict
+from dnn_cool.losses import LossFlowData, LossItems
+from dnn_cool.modules import FeaturesDict, CompositeModuleOutput, NestedCondition, AndCondition
+from dnn_cool.packed import PackedGt
+from dnn_cool.task_flow import TaskFlow, BinaryHardcodedTask
+from dnn_cool.tracing import InputRef
+
+
+def create_numerical_flow():
+    def numerical_flow(flow, x, out):
+        out += flow.is_even(x.features)
+        out += flow.predict_positive(x.features) | out.is_even
+        out += flow.multiple_three(x.features) | out.predict_positive
+        return out
+
+    def full_flow(flow, x, out):
+        out += flow.is_interesting(x.features)
+        out += flow.numerical_flow(x) | out.is_interesting
+        return out
+
+    tensor = torch.arange(8).unsqueeze(dim=-1)
+    inputs = Values(keys=['inp'], values=[tensor])
+
+    is_even_task = BinaryHardcodedTask(name='is_even', labels=(tensor % 2) == 0)
+    predict_positive = BinaryHardcodedTask(name='predict_positive', labels=(tensor > 0.))
+    multiple_three = BinaryHardcodedTask(name='multiple_three', labels=(tensor % 3) == 0)
+    is_interesting_task = BinaryHardcodedTask(name='is_interesting', labels=torch.tensor(
+        [True, True, False, False, False, True, True, True]).unsqueeze(dim=-1))
+
+    tasks = [is_even_task, predict_positive, multiple_three]
+    numerical_flow_task = TaskFlow(name='numerical_flow', tasks=tasks, inputs=inputs, flow_func=numerical_flow)
+    return TaskFlow(name='full_flow', tasks=[is_interesting_task, numerical_flow_task], inputs=inputs,
+                    flow_func=full_flow)
+
+
+def test_trace_records_leaves_inputs_and_preconditions():
+    flow = create_numerical_flow()
+    compiled_flow = flow.get_compiled_flow()
+
+    assert compiled_flow.get_paths() == ['is_interesting',
+                                         'numerical_flow.is_even',
+                                         'numerical_flow.predict_positive',
+                                         'numerical_flow.multiple_three']
+    assert compiled_flow.leaves[1].args == (InputRef(('features',)),)
+    precondition = compiled_flow.get_preconditions()['numerical_flow.predict_positive']
+    assert isinstance(precondition, AndCondition)
+    assert isinstance(precondition.condition_one, NestedCondition)
+    assert compiled_flow.get_condition_paths() == ['is_interesting',
+                                                   'numerical_flow.is_even',
+                                                   'numerical_flow.predict_positive']
+    assert flow.get_compiled_flow() is compiled_flow
+
+
+def test_compiled_dataset_matches_flow():
+    flow = create_numerical_flow()
+    dataset = flow.get_dataset()
+
+    for i in range(len(dataset)):
+        X, y = dataset[i]
+        expected_X, expected_y = dataset.flow(dataset, IndexHolder(i), FlowDatasetDict('', {})).to_dict({'inp': None})
+        expected_gt = expected_X['gt']
+        expected_available = expected_gt.pop('_availability')
+        assert set(X['gt']['_availability'].keys()) == set(expected_available.keys())
+        for key, value in expected_y.items():
+            assert torch.equal(y[key], value)
+        for key, value in expected_gt.items():
+            assert torch.equal(X['gt'][key], value)
+        for key, value in expected_available.items():
+            assert torch.equal(X['gt']['_availability'][key], value)
+
+
+def test_compiled_module_and_loss_match_flow(interior_car_task):
+    model, task_flow = interior_car_task
+    loader = DataLoader(task_flow.get_dataset(), batch_size=32, shuffle=False)
+    X, y = next(iter(loader))
+    flow_module = model.flow_module
+    criterion = task_flow.get_loss()
+
+    common = model.seq(X['inputs'])
+    features = {
+        'driver_features': model.driver_features_fc(common),
+        'passenger_features': model.passenger_features_fc(common),
+        'features': model.features_fc(common),
+        'gt': X['gt']
+    }
+    actual = flow_module(features)
+    gt = PackedGt(X['gt'], task_flow.get_packed_layout())
+    out = CompositeModuleOutput(training=flow_module.training, gt=gt, prefix='')
+    expected = flow_module.flow(flow_module, FeaturesDict(features), out).reduce()
+
+    assert actual.keys() == expected.keys()
+    for key, value in expected.items():
+        assert torch.allclose(actual[key], value)
+
+    expected_loss = criterion.flow(criterion, LossFlowData(expected, y), LossItems(torch.zeros(1))).loss_items
+    assert torch.allclose(criterion(actual, y), expected_loss)
+
+
+def test_leaves_are_grouped_by_precondition(interior_car_task):
+    model, task_flow = interior_car_task
+    compiled_flow = task_flow.get_compiled_flow()
+
+    groups = [[compiled_flow.leaves[i].path for i in group] for group in compiled_flow.get_precondition_groups()]
+    assert groups == [['camera_blocked'],
+                      ['driver_flow.driver_seat_empty', 'passenger_flow.passenger_seat_empty'],
+                      ['driver_flow.driver_has_seatbelt', 'driver_flow.driver_uniform_type'],
+                      ['passenger_flow.passenger_uniform_type']]